@@ -0,0 +1,182 @@
+import collections
+import hmac
+import http
+import json
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+import relayTrace
+import metrics
+
+## Admin API to find out where a running switchboard spends its time, on /admin/ of both server engines:
+#       GET /admin/threads
+#           The stacks of all threads as text. Threads with the same stack are listed together, so hundreds of connections
+#           waiting at the same place show up once.
+#       GET /admin/profile?seconds=[seconds]&interval=[seconds]
+#           Sample the stacks of all threads every interval (default 0.01) for the given time (default 5, at most
+#           max_profile_seconds), and reply with the number of times every stack was seen in the collapsed stack format of
+#           flamegraph.pl and speedscope: a line of "outer (file:line);...;inner (file:line) count" per stack.
+#           Only one profile runs at a time, a request for another one gets a 409.
+#       POST /admin/trace/[key]?seconds=[seconds]
+#           Trace the relay latency of a session (see relayTrace) for the given time (default 60, at most max_trace_seconds),
+#           with 0 seconds a running trace is stopped. Replies with the trace, like a GET does.
+#       GET /admin/trace/[key]
+#           The running or last trace of a session as json, with a histogram of the relay latency till each message was handed
+#           to the other side, and one till it was written to it.
+#   Every request needs an "Authorization: Bearer [token]" header, without it or with another token the reply is a 401.
+#   Without a token the admin API is disabled, and everything on /admin/ is a 404.
+#   The admin API is not subject to admission control, so it keeps working during the request storms it may be needed for.
+#   Requests are handled in the thread that calls handle, and a profile blocks that thread for as long as it runs, so the
+#   asyncio engine calls it from its executor. With server_workers the threads and profiles are those of the worker that handles
+#   the request, requests for a trace are routed to the home worker of its key.
+
+text_content_type = "text/plain; charset=utf-8"
+# Thread names that are listed for a stack, the rest is only counted.
+max_thread_names = 10
+
+_profile_lock = threading.Lock()
+
+
+class AdminResponse:
+    def __init__(self, status, body, content_type=text_content_type, headers=()):
+        self.status = status
+        self.body = body
+        self.headers = [("Content-Type", content_type)] + list(headers)
+
+
+## The stacks of all threads of this process as text, threads with the same stack are grouped.
+def dumpThreads():
+    frames = sys._current_frames()
+    groups = {}
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "  No stack\n"
+        groups.setdefault(stack, []).append(thread.name)
+    frames = None
+    lines = ["%d threads" % (sum(len(names) for names in groups.values()))]
+    for stack, names in sorted(groups.items(), key=lambda item: -len(item[1])):
+        names.sort()
+        listed = ", ".join(names[:max_thread_names])
+        if len(names) > max_thread_names:
+            listed += ", and %d more" % (len(names) - max_thread_names)
+        lines += ["", "%d x %s" % (len(names), listed), stack.rstrip("\n")]
+    return "\n".join(lines) + "\n"
+
+
+## Sample the stacks of all other threads every interval for the given number of seconds.
+#   Returns the collapsed stacks with their counts, or None when another profile is already running.
+def profile(seconds, interval):
+    if not _profile_lock.acquire(False):
+        return None
+    try:
+        own_ident = threading.get_ident()
+        labels = {}
+        counts = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while True:
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    location = (frame.f_code, frame.f_lineno)
+                    label = labels.get(location)
+                    if label is None:
+                        code = frame.f_code
+                        label = labels[location] = "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+                    stack.append(label)
+                    frame = frame.f_back
+                counts[tuple(stack)] += 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(interval, remaining))
+    finally:
+        _profile_lock.release()
+    lines = sorted("%s %d\n" % (";".join(reversed(stack)), count) for stack, count in counts.items())
+    return "".join(lines)
+
+
+class AdminApi:
+    ## registry is the GameRegistryMixin of the server, token the shared secret of the admin requests or None to disable them.
+    def __init__(self, registry, token, max_profile_seconds=60.0, max_trace_seconds=3600.0):
+        self.__registry = registry
+        self.__token = None if token is None else token.encode("utf-8")
+        self.max_profile_seconds = max_profile_seconds
+        self.max_trace_seconds = max_trace_seconds
+
+    ## Game key of a request for a trace, or None when the request is not about a trace.
+    @staticmethod
+    def traceKey(path):
+        path = urllib.parse.urlsplit(path).path
+        if path.startswith("/admin/trace/"):
+            return path[13:]
+        return None
+
+    ## Handle an admin request, returns the AdminResponse to send. Posted data is never read, the caller has to take care of that.
+    def handle(self, command, path, headers):
+        if self.__token is None:
+            return self.__error(http.HTTPStatus.NOT_FOUND)
+        if not self.__isAuthorized(headers.get("Authorization")):
+            return self.__error(http.HTTPStatus.UNAUTHORIZED, [("WWW-Authenticate", "Bearer")])
+        url = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            if url.path == "/admin/threads" and command == "GET":
+                return AdminResponse(http.HTTPStatus.OK, dumpThreads().encode("utf-8"))
+            elif url.path == "/admin/profile" and command == "GET":
+                seconds = self.__getSeconds(query, "seconds", 5.0, self.max_profile_seconds)
+                interval = max(0.001, self.__getSeconds(query, "interval", 0.01, 1.0))
+                result = profile(seconds, interval)
+                if result is None:
+                    return self.__error(http.HTTPStatus.CONFLICT)
+                return AdminResponse(http.HTTPStatus.OK, result.encode("utf-8"))
+            elif url.path.startswith("/admin/trace/") and command in ("GET", "POST"):
+                return self.__handleTrace(command, url.path[13:], query)
+        except ValueError:
+            return self.__error(http.HTTPStatus.BAD_REQUEST)
+        return self.__error(http.HTTPStatus.NOT_FOUND)
+
+    def __handleTrace(self, command, game_key, query):
+        if command == "POST":
+            seconds = self.__getSeconds(query, "seconds", 60.0, self.max_trace_seconds)
+            if seconds > 0:
+                if self.__registry.findGame(game_key) is None:
+                    metrics.session_not_found.labels("trace").inc()
+                    return self.__error(http.HTTPStatus.NOT_FOUND)
+                relayTrace.start(game_key, seconds)
+            else:
+                relayTrace.stop(game_key)
+        trace = relayTrace.get(game_key)
+        if trace is None:
+            # A session that exists but was never traced is not a lookup miss.
+            if self.__registry.findGame(game_key) is None:
+                metrics.session_not_found.labels("trace").inc()
+            return self.__error(http.HTTPStatus.NOT_FOUND)
+        return AdminResponse(http.HTTPStatus.OK, json.dumps(trace.toJson()).encode("ascii"), "application/json")
+
+    def __isAuthorized(self, authorization):
+        if authorization is None:
+            return False
+        scheme, _, token = authorization.strip().partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode("utf-8"), self.__token)
+
+    ## Get a time in seconds from the query, limited to maximum. Raises ValueError when it is not a valid time.
+    @staticmethod
+    def __getSeconds(query, name, default, maximum):
+        if name not in query:
+            return min(default, maximum)
+        seconds = float(query[name][0])
+        if not math.isfinite(seconds) or seconds < 0:
+            raise ValueError("Invalid %s: %s" % (name, query[name][0]))
+        return min(seconds, maximum)
+
+    @staticmethod
+    def __error(status, headers=()):
+        status = http.HTTPStatus(status)
+        return AdminResponse(status, status.phrase.encode("ascii"), text_content_type, headers)
@@ -0,0 +1,124 @@
+import collections
+import math
+import time
+import http
+
+import metrics
+
+## Admission control for the HTTP API and upgrades, shared by the threaded and asyncio server engines.
+#   Requests are grouped in endpoint classes: "register" (/game/register), "list" (/game/list and /game/watch),
+#   "connect" (/game/connect) and "master" (/game/master). Every class can have a token bucket for all clients together,
+#   and one per client address. A request is checked before anything else is done for it, like reading the posted json,
+#   and is refused with a 429 when its client address is over its limit, or a 503 when all clients together are.
+#   Both come with a Retry-After of the time till a token is available again.
+#   On top of that the number of relays (paired /game/connect connections) and parked masters (master connections that are
+#   not paired with a client) can be capped, upgrades over the cap get a 503.
+#   Relays that are already established never pass admission control again, so their traffic is not affected by request storms.
+#   With server_workers every worker process has its own limits.
+
+endpoint_classes = ("register", "list", "connect", "master")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "time")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = now
+
+    ## Take a token, returns 0 when there was one, otherwise the time till the next token is available.
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+## Get the value for a Retry-After header from a time in seconds.
+def retryAfter(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+class AdmissionControl:
+    # Per address buckets of this many client addresses are kept, the least recently used addresses are forgotten first.
+    max_addresses = 65536
+    # Retry-After for upgrades that are refused because a cap on connections is reached.
+    capacity_retry_after = 5.0
+
+    ## global_rates and address_rates are dicts of endpoint class to (requests per second, burst), classes without an entry are not limited.
+    #   max_relays and max_parked_masters of 0 do not cap the number of connections.
+    def __init__(self, global_rates=None, address_rates=None, max_relays=0, max_parked_masters=0):
+        now = time.monotonic()
+        self.__lock = metrics.TimedLock("admission")
+        self.__global_buckets = {name: TokenBucket(rate, burst, now) for name, (rate, burst) in (global_rates or {}).items()}
+        self.__address_rates = dict(address_rates or {})
+        self.__address_buckets = collections.OrderedDict()
+        self.max_relays = max_relays
+        self.max_parked_masters = max_parked_masters
+        self.__connections = {"relay": 0, "master": 0}
+        metrics.admitted_connections.setCallback(lambda: {(role,): count for role, count in self.__connections.items()})
+
+    ## Check if a request of an endpoint class from remote_address can be handled.
+    #   Returns None when it is admitted, otherwise (status, retry_after) for the response that refuses it.
+    def admit(self, endpoint_class, remote_address):
+        global_bucket = self.__global_buckets.get(endpoint_class)
+        address_rate = self.__address_rates.get(endpoint_class)
+        if global_bucket is None and address_rate is None:
+            return None
+        now = time.monotonic()
+        with self.__lock:
+            address_bucket = None
+            if address_rate is not None:
+                address_bucket = self.__getAddressBucket(endpoint_class, remote_address, address_rate, now)
+                wait = address_bucket.take(now)
+                if wait > 0:
+                    metrics.admission_refused.labels(endpoint_class, "address_rate").inc()
+                    return http.HTTPStatus.TOO_MANY_REQUESTS, retryAfter(wait)
+            if global_bucket is not None:
+                wait = global_bucket.take(now)
+                if wait > 0:
+                    # The request is not handled, so it should not count against the client.
+                    if address_bucket is not None:
+                        address_bucket.refund()
+                    metrics.admission_refused.labels(endpoint_class, "global_rate").inc()
+                    return http.HTTPStatus.SERVICE_UNAVAILABLE, retryAfter(wait)
+        return None
+
+    ## Take a slot for a connection of the role "relay" or "master", to be released with leave when the connection is closed.
+    #   Returns None when there is room, otherwise (status, retry_after) for the response that refuses the upgrade.
+    def enter(self, role):
+        with self.__lock:
+            connections = self.__connections
+            if role == "relay":
+                full = self.max_relays > 0 and connections["relay"] >= self.max_relays
+            else:
+                # Every relay has a master, so masters without a relay are parked. Multiplexed masters serve many relays at once.
+                full = self.max_parked_masters > 0 and connections["master"] - connections["relay"] >= self.max_parked_masters
+            if not full:
+                connections[role] += 1
+                return None
+        metrics.admission_refused.labels(role if role == "master" else "connect", "capacity").inc()
+        return http.HTTPStatus.SERVICE_UNAVAILABLE, retryAfter(self.capacity_retry_after)
+
+    def leave(self, role):
+        with self.__lock:
+            self.__connections[role] -= 1
+
+    # Needs to be called with the lock held.
+    def __getAddressBucket(self, endpoint_class, remote_address, rate, now):
+        key = (endpoint_class, remote_address)
+        bucket = self.__address_buckets.get(key)
+        if bucket is None:
+            bucket = self.__address_buckets[key] = TokenBucket(rate[0], rate[1], now)
+            if len(self.__address_buckets) > self.max_addresses:
+                self.__address_buckets.popitem(last=False)
+        else:
+            self.__address_buckets.move_to_end(key)
+        return bucket
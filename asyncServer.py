@@ -0,0 +1,759 @@
+import asyncio
+import http
+import http.client
+import io
+import json
+import logging
+import struct
+import time
+import urllib.parse
+import zlib
+
+import config
+import websocketParse
+import websocketDeflate
+import lobbyCache
+import staticFiles
+import keepalive
+import metrics
+import sessionLog
+import multiplex
+import lobbyWatch
+import admission
+import adminApi
+import relayTrace
+from gameSession import GameSession, GameRegistryMixin, parseConnectPath
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## Asyncio engine for the switchboard.
+#   Instead of a thread per connection, every connection is a task on a single event loop.
+#   A parked /game/master connection only costs a socket, a task and its stream buffers, so a single core
+#   can keep tens of thousands of them waiting for clients.
+#   The HTTP API is the same as the threaded HTTPRequestHandler in main.py, see the description there.
+
+relayed_websocket_messages_metric = metrics.relayed_messages.labels("websocket")
+relayed_websocket_bytes_metric = metrics.relayed_bytes.labels("websocket")
+relayed_raw_messages_metric = metrics.relayed_messages.labels("raw")
+relayed_raw_bytes_metric = metrics.relayed_bytes.labels("raw")
+deflate_compressed_metric = metrics.deflate_messages.labels("compressed")
+deflate_decompressed_metric = metrics.deflate_messages.labels("decompressed")
+deflate_passthrough_metric = metrics.deflate_messages.labels("passthrough")
+
+
+class AsyncConnection:
+    # Every parked master is one of these, so there is no instance dict.
+    __slots__ = ("server", "reader", "writer", "client_address", "command", "path", "request_version", "headers", "keep_alive", "other", "multiplexer",
+        "last_activity", "keepalive_timeout", "__is_websocket", "__is_raw", "deflate", "__loop", "admission_role", "retry_after", "trace_key")
+    # Limit of the request line and headers together, larger requests are closed. Also the buffer limit of the StreamReader.
+    max_header_size = 64 * 1024
+    websocket_timeout = getattr(config, "websocket_idle_timeout", 20.0)
+    rawsocket_timeout = 60.0 * 60.0
+    # Raw data is read in chunks of whatever the StreamReader has buffered, up to this size.
+    rawsocket_read_size = 64 * 1024
+    # Do not queue keepalive pings behind this many bytes of unsend data, the connection is congested or dead.
+    keepalive_max_buffer = 64 * 1024
+    max_connect_wait = getattr(config, "max_connect_wait", 10.0)
+    http_idle_timeout = getattr(config, "http_idle_timeout", 5.0)
+    # Time a request, or the data posted with it, may take to arrive, the same as the timeout of the threaded server.
+    request_timeout = 60.0
+    http_max_requests = getattr(config, "http_max_requests", 100)
+    # Maximum time a lookup waits for the session log of the previous run to be loaded.
+    restore_wait = 5.0
+    # Bytes that may be buffered towards a slow connection before send_queue_policy applies, see SendQueue.
+    send_queue_size = getattr(config, "relay_queue_size", 1024 * 1024)
+    send_queue_policy = getattr(config, "relay_queue_policy", "pause")
+    websocket_deflate = getattr(config, "websocket_deflate", True)
+    websocket_deflate_window_bits = getattr(config, "websocket_deflate_window_bits", 15)
+    websocket_deflate_context_takeover = getattr(config, "websocket_deflate_context_takeover", True)
+    websocket_max_message_size = getattr(config, "websocket_max_message_size", 16 * 1024 * 1024)
+    websocket_cut_through = getattr(config, "websocket_cut_through", True)
+    # How often the transport is checked for having written a traced message, see traceSent.
+    trace_poll_interval = 0.001
+    # Bytes that may be buffered towards a /game/watch connection, a watcher that falls further behind is disconnected.
+    lobby_watch_queue_size = getattr(config, "lobby_watch_queue_size", 1024 * 1024)
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info("peername")
+        self.command = None
+        self.path = None
+        self.request_version = None
+        self.headers = None
+        self.keep_alive = False
+        self.other = None
+        # The multiplex.Multiplexer of a multiplexed master connection.
+        self.multiplexer = None
+        self.last_activity = time.monotonic()
+        self.keepalive_timeout = self.websocket_timeout
+        self.__is_websocket = False
+        self.__is_raw = False
+        self.deflate = None
+        self.__loop = None
+        # The admission.AdmissionControl connection role that this connection has a slot for.
+        self.admission_role = None
+        # Retry-After of a request that is refused by admission control.
+        self.retry_after = None
+        # Game key under which the messages relayed by this connection are traced, see relayTrace.
+        self.trace_key = None
+
+    ## Handle requests till the connection is not kept alive anymore, the same way as main.HTTPRequestHandler.handle does.
+    async def handle(self):
+        try:
+            request_count = 0
+            while await self.__readRequest(request_count > 0):
+                request_count += 1
+                self.keep_alive = self.__wantsKeepAlive() and request_count < self.http_max_requests
+                if self.__isUpgrade("websocket"):
+                    return await self.__handleWebsocket()
+                elif self.__isUpgrade("raw"):
+                    return await self.__handleRawsocket()
+                elif self.command == "GET":
+                    await self.__doGET()
+                elif self.command == "POST":
+                    await self.__doPOST()
+                else:
+                    self.sendError(http.HTTPStatus.NOT_IMPLEMENTED)
+                await self.writer.drain()
+                if not self.keep_alive:
+                    return
+        except (IOError, asyncio.LimitOverrunError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass    # We can pretty much except an IOError at some point because the other side will close the connection, or we will get a timeout.
+        finally:
+            if self.admission_role is not None:
+                self.server.admission.leave(self.admission_role)
+            self.writer.close()
+
+    async def __readRequest(self, idle):
+        try:
+            data = await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), self.http_idle_timeout if idle else self.request_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+            return False
+        requestline, _, header_block = data.partition(b"\r\n")
+        words = requestline.decode("iso-8859-1").split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            self.sendError(http.HTTPStatus.BAD_REQUEST)
+            return False
+        self.command, self.path, self.request_version = words
+        self.headers = http.client.parse_headers(io.BytesIO(header_block))
+        return True
+
+    def __wantsKeepAlive(self):
+        connection = [token.strip().lower() for token in self.headers.get("Connection", "").split(",")]
+        if self.request_version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
+
+    def __isUpgrade(self, protocol):
+        if "Connection" not in self.headers or "Upgrade" not in self.headers:
+            return False
+        return self.headers["Connection"].lower() == "upgrade" and self.headers["Upgrade"].lower() == protocol
+
+    def sendResponse(self, code, body=b"", headers=(), content_length=None):
+        code = http.HTTPStatus(code)
+        response = ["HTTP/1.1 %d %s" % (code.value, code.phrase)]
+        for key, value in headers:
+            response.append("%s: %s" % (key, value))
+        if code != http.HTTPStatus.SWITCHING_PROTOCOLS:
+            if code != http.HTTPStatus.NOT_MODIFIED:
+                response.append("Content-Length: %d" % (len(body) if content_length is None else content_length))
+            if not self.keep_alive:
+                response.append("Connection: close")
+            elif self.request_version == "HTTP/1.0":
+                response.append("Connection: keep-alive")
+        self.writer.write(("\r\n".join(response) + "\r\n\r\n").encode("latin-1", "strict") + body)
+
+    ## Errors close the connection, as the body of the request might not have been read.
+    def sendError(self, code):
+        self.keep_alive = False
+        headers = [("Content-Type", "text/plain")]
+        if self.retry_after is not None:
+            headers.append(("Retry-After", self.retry_after))
+        self.sendResponse(code, http.HTTPStatus(code).phrase.encode("ascii"), headers)
+
+    ## Check a request with admission control, returns None when it is admitted, otherwise the status to refuse it with.
+    def __admit(self, endpoint_class):
+        refused = self.server.admission.admit(endpoint_class, self.client_address[0])
+        if refused is None:
+            return None
+        status, self.retry_after = refused
+        return status
+
+    ## Take a connection slot of admission control, which is released when the connection is closed.
+    #   Returns None when there was room, otherwise the status to refuse the upgrade with.
+    def __enterAdmission(self, role):
+        refused = self.server.admission.enter(role)
+        if refused is not None:
+            status, self.retry_after = refused
+            return status
+        self.admission_role = role
+        return None
+
+    def __leaveAdmission(self):
+        self.server.admission.leave(self.admission_role)
+        self.admission_role = None
+
+    def sendJson(self, data):
+        self.sendResponse(http.HTTPStatus.OK, json.dumps(data).encode("ascii"), [("Content-Type", "application/json")])
+
+    async def __doGET(self):
+        if self.path.startswith("/game/list/"):
+            refused = self.__admit("list")
+            if refused is not None:
+                return self.sendError(refused)
+            game_name = self.path[11:]
+            body, etag = self.server.lobby_cache.getList(game_name, self.client_address[0])
+            if lobbyCache.LobbyCache.matchesETag(self.headers.get("If-None-Match"), etag):
+                return self.sendResponse(http.HTTPStatus.NOT_MODIFIED, headers=[("ETag", etag)])
+            return self.sendResponse(http.HTTPStatus.OK, body, [("Content-Type", "application/json"), ("ETag", etag), ("Cache-Control", "no-cache")])
+        elif self.path.startswith("/game/connect/"):
+            refused = self.__admit("connect")
+            if refused is not None:
+                return self.sendError(refused)
+            game_key = urllib.parse.urlsplit(self.path).path[14:]
+            game = await self.findGame(game_key)
+            if game is None:
+                metrics.session_not_found.labels("info").inc()
+                return self.sendError(http.HTTPStatus.NOT_FOUND)
+            return self.sendJson(game.getInfoFor(self.client_address[0]))
+        elif self.path == "/metrics":
+            return self.sendResponse(http.HTTPStatus.OK, metrics.render(), [("Content-Type", metrics.content_type)])
+        elif self.path.startswith("/admin/"):
+            return await self.__sendAdmin()
+        await self.__sendStaticFile()
+
+    ## Admin requests can block for a long time, so they are handled in the executor, see adminApi.
+    async def __sendAdmin(self):
+        # The admin API never reads posted data, so the connection cannot be used for another request when there is any.
+        if self.headers.get("Content-Length", "0").strip() != "0":
+            self.keep_alive = False
+        response = await asyncio.get_running_loop().run_in_executor(None, self.server.admin_api.handle, self.command, self.path, self.headers)
+        self.sendResponse(response.status, response.body, response.headers)
+
+    async def __sendStaticFile(self):
+        static_files = self.server.static_files
+        if static_files.isCached(self.path):
+            response = static_files.serve(self.path, self.headers)
+        else:
+            response = await asyncio.get_running_loop().run_in_executor(None, static_files.serve, self.path, self.headers)
+        if response is None:
+            return self.sendError(http.HTTPStatus.NOT_FOUND)
+        if response.file is None:
+            return self.sendResponse(response.status, response.body, response.headers)
+        with response.file:
+            self.sendResponse(response.status, b"", response.headers, response.length)
+            # Uses os.sendfile when the transport supports it, after the headers are written.
+            await asyncio.get_running_loop().sendfile(self.writer.transport, response.file, 0, response.length)
+
+    ## Find a session, when it is not found before the session log is loaded, wait for that without blocking the event loop.
+    async def findGame(self, game_key):
+        game = self.server.findGame(game_key)
+        if game is None and not self.server.isRestored():
+            await asyncio.get_running_loop().run_in_executor(None, self.server.waitForRestore, self.restore_wait)
+            game = self.server.findGame(game_key)
+        return game
+
+    async def __doPOST(self):
+        if self.path == "/game/register":
+            refused = self.__admit("register")
+            if refused is not None:
+                return self.sendError(refused)
+            if "Content-Length" not in self.headers or "Content-Type" not in self.headers:
+                return self.sendError(http.HTTPStatus.BAD_REQUEST)
+            if self.headers["Content-Type"] != "application/json":
+                return self.sendError(http.HTTPStatus.BAD_REQUEST)
+            try:
+                post_data = json.loads((await asyncio.wait_for(self.reader.readexactly(int(self.headers["Content-Length"])), self.request_timeout)).decode("utf-8"))
+            except ValueError:
+                return self.sendError(http.HTTPStatus.BAD_REQUEST)
+            game = GameSession.fromRegistration(post_data, self.client_address[0], self.server.createKey())
+            if game is None:
+                return self.sendError(http.HTTPStatus.BAD_REQUEST)
+            if not self.server.addGame(game):
+                return self.sendError(http.HTTPStatus.INTERNAL_SERVER_ERROR)
+            return self.sendJson({"key": game.key, "secret": game.secret})
+        elif self.path.startswith("/admin/"):
+            return await self.__sendAdmin()
+        self.sendError(http.HTTPStatus.NOT_FOUND)
+
+    async def __handleWebOrRawConnect(self, socket_type):
+        if self.path == "/game/master":
+            if not "Game-Key" in self.headers or not "Game-Secret" in self.headers:
+                logging.warning("Master connection: No game or secret supplied")
+                return http.HTTPStatus.BAD_REQUEST
+            refused = self.__admit("master")
+            if refused is not None:
+                return refused
+            game = await self.findGame(self.headers["Game-Key"])
+            if game is None:
+                logging.warning("Master connection: Game not found")
+                metrics.session_not_found.labels("master").inc()
+                return http.HTTPStatus.NOT_FOUND
+            if game.secret != self.headers["Game-Secret"]:
+                logging.warning("Master connection: Secret mismatch")
+                return http.HTTPStatus.BAD_REQUEST
+            refused = self.__enterAdmission("master")
+            if refused is not None:
+                return refused
+            self.other = None
+            self.trace_key = game.key
+            if multiplex.isRequested(self.headers):
+                self.multiplexer = multiplex.Multiplexer(self, "websocket" if socket_type == "Web" else "raw")
+                game.setMultiplexer(self.multiplexer)
+            elif socket_type == "Web":
+                game.setWaitingWebsocket(self)
+            else:
+                game.setWaitingRawsocket(self)
+            self.server.notifyMasterWaiting(game.key)
+            return
+        elif self.path.startswith("/game/connect/"):
+            connect = parseConnectPath(self.path, self.max_connect_wait)
+            if connect is None:
+                metrics.connect_requests.labels("bad_request").inc()
+                return http.HTTPStatus.BAD_REQUEST
+            game_key, wait = connect
+            refused = self.__admit("connect")
+            if refused is not None:
+                metrics.connect_requests.labels("refused").inc()
+                return refused
+            game = await self.findGame(game_key)
+            if game is None:
+                metrics.connect_requests.labels("not_found").inc()
+                metrics.session_not_found.labels("connect").inc()
+                return http.HTTPStatus.NOT_FOUND
+            refused = self.__enterAdmission("relay")
+            if refused is not None:
+                metrics.connect_requests.labels("refused").inc()
+                return refused
+            start = time.monotonic()
+            self.other = await self.__grabMaster(game, socket_type, wait)
+            if self.other is None:
+                self.__leaveAdmission()
+                metrics.connect_requests.labels("unavailable").inc()
+                return http.HTTPStatus.SERVICE_UNAVAILABLE
+            metrics.pairing_wait_seconds.observe(time.monotonic() - start)
+            metrics.connect_requests.labels("paired").inc()
+            self.other.other = self
+            self.trace_key = game.key
+            return
+        elif self.path.startswith("/game/watch/") and socket_type == "Web":
+            refused = self.__admit("list")
+            if refused is not None:
+                return refused
+            self.other = None
+            return
+        return http.HTTPStatus.NOT_FOUND
+
+    ## Grab a waiting master connection, if there is none wait up to the given time for a master to connect.
+    #   GameSession can only block a thread while waiting, so here we wait for the server to notify us of a new master instead.
+    async def __grabMaster(self, game, socket_type, wait):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            if socket_type == "Web":
+                other = game.grabWebsocket()
+            else:
+                other = game.grabRawsocket()
+            remaining = deadline - loop.time()
+            if other is not None or remaining <= 0:
+                return other
+            future = loop.create_future()
+            waiters = self.server.master_waiters.setdefault(game.key, set())
+            waiters.add(future)
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                waiters.discard(future)
+                if not waiters and self.server.master_waiters.get(game.key) is waiters:
+                    del self.server.master_waiters[game.key]
+
+    async def __handleWebsocket(self):
+        if "Sec-Websocket-Version" not in self.headers or "Sec-Websocket-Key" not in self.headers or self.headers["Sec-Websocket-Version"] != "13":
+            return self.sendError(http.HTTPStatus.BAD_REQUEST)
+        error = await self.__handleWebOrRawConnect("Web")
+        if error is not None:
+            return self.sendError(error)
+        headers = [
+            ("Connection", "Upgrade"),
+            ("Upgrade", "websocket"),
+            ("Cache-Control", "No-Cache"),
+            ("Sec-WebSocket-Accept", websocketParse.acceptKey(self.headers["Sec-Websocket-Key"])),
+        ]
+        if "Sec-WebSocket-Protocol" in self.headers:
+            if "binary" in self.headers["Sec-WebSocket-Protocol"]:
+                headers.append(("Sec-WebSocket-Protocol", "binary"))
+            else:
+                headers.append(("Sec-WebSocket-Protocol", "chat"))
+        if self.websocket_deflate and "Sec-WebSocket-Extensions" in self.headers:
+            self.deflate = websocketDeflate.negotiate(", ".join(self.headers.get_all("Sec-WebSocket-Extensions")), self.websocket_deflate_window_bits, self.websocket_deflate_context_takeover)
+            if self.deflate is not None:
+                headers.append(("Sec-WebSocket-Extensions", self.deflate.response))
+                if self.send_queue_policy == "drop_oldest":
+                    self.deflate.setLossy()
+        self.sendResponse(http.HTTPStatus.SWITCHING_PROTOCOLS, headers=headers)
+        # The request headers are not needed anymore, and a parked master can stay for a long time.
+        self.headers = None
+
+        self.__is_websocket = True
+        self.server.keepalive_scheduler.add(self)
+        connection_metric = self.__connectionMetric("websocket")
+        connection_metric.inc()
+        if isinstance(self.other, multiplex.Channel):
+            self.other.open()
+        elif self.other is not None:
+            self.other.websocket_send(b"CLIENT_CONNECTED")
+        elif self.path.startswith("/game/watch/"):
+            self.__loop = asyncio.get_running_loop()
+            self.server.lobby_watch.subscribe(self.path[12:], self, self.client_address[0])
+        # State of the fragmented message that is being received, message_opcode is None between messages.
+        message_opcode = None
+        message_size = 0
+        compressed = False
+        fragments = []
+        forward_to = None
+        allowed_rsv = websocketParse.rsv1_mask if self.deflate is not None else 0
+        try:
+            while not self.writer.is_closing():
+                frame = await websocketParse.readFrameAsync(self.reader, allowed_rsv, self.websocket_max_message_size)
+                if frame is None:
+                    return
+                self.last_activity = time.monotonic()
+                fin, opcode, message, rsv = frame
+                if rsv and opcode != websocketParse.opcode_text and opcode != websocketParse.opcode_binary:
+                    return  # Only the first frame of a data message can be marked as compressed.
+                if opcode == websocketParse.opcode_continuation or opcode == websocketParse.opcode_text or opcode == websocketParse.opcode_binary:
+                    if (opcode == websocketParse.opcode_continuation) != (message_opcode is not None):
+                        return  # A continuation frame without a message to continue, or a new message before the last one was finished.
+                    if opcode != websocketParse.opcode_continuation:
+                        if fin:
+                            if not await self.__relayWebsocket(opcode, message, bool(rsv)):
+                                return self.__closeMessageTooBig()
+                            if relayTrace.traces:
+                                self.__traceRelay()
+                            continue
+                        message_opcode = opcode
+                        message_size = 0
+                        compressed = bool(rsv)
+                        forward_to = self.__startForwarding(compressed)
+                    message_size += len(message)
+                    if message_size > self.websocket_max_message_size:
+                        return self.__closeMessageTooBig()
+                    if forward_to is not None:
+                        # A fragment cannot be dropped, canForwardFragments makes sure the policy never does.
+                        if await forward_to.reserveSend(message, self.send_queue_policy):
+                            relayed_websocket_bytes_metric.inc(len(message))
+                            if opcode != websocketParse.opcode_continuation and compressed:
+                                forward_to.websocket_send_compressed(message, opcode, fin)
+                            else:
+                                forward_to.websocket_send_fragment(opcode, message, fin)
+                    else:
+                        fragments.append(message)
+                    if fin:
+                        if forward_to is not None:
+                            relayed_websocket_messages_metric.inc()
+                        elif not await self.__relayWebsocket(message_opcode, b"".join(fragments), compressed):
+                            return self.__closeMessageTooBig()
+                        if relayTrace.traces:
+                            self.__traceRelay()
+                        message_opcode = None
+                        fragments = []
+                        forward_to = None
+                elif opcode == websocketParse.opcode_close:
+                    websocketParse.writeFrame(self.writer, websocketParse.opcode_close, message)
+                    return
+                elif opcode == websocketParse.opcode_ping:
+                    websocketParse.writeFrame(self.writer, websocketParse.opcode_pong, message)
+                elif opcode == websocketParse.opcode_pong:
+                    pass
+                else:
+                    return
+        except zlib.error:
+            pass    # Invalid compressed data, there is nothing we can do but close the connection.
+        finally:
+            connection_metric.dec()
+            self.server.keepalive_scheduler.remove(self)
+            self.__is_websocket = False
+            if self.__loop is not None:
+                self.server.lobby_watch.unsubscribe(self.path[12:], self)
+            if self.multiplexer is not None:
+                self.multiplexer.closeAll()
+            if self.other is not None:
+                self.other.closeRelay()
+
+    ## Relay a complete received message. A compressed message is passed on as it is when the other side can take it, see
+    #   websocketDeflate.PerMessageDeflate.canPassTo, and decompressed otherwise. Returns False when it is too large once decompressed.
+    async def __relayWebsocket(self, opcode, message, compressed):
+        other = self.other
+        if compressed:
+            if other is not None and other.is_websocket() and self.deflate.canPassTo(other.deflate):
+                if await other.reserveSend(message, self.send_queue_policy):
+                    self.deflate.passedTo(other.deflate)
+                    deflate_passthrough_metric.inc()
+                    relayed_websocket_messages_metric.inc()
+                    relayed_websocket_bytes_metric.inc(len(message))
+                    other.websocket_send_compressed(message, opcode)
+                return True
+            message = self.deflate.decompress(message, self.websocket_max_message_size)
+            if message is None:
+                return False
+            deflate_decompressed_metric.inc()
+        if self.multiplexer is not None:
+            try:
+                packets = self.multiplexer.parseMessage(message)
+            except ValueError:
+                self.closeRelay()
+                return True
+            await self.__relayMultiplexed(packets, self.send_queue_policy)
+        elif other is not None and await other.reserveSend(message, self.send_queue_policy):
+            relayed_websocket_messages_metric.inc()
+            relayed_websocket_bytes_metric.inc(len(message))
+            other.websocket_send(message, opcode)
+        return True
+
+    ## Relay the messages of a multiplexed master to the clients of their channels.
+    async def __relayMultiplexed(self, packets, policy):
+        for client, opcode, payload in packets:
+            if await client.reserveSend(payload, policy):
+                if self.__is_websocket:
+                    relayed_websocket_messages_metric.inc()
+                    relayed_websocket_bytes_metric.inc(len(payload))
+                    client.websocket_send(payload, opcode)
+                else:
+                    relayed_raw_messages_metric.inc()
+                    relayed_raw_bytes_metric.inc(len(payload))
+                    client.rawsocket_send(payload)
+                if relayTrace.traces and relayTrace.isTraced(self.trace_key):
+                    client.traceSent(self.trace_key, self.last_activity)
+
+    ## Record the handoff of the message that was just relayed for a traced session, and when it is written, see relayTrace.
+    #   The messages of a multiplexed master are reported as written by __relayMultiplexed, for every client.
+    def __traceRelay(self):
+        if relayTrace.handedOff(self.trace_key, self.last_activity) and self.other is not None and self.multiplexer is None:
+            self.other.traceSent(self.trace_key, self.last_activity)
+
+    ## Find the connection that the frames of a new fragmented message can be forwarded to as they arrive, instead of collecting the whole message first.
+    #   Returns None when the message has to be collected, which is also the case for a compressed message that we need to decompress.
+    def __startForwarding(self, compressed):
+        other = self.other
+        if not self.websocket_cut_through or other is None or not other.is_websocket() or not other.canForwardFragments():
+            return None
+        if compressed:
+            if not self.deflate.canPassTo(other.deflate):
+                return None
+            self.deflate.passedTo(other.deflate)
+            deflate_passthrough_metric.inc()
+        return other
+
+    def __closeMessageTooBig(self):
+        websocketParse.writeFrame(self.writer, websocketParse.opcode_close, struct.pack(">H", websocketParse.close_message_too_big))
+
+    async def __handleRawsocket(self):
+        error = await self.__handleWebOrRawConnect("Raw")
+        if error is not None:
+            return self.sendError(error)
+        self.sendResponse(http.HTTPStatus.SWITCHING_PROTOCOLS, headers=[("Connection", "Upgrade"), ("Upgrade", "raw"), ("Cache-Control", "No-Store")])
+        self.headers = None
+
+        self.__is_raw = True
+        self.keepalive_timeout = self.rawsocket_timeout
+        self.server.keepalive_scheduler.add(self)
+        connection_metric = self.__connectionMetric("raw")
+        connection_metric.inc()
+        if isinstance(self.other, multiplex.Channel):
+            self.other.open()
+        elif self.other is not None:
+            self.other.rawsocket_send(struct.pack("!I", 0))
+        try:
+            while not self.writer.is_closing():
+                message = await self.reader.read(self.rawsocket_read_size)
+                if message == b"":
+                    return
+                self.last_activity = time.monotonic()
+                other = self.other
+                # Dropping part of a raw stream corrupts it, so drop_oldest disconnects instead.
+                policy = "disconnect" if self.send_queue_policy == "drop_oldest" else self.send_queue_policy
+                if self.multiplexer is not None:
+                    try:
+                        packets = self.multiplexer.parseStream(message)
+                    except ValueError:
+                        return
+                    await self.__relayMultiplexed(packets, policy)
+                elif other is not None and await other.reserveSend(message, policy):
+                    relayed_raw_messages_metric.inc()
+                    relayed_raw_bytes_metric.inc(len(message))
+                    other.rawsocket_send(message)
+                if relayTrace.traces:
+                    self.__traceRelay()
+        finally:
+            connection_metric.dec()
+            self.server.keepalive_scheduler.remove(self)
+            self.__is_raw = False
+            if self.multiplexer is not None:
+                self.multiplexer.closeAll()
+            if self.other is not None:
+                self.other.closeRelay()
+
+    def __connectionMetric(self, protocol):
+        if self.path.startswith("/game/watch/"):
+            return metrics.connections.labels("watcher", protocol)
+        return metrics.connections.labels("master" if self.path == "/game/master" else "client", protocol)
+
+    ## Called from the thread of the lobby watch, the message is send from the event loop.
+    def lobbyUpdate(self, message):
+        self.__loop.call_soon_threadsafe(self.__sendLobbyUpdate, message)
+
+    def __sendLobbyUpdate(self, message):
+        buffered = self.writer.transport.get_write_buffer_size()
+        if buffered > 0 and buffered + len(message) > self.lobby_watch_queue_size:
+            self.keepaliveExpired()
+        else:
+            self.websocket_send(message)
+
+    def is_websocket(self):
+        return self.__is_websocket
+
+    def is_raw(self):
+        return self.__is_raw
+
+    def websocket_send(self, message, opcode=websocketParse.opcode_text):
+        if not self.writer.is_closing():
+            rsv = 0
+            if self.deflate is not None and self.deflate.shouldCompress(message):
+                message = self.deflate.compress(message)
+                deflate_compressed_metric.inc()
+                rsv = websocketParse.rsv1_mask
+            websocketParse.writeFrame(self.writer, opcode, message, rsv)
+
+    ## Send a message, or the first frame of a fragmented message, that was compressed by the peer of another connection.
+    #   Only to be used when that connection allowed it with canPassTo.
+    def websocket_send_compressed(self, payload, opcode=websocketParse.opcode_text, fin=True):
+        if not self.writer.is_closing():
+            self.deflate.passedFrom()
+            websocketParse.writeFrame(self.writer, opcode, payload, websocketParse.rsv1_mask, fin)
+
+    ## Forward a single frame of a fragmented message unchanged. The frames of a message have to be send without any other message in between.
+    def websocket_send_fragment(self, opcode, payload, fin):
+        if not self.writer.is_closing():
+            websocketParse.writeFrame(self.writer, opcode, payload, 0, fin)
+
+    ## Forwarded fragments cannot be dropped halfway a message, and reserveSend drops messages with the drop_oldest policy.
+    def canForwardFragments(self):
+        return self.send_queue_policy != "drop_oldest"
+
+    def websocket_send_ping(self):
+        if not self.writer.is_closing():
+            websocketParse.writeFrame(self.writer, websocketParse.opcode_ping, b'')
+
+    def keepalivePing(self):
+        if self.__is_websocket and self.writer.transport.get_write_buffer_size() < self.keepalive_max_buffer:
+            self.websocket_send_ping()
+
+    def keepaliveExpired(self):
+        self.writer.transport.abort()
+
+    def rawsocket_send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(message)
+
+    ## Apply the backpressure policy before a relayed message is written to this connection.
+    #   The transport buffer takes the role of the SendQueue of the threaded server. Data that is in the transport buffer
+    #   cannot be taken back, so drop_oldest drops the new message instead. Returns False when the message should not be send.
+    async def reserveSend(self, message, policy):
+        if self.writer.transport.get_write_buffer_size() + len(message) <= self.send_queue_size:
+            return True
+        if policy == "pause":
+            await self.drain()
+            return True
+        metrics.relay_dropped_messages.inc()
+        metrics.relay_dropped_bytes.inc(len(message))
+        if policy == "disconnect":
+            self.keepaliveExpired()
+        return False
+
+    ## Report a traced message that was just handed to this connection as sent, once the transport has no buffered data left.
+    def traceSent(self, key, received):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() == 0:
+            relayTrace.sent(key, received)
+        else:
+            asyncio.get_running_loop().call_later(self.trace_poll_interval, self.traceSent, key, received)
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except IOError:
+            self.closeRelay()
+
+    def closeRelay(self):
+        self.writer.close()
+
+    def isRelayClosed(self):
+        return self.writer.is_closing()
+
+
+class AsyncServer(sessionLog.SessionLogMixin, GameRegistryMixin):
+    ping_interval = getattr(config, "websocket_ping_interval", 5.0)
+    session_log_path = getattr(config, "session_log", None)
+    # Lookups on the event loop never wait for the session log of the previous run, AsyncConnection.findGame waits in the executor instead.
+    restore_wait = 0
+    backlog = 1024
+    # The file descriptor limit is raised up to this, a hard limit can be unlimited while the kernel has a maximum of its own.
+    max_open_files = 1 << 20
+
+    def __init__(self, server_address):
+        super().__init__()
+        self.server_address = server_address
+        self.keepalive_scheduler = keepalive.KeepaliveScheduler(self.ping_interval)
+        self.lobby_cache = lobbyCache.LobbyCache(self)
+        self.lobby_watch = lobbyWatch.LobbyWatch(self)
+        self.admission = admission.AdmissionControl(getattr(config, "admission_global_rates", None), getattr(config, "admission_address_rates", None), getattr(config, "max_relays", 0), getattr(config, "max_parked_masters", 0))
+        self.static_files = staticFiles.StaticFiles(getattr(config, "static_root", "www"), getattr(config, "static_max_age", 0), getattr(config, "static_cache_size", 16 * 1024 * 1024))
+        self.admin_api = adminApi.AdminApi(self, getattr(config, "admin_token", None), getattr(config, "admin_max_profile_seconds", 60.0), getattr(config, "admin_max_trace_seconds", 3600.0))
+        self.master_waiters = {}
+
+    def serve_forever(self):
+        if resource is not None:
+            # Idle connections are cheap on the event loop, so the file descriptor limit is usually the first limit we hit.
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            limit = self.max_open_files if hard == resource.RLIM_INFINITY else min(hard, self.max_open_files)
+            if soft != resource.RLIM_INFINITY and soft < limit:
+                try:
+                    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+                except (ValueError, OSError) as e:
+                    logging.warning("Could not raise the open file limit from %d to %d: %s", soft, limit, e)
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(self.__handleConnection, self.server_address[0] or None, self.server_address[1], backlog=self.backlog, limit=AsyncConnection.max_header_size)
+        keepalive_task = asyncio.ensure_future(self.__runKeepalive())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            keepalive_task.cancel()
+
+    ## Wake up clients waiting in /game/connect/[key]?wait= for a master connection of this game.
+    def notifyMasterWaiting(self, game_key):
+        for future in self.master_waiters.get(game_key, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def __handleConnection(self, reader, writer):
+        await AsyncConnection(self, reader, writer).handle()
+
+    ## Also measures how late the event loop wakes up the keepalive, anything that blocks the loop shows up as lag on /metrics.
+    async def __runKeepalive(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.keepalive_scheduler.tick_interval)
+            metrics.event_loop_lag_seconds.observe(max(0.0, loop.time() - start - self.keepalive_scheduler.tick_interval))
+            self.keepalive_scheduler.tick()
@@ -0,0 +1,127 @@
+import os
+import sys
+import socket
+import struct
+import json
+import http.client
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import websocketParse
+
+## Minimal blocking switchboard client, in pure python, for the benchmarks.
+#   Covers the HTTP API (register, list, connect info) and both upgraded protocols, websocket and raw,
+#   for the master (/game/master) as well as the client (/game/connect/[key]) side.
+
+
+class UpgradeError(Exception):
+    def __init__(self, status_line):
+        super().__init__(status_line)
+        self.status_line = status_line
+
+
+## Do a plain HTTP request on a new connection, returns (status, headers, body).
+def request(address, method, path, body=None, headers={}):
+    connection = http.client.HTTPConnection(address[0], address[1])
+    try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+## Register a new game session, returns (key, secret).
+def register(address, game_name, name, public=True):
+    registration = {"name": name, "game_name": game_name, "game_version": 1, "secret_hash": "", "public": public, "address": ["127.0.0.1"], "port": 0}
+    status, headers, body = request(address, "POST", "/game/register", json.dumps(registration), {"Content-Type": "application/json"})
+    if status != 200:
+        raise RuntimeError("Registration failed with %d" % (status))
+    result = json.loads(body.decode("utf-8"))
+    return result["key"], result["secret"]
+
+
+def masterHeaders(key, secret):
+    return [("Game-Key", key), ("Game-Secret", secret)]
+
+
+## Send the upgrade request and read the response head, raises UpgradeError when the answer is not a 101.
+def _upgrade(address, path, protocol_headers, headers):
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    lines = ["GET %s HTTP/1.1" % (path), "Host: %s:%d" % (address[0], address[1])]
+    lines += ["%s: %s" % (key, value) for key, value in list(protocol_headers) + list(headers)]
+    sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    stream = sock.makefile("rb")
+    status_line = stream.readline()
+    while stream.readline() not in (b"\r\n", b""):
+        pass
+    if status_line.split()[1:2] != [b"101"]:
+        stream.close()
+        sock.close()
+        raise UpgradeError(status_line.decode("latin-1").strip())
+    return sock, stream
+
+
+## Shut the socket down before closing, this wakes up any thread that is blocked reading from the stream,
+#   closing the stream would otherwise wait for that read to finish.
+def _close(sock, stream):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    stream.close()
+    sock.close()
+
+
+class WebsocketClient:
+    def __init__(self, address, path, headers=()):
+        protocol_headers = [("Connection", "Upgrade"), ("Upgrade", "websocket"), ("Sec-WebSocket-Version", "13"), ("Sec-WebSocket-Key", "dGhlIHNhbXBsZSBub25jZQ==")]
+        self.socket, self.__stream = _upgrade(address, path, protocol_headers, headers)
+
+    ## Send a single masked frame, as required for frames from a client.
+    def send(self, message, opcode=websocketParse.opcode_binary):
+        length = len(message)
+        if length < websocketParse.payload_length_16bit:
+            header = struct.pack(">BB", websocketParse.fin_mask | opcode, websocketParse.mask_mask | length)
+        elif length < (1 << 16):
+            header = struct.pack(">BBH", websocketParse.fin_mask | opcode, websocketParse.mask_mask | websocketParse.payload_length_16bit, length)
+        else:
+            header = struct.pack(">BBQ", websocketParse.fin_mask | opcode, websocketParse.mask_mask | websocketParse.payload_length_64bit, length)
+        mask = os.urandom(4)
+        self.socket.sendall(header + mask + websocketParse.unmask(message, mask))
+
+    ## Receive the next data message, answering pings on the way. Returns None when the connection is closed.
+    def receive(self):
+        while True:
+            frame = websocketParse.readFrame(self.__stream)
+            if frame is None:
+                return None
+            fin, opcode, message, rsv = frame
+            if opcode == websocketParse.opcode_ping:
+                self.send(message, websocketParse.opcode_pong)
+            elif opcode == websocketParse.opcode_close:
+                return None
+            elif opcode != websocketParse.opcode_pong:
+                return message
+
+    def close(self):
+        _close(self.socket, self.__stream)
+
+
+class RawClient:
+    def __init__(self, address, path, headers=()):
+        self.socket, self.__stream = _upgrade(address, path, [("Connection", "Upgrade"), ("Upgrade", "raw")], headers)
+
+    def send(self, data):
+        self.socket.sendall(data)
+
+    ## Receive exactly size bytes, returns less when the connection is closed.
+    def receive(self, size):
+        return self.__stream.read(size)
+
+    ## Receive whatever is available, b"" when the connection is closed.
+    def receiveSome(self, size=65536):
+        return self.__stream.read1(size)
+
+    def close(self):
+        _close(self.socket, self.__stream)
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import json
+import argparse
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import client
+import switchboard
+
+## Memory footprint of the switchboard.
+#   Starts the server like benchmarks/switchboard.py does, and measures the growth of its RSS for:
+#       - sessions: N registered game sessions.
+#       - idle masters: a websocket (or raw) master connection waiting on each of those sessions.
+#       - relays: M of those masters paired with a client, after one message went trough each of them both ways.
+#   Reports the bytes per session, per idle master and per active relay, and the number of threads of the server.
+#   The RSS is only read from /proc, so this only works on linux. Every connection needs a file descriptor in both
+#   the server and this process, so the file descriptor limit is raised as far as it goes.
+#   Usage: python benchmarks/memory.py [--engine threading|asyncio] [--masters N] [--relays M] [--protocol websocket|raw] [--stack-size bytes] [--json]
+
+
+def runServer(engine, port, stack_size):
+    if stack_size:
+        import main
+        main.Server.thread_stack_size = stack_size
+    switchboard.runServer(engine, port)
+
+
+def raiseFileLimit():
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+## RSS of the server in bytes, after giving it a moment to settle.
+def serverRSS(pid, settle=0.5):
+    time.sleep(settle)
+    return switchboard.processStats(pid)["rss_kb"] * 1024
+
+
+def perItem(before, after, count):
+    if count == 0 or before is None or after is None:
+        return None
+    return (after - before) / count
+
+
+def connect(protocol, address, path, headers=()):
+    if protocol == "websocket":
+        return client.WebsocketClient(address, path, headers)
+    return client.RawClient(address, path, headers)
+
+
+def measure(address, server_pid, protocol, master_count, relay_count):
+    result = {"protocol": protocol, "masters": master_count, "relays": relay_count}
+    # Warm up, so the first request does not count as part of the first session.
+    client.register(address, "memory", "warm up", public=False)
+    start_rss = serverRSS(server_pid)
+    sessions = [client.register(address, "memory", "session %d" % (n), public=False) for n in range(master_count)]
+    sessions_rss = serverRSS(server_pid)
+    masters = [connect(protocol, address, "/game/master", client.masterHeaders(key, secret)) for key, secret in sessions]
+    masters_rss = serverRSS(server_pid)
+    masters_stats = switchboard.processStats(server_pid)
+    clients = []
+    for (key, secret), master in zip(sessions[:relay_count], masters):
+        peer = connect(protocol, address, "/game/connect/%s?wait=5" % (key))
+        clients.append(peer)
+        payload = b"x" * 64
+        if protocol == "websocket":
+            master.receive()
+            peer.send(payload)
+            master.send(master.receive())
+            peer.receive()
+        else:
+            master.receive(4)
+            peer.send(payload)
+            master.send(master.receive(len(payload)))
+            peer.receive(len(payload))
+    relays_rss = serverRSS(server_pid)
+    relays_stats = switchboard.processStats(server_pid)
+    result["bytes_per_session"] = perItem(start_rss, sessions_rss, master_count)
+    result["bytes_per_idle_master"] = perItem(sessions_rss, masters_rss, master_count)
+    # A paired master is no longer idle, so a relay costs its client plus the difference between an idle and a paired master.
+    result["bytes_per_relay"] = perItem(masters_rss, relays_rss, relay_count)
+    result["threads_with_masters"] = masters_stats["threads"]
+    result["threads_with_relays"] = relays_stats["threads"]
+    result["server_rss_kb"] = relays_rss // 1024
+    for connection in clients + masters:
+        connection.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory footprint of the switchboard")
+    parser.add_argument("--engine", choices=["threading", "asyncio"], default="threading")
+    parser.add_argument("--protocol", choices=["websocket", "raw"], default="websocket")
+    parser.add_argument("--masters", type=int, default=1000, help="Number of sessions with an idle master")
+    parser.add_argument("--relays", type=int, default=200, help="Number of those masters that get paired with a client")
+    parser.add_argument("--stack-size", type=int, default=0, help="Thread stack size of the threading engine in bytes, 0 for config.py")
+    parser.add_argument("--json", action="store_true", help="Output the results as json")
+    args = parser.parse_args()
+
+    raiseFileLimit()
+    port = switchboard.freePort()
+    server = multiprocessing.Process(target=runServer, args=(args.engine, port, args.stack_size), daemon=True)
+    server.start()
+    address = ("127.0.0.1", port)
+    try:
+        switchboard.waitForServer(address)
+        result = {"commit": switchboard.gitCommit(), "engine": args.engine, "python": sys.version.split()[0]}
+        result.update(measure(address, server.pid, args.protocol, args.masters, min(args.relays, args.masters)))
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print("%-24s %12s" % (key, "-" if value is None else ("%.0f" % (value) if isinstance(value, float) else value)))
+
+
+if __name__ == "__main__":
+    main()
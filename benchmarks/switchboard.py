@@ -0,0 +1,301 @@
+import os
+import sys
+import time
+import json
+import socket
+import threading
+import subprocess
+import collections
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import client
+
+## Load generator and benchmark for the whole switchboard.
+#   Starts the server (main.Server, or asyncServer.AsyncServer with --engine asyncio) in its own process on localhost, and drives these scenarios:
+#       - register: N servers registering a game session.
+#       - lobby: M clients polling /game/list/[game_name] as fast as they can.
+#       - websocket/raw: K paired relays, where the client side keeps --window messages of --size bytes in flight trough the switchboard
+#         and the master side echoes them back. Relay latency is the round trip, so trough the switchboard twice.
+#   Reports throughput, p50/p99 latencies, pairing latency and the RSS and thread count of the server process.
+#   Results can be written as json with --output, and compared to an earlier run with --compare.
+#   Needs a config.py, like main.py itself.
+#   Usage: python benchmarks/switchboard.py [--engine threading|asyncio] [--servers N] [--lobby-clients M] [--relays K] [--json] [--output file] [--compare file]
+
+
+def runServer(engine, port):
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    sys.path.insert(0, os.getcwd())
+    # Request logging stays on, as it is part of the cost of a request, but it does not need to end up in the benchmark output.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    if engine == "asyncio":
+        import asyncServer
+        server = asyncServer.AsyncServer(("127.0.0.1", port))
+    else:
+        import main
+        server = main.Server(("127.0.0.1", port), main.HTTPRequestHandler)
+    # All load comes from a single address, so the limits of config.py would only measure admission control itself.
+    import admission
+    server.admission = admission.AdmissionControl()
+    server.serve_forever()
+
+
+def freePort():
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def waitForServer(address, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(address).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not start")
+
+
+## RSS in KB and the number of threads of a process, from /proc so only on linux.
+def processStats(pid):
+    result = {"rss_kb": None, "threads": None}
+    try:
+        with open("/proc/%d/status" % (pid), "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    result["rss_kb"] = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    result["threads"] = int(line.split()[1])
+    except IOError:
+        pass
+    return result
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p99": None}
+    values = sorted(values)
+    return {"p50": values[len(values) // 2] * 1000.0, "p99": values[min(len(values) - 1, int(len(values) * 0.99))] * 1000.0}
+
+
+def runThreads(count, target):
+    threads = [threading.Thread(target=target, args=(n,), daemon=True) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def benchmarkRegister(address, count):
+    latencies = []
+    errors = [0]
+    start = time.perf_counter()
+    def register(n):
+        t = time.perf_counter()
+        try:
+            client.register(address, "benchmark", "server %d" % (n))
+        except (OSError, RuntimeError):
+            errors[0] += 1
+            return
+        latencies.append(time.perf_counter() - t)
+    runThreads(count, register)
+    duration = time.perf_counter() - start
+    result = {"registrations": len(latencies), "errors": errors[0], "per_second": len(latencies) / duration}
+    result.update(("latency_%s_ms" % (key), value) for key, value in percentiles(latencies).items())
+    return result
+
+
+def benchmarkLobby(address, count, duration):
+    latencies = []
+    not_modified = [0]
+    errors = [0]
+    end = time.perf_counter() + duration
+    def poll(n):
+        etag = None
+        while time.perf_counter() < end:
+            t = time.perf_counter()
+            try:
+                status, headers, body = client.request(address, "GET", "/game/list/benchmark", headers={"If-None-Match": etag} if etag else {})
+            except OSError:
+                errors[0] += 1
+                continue
+            latencies.append(time.perf_counter() - t)
+            if status == 304:
+                not_modified[0] += 1
+            etag = headers.get("ETag")
+    runThreads(count, poll)
+    result = {"clients": count, "requests": len(latencies), "errors": errors[0], "per_second": len(latencies) / duration, "not_modified": not_modified[0]}
+    result.update(("latency_%s_ms" % (key), value) for key, value in percentiles(latencies).items())
+    return result
+
+
+class Relay:
+    def __init__(self, address, protocol, key, secret, size, window):
+        self.protocol = protocol
+        self.size = size
+        self.window = window
+        self.latencies = []
+        self.messages = 0
+        headers = client.masterHeaders(key, secret)
+        if protocol == "websocket":
+            self.master = client.WebsocketClient(address, "/game/master", headers)
+        else:
+            self.master = client.RawClient(address, "/game/master", headers)
+        self.__address = address
+        self.__key = key
+
+    def pair(self):
+        start = time.perf_counter()
+        path = "/game/connect/%s?wait=5" % (self.__key)
+        if self.protocol == "websocket":
+            self.client = client.WebsocketClient(self.__address, path)
+            if self.master.receive() != b"CLIENT_CONNECTED":
+                raise RuntimeError("Master did not get CLIENT_CONNECTED")
+        else:
+            self.client = client.RawClient(self.__address, path)
+            if self.master.receive(4) != b"\0\0\0\0":
+                raise RuntimeError("Master did not get the raw connect marker")
+        return time.perf_counter() - start
+
+    def echo(self):
+        try:
+            while True:
+                if self.protocol == "websocket":
+                    message = self.master.receive()
+                    if message is None:
+                        return
+                    self.master.send(message)
+                else:
+                    data = self.master.receiveSome()
+                    if data == b"":
+                        return
+                    self.master.send(data)
+        except (OSError, ValueError):
+            pass    # The connection was closed by run()
+
+    def run(self, end):
+        payload = os.urandom(self.size)
+        send_times = collections.deque()
+        try:
+            for n in range(self.window):
+                send_times.append(time.perf_counter())
+                self.client.send(payload)
+            while send_times:
+                if self.protocol == "websocket":
+                    received = self.client.receive()
+                    if received is None:
+                        return
+                else:
+                    received = self.client.receive(self.size)
+                    if len(received) != self.size:
+                        return
+                now = time.perf_counter()
+                self.latencies.append(now - send_times.popleft())
+                self.messages += 1
+                if now < end:
+                    send_times.append(now)
+                    self.client.send(payload)
+        finally:
+            self.client.close()
+            self.master.close()
+
+
+def benchmarkRelay(address, server_pid, protocol, count, size, window, duration):
+    relays = []
+    for n in range(count):
+        key, secret = client.register(address, "benchmark-relay", "relay %d" % (n), public=False)
+        relays.append(Relay(address, protocol, key, secret, size, window))
+    pairing = [relay.pair() for relay in relays]
+    for relay in relays:
+        threading.Thread(target=relay.echo, daemon=True).start()
+    end = time.perf_counter() + duration
+    threads = [threading.Thread(target=relay.run, args=(end,), daemon=True) for relay in relays]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration / 2)
+    server_stats = processStats(server_pid)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    messages = sum(relay.messages for relay in relays)
+    result = {"relays": count, "size": size, "window": window, "messages": messages, "messages_per_second": messages / elapsed,
+        # Every message goes trough the switchboard twice, once to the master and once back.
+        "mb_per_second": messages * size * 2 / elapsed / (1024 * 1024)}
+    result.update(("latency_%s_ms" % (key), value) for key, value in percentiles([latency for relay in relays for latency in relay.latencies]).items())
+    result.update(("pairing_%s_ms" % (key), value) for key, value in percentiles(pairing).items())
+    result["server_rss_kb"] = server_stats["rss_kb"]
+    result["server_threads"] = server_stats["threads"]
+    return result
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def printResults(results, previous=None):
+    print("commit %s, engine %s" % (results["commit"], results["engine"]))
+    for name, values in results["scenarios"].items():
+        print("%s:" % (name))
+        for key, value in values.items():
+            line = "  %-22s %12s" % (key, "-" if value is None else ("%.3f" % (value) if isinstance(value, float) else value))
+            old = previous["scenarios"].get(name, {}).get(key) if previous is not None else None
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old != 0:
+                line += "   %+.1f%% (was %s)" % ((value - old) * 100.0 / old, "%.3f" % (old) if isinstance(old, float) else old)
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the switchboard")
+    parser.add_argument("--engine", choices=["threading", "asyncio"], default="threading")
+    parser.add_argument("--servers", type=int, default=100, help="Number of registering servers")
+    parser.add_argument("--lobby-clients", type=int, default=10, help="Number of clients polling the game list")
+    parser.add_argument("--relays", type=int, default=10, help="Number of paired relays per protocol")
+    parser.add_argument("--size", type=int, default=1024, help="Size of the relayed messages in bytes")
+    parser.add_argument("--window", type=int, default=4, help="Number of messages every relay keeps in flight")
+    parser.add_argument("--duration", type=float, default=3.0, help="Duration of the lobby and relay scenarios in seconds")
+    parser.add_argument("--json", action="store_true", help="Output the results as json")
+    parser.add_argument("--output", help="Also write the json results to this file")
+    parser.add_argument("--compare", help="Json results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    port = freePort()
+    server = multiprocessing.Process(target=runServer, args=(args.engine, port), daemon=True)
+    server.start()
+    address = ("127.0.0.1", port)
+    try:
+        waitForServer(address)
+        results = {"commit": gitCommit(), "engine": args.engine, "python": sys.version.split()[0], "scenarios": collections.OrderedDict()}
+        results["scenarios"]["idle"] = processStats(server.pid)
+        results["scenarios"]["register"] = benchmarkRegister(address, args.servers)
+        results["scenarios"]["lobby"] = benchmarkLobby(address, args.lobby_clients, args.duration)
+        for protocol in ("websocket", "raw"):
+            results["scenarios"][protocol] = benchmarkRelay(address, server.pid, protocol, args.relays, args.size, args.window, args.duration)
+        results["scenarios"]["end"] = processStats(server.pid)
+    finally:
+        server.terminate()
+        server.join()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        previous = None
+        if args.compare:
+            with open(args.compare, "r") as f:
+                previous = json.load(f)
+        printResults(results, previous)
+
+
+if __name__ == "__main__":
+    main()
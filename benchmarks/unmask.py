@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import websocketParse
+
+## Benchmark for the websocket payload unmasking implementations in websocketParse.
+#   Reports the throughput in MB/s of every available implementation for payload sizes from 16 bytes to 1MB.
+#   Usage: python benchmarks/unmask.py [--json] [--duration seconds]
+
+SIZES = [16, 64, 256, 1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024]
+
+
+def implementations():
+    result = [("python", websocketParse.unmaskPython), ("int", websocketParse.unmaskInt)]
+    if websocketParse.numpy is not None:
+        result.append(("numpy", websocketParse.unmaskNumpy))
+    result.append(("unmask", websocketParse.unmask))
+    return result
+
+
+def measure(function, payload, mask, duration):
+    iterations = 0
+    start = time.perf_counter()
+    end = start + duration
+    now = start
+    while now < end:
+        for n in range(10):
+            function(payload, mask)
+        iterations += 10
+        now = time.perf_counter()
+    return len(payload) * iterations / (now - start) / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark websocket unmasking")
+    parser.add_argument("--json", action="store_true", help="Output the results as json")
+    parser.add_argument("--duration", type=float, default=0.2, help="Time spend per measurement in seconds")
+    args = parser.parse_args()
+
+    mask = os.urandom(4)
+    results = []
+    for size in SIZES:
+        payload = os.urandom(size)
+        expected = websocketParse.unmaskPython(payload, mask)
+        for name, function in implementations():
+            if function(payload, mask) != expected:
+                raise RuntimeError("%s gives a wrong result for a payload of %d bytes" % (name, size))
+            if name == "python" and size > 64 * 1024:
+                continue    # Takes too long to be useful, and we already know it is slow.
+            results.append({"implementation": name, "size": size, "mb_per_second": measure(function, payload, mask, args.duration)})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    names = [name for name, function in implementations()]
+    print("%10s" % ("size") + "".join("%12s" % (name) for name in names) + "   (MB/s)")
+    for size in SIZES:
+        line = "%10d" % (size)
+        for name in names:
+            values = [result["mb_per_second"] for result in results if result["implementation"] == name and result["size"] == size]
+            line += "%12.1f" % (values[0]) if values else "%12s" % ("-")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import threading
+import collections
+
+import metrics
+
+## Pool of reusable receive buffers, shared by all connections of a process.
+#   Connections receive into pooled bytearrays with recv_into/readinto and pass memoryviews of them on to the send path of their
+#   peer without copying. The send path may hold on to such a view for a while (in a send queue or a frame batch), so a buffer
+#   can only be reused once no view of it exists anymore. A bytearray cannot be resized while it is exported, which is used
+#   to check that, so nobody has to give buffers back explicitly: a buffer that is released while it is still in flight simply
+#   stays in the pool until the last view of it is gone.
+#   Buffers come in power of two size classes from min_size to max_size, larger requests get an unpooled buffer.
+#   At most max_free_bytes of unused buffers are kept, the rest is left to the garbage collector.
+
+
+def isExported(buffer):
+    try:
+        buffer.append(0)
+    except BufferError:
+        return True
+    buffer.pop()
+    return False
+
+
+class BufferPool:
+    # Number of in flight buffers that acquire skips before it allocates a new buffer.
+    max_scan = 4
+
+    def __init__(self, min_size=4096, max_size=1024 * 1024, max_free_bytes=16 * 1024 * 1024):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_free_bytes = max_free_bytes
+        self.__lock = threading.Lock()
+        self.__free = collections.defaultdict(collections.deque)
+        # Statistics
+        self.in_use_bytes = 0
+        self.free_bytes = 0
+        self.allocations = 0
+
+    def sizeClass(self, size):
+        return max(self.min_size, 1 << max(size - 1, 0).bit_length())
+
+    ## Get a buffer of at least size bytes.
+    def acquire(self, size):
+        size_class = self.sizeClass(size)
+        if size_class > self.max_size:
+            return bytearray(size)
+        with self.__lock:
+            free = self.__free.get(size_class)
+            if free:
+                for n in range(min(len(free), self.max_scan)):
+                    buffer = free.popleft()
+                    if not isExported(buffer):
+                        self.free_bytes -= size_class
+                        self.in_use_bytes += size_class
+                        return buffer
+                    free.append(buffer)
+            self.in_use_bytes += size_class
+            self.allocations += 1
+        return bytearray(size_class)
+
+    ## Give a buffer back to the pool, views of it may still be in use by the send path.
+    def release(self, buffer):
+        size_class = len(buffer)
+        if size_class > self.max_size or size_class != self.sizeClass(size_class):
+            return
+        with self.__lock:
+            self.in_use_bytes -= size_class
+            if self.free_bytes + size_class > self.max_free_bytes:
+                return
+            self.free_bytes += size_class
+            self.__free[size_class].append(buffer)
+
+    ## Bytes of the free buffers that are still referenced by the send path of a connection.
+    def inFlightBytes(self):
+        with self.__lock:
+            return sum(len(buffer) for free in self.__free.values() for buffer in free if isExported(buffer))
+
+
+## Receive buffer of a single connection.
+#   get(size) returns a memoryview of size bytes to receive into. The buffer is reused as long as the data of the last receive is no
+#   longer referenced, otherwise it goes back to the pool and another one is taken.
+#   receive_size adapts to the sizes given to observe: it grows when a receive fills the whole buffer (for streams without message
+#   boundaries, like raw sockets) or a larger message is seen, and shrinks when receives stay well below it. The buffer is not
+#   given back for smaller receives as long as it is not larger than receive_size.
+class ReceiveBuffer:
+    # Weight of a new receive in the running average of the received sizes.
+    average_weight = 0.125
+
+    def __init__(self, pool, initial_size=4096):
+        self.__pool = pool
+        self.__buffer = None
+        self.receive_size = pool.sizeClass(initial_size)
+        self.__average = float(self.receive_size)
+
+    def get(self, size):
+        buffer = self.__buffer
+        if buffer is None or not size <= len(buffer) <= max(size * 2, self.receive_size) or isExported(buffer):
+            if buffer is not None:
+                self.__pool.release(buffer)
+            buffer = self.__buffer = self.__pool.acquire(size)
+        return memoryview(buffer)[:size]
+
+    ## Record the size of a receive into a buffer of receive_size bytes, or of a received message.
+    def observe(self, count):
+        self.__average += (count - self.__average) * self.average_weight
+        if count >= self.receive_size and self.receive_size < self.__pool.max_size:
+            self.receive_size = min(self.__pool.max_size, max(self.receive_size * 2, self.__pool.sizeClass(count)))
+        elif self.__average < self.receive_size / 4 and self.receive_size > self.__pool.min_size:
+            self.receive_size //= 2
+
+    def close(self):
+        if self.__buffer is not None:
+            self.__pool.release(self.__buffer)
+            self.__buffer = None
+
+
+# Pool of the receive buffers of this process.
+pool = BufferPool()
+
+metrics.buffer_pool_bytes.setCallback(lambda: {("in_use",): pool.in_use_bytes, ("free",): pool.free_bytes, ("in_flight",): pool.inFlightBytes()})
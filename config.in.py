@@ -1,2 +1,74 @@
 server_shared_secret = b"?"
 server_port = 8080
+# "threading" handles every connection in its own thread, "asyncio" handles all connections on a single event loop.
+server_engine = "threading"
+# How paired raw sockets relay data: "splice" keeps the data inside the kernel (linux only, otherwise "copy"),
+#   "copy" uses a reused buffer per connection and "message" passes every chunk trough the request handler.
+raw_relay_mode = "splice"
+# Maximum number of /game/master connections that can wait for a client per game session, the oldest is closed when more connect.
+max_waiting_masters = 8
+# Maximum time in seconds a client can wait for a master connection with /game/connect/[key]?wait=[seconds]
+max_connect_wait = 10.0
+# Websockets that did not receive anything for ping_interval seconds are pinged,
+#   and closed when nothing (not even a pong) is received for idle_timeout seconds.
+websocket_ping_interval = 5.0
+websocket_idle_timeout = 20.0
+# Collect small websocket frames for at most this many seconds and write them with a single syscall, 0 to write every frame directly.
+websocket_batch_latency = 0.0
+# Size in bytes of the outbound queue of every relayed connection, which is written by its own thread. 0 to write from the reading thread.
+relay_queue_size = 1024 * 1024
+# What to do when the queue of a connection is full: "pause" reading from its peer, "drop_oldest" messages (websocket only) or "disconnect".
+relay_queue_policy = "pause"
+# Number of processes for the "threading" engine. With more than 1, worker processes share server_port with SO_REUSEPORT (linux only)
+#   and connections for a game session are passed to the worker that owns the session.
+server_workers = 1
+# Use permessage-deflate compression on websockets when the browser offers it. Compressed messages are relayed without
+#   decompressing them when both sides of a relay negotiated compatible settings.
+websocket_deflate = True
+# Largest deflate window (9-15) in bits, every compressing websocket uses 2^(bits+2) bytes plus 128KB for its compressor
+#   and 2^bits for its decompressor. Without context takeover nothing is kept between messages, which saves that memory
+#   for idle websockets, but compresses worse.
+websocket_deflate_window_bits = 15
+websocket_deflate_context_takeover = True
+# Websocket messages larger than this many bytes (after decompressing) are refused by closing the connection.
+websocket_max_message_size = 16 * 1024 * 1024
+# Forward each frame of a fragmented websocket message to the other side as it arrives, instead of collecting the whole message first.
+websocket_cut_through = True
+# Bytes of unused receive buffers that are kept for reuse. The receive buffers of all connections come from a shared pool,
+#   its size is shown on /metrics as switchboard_buffer_pool_bytes.
+buffer_pool_max_free = 16 * 1024 * 1024
+# File in which all game sessions are logged, so they survive a restart of the switchboard with the same key and secret.
+#   Sessions of the previous run are restored in the background at startup. None to keep sessions in memory only.
+session_log = None
+# Directory with the static files of the browser lobby, served for every path that is not an API endpoint.
+#   Files up to 256KB are kept in memory (static_cache_size bytes in total), a precompressed [file].gz is served to browsers that accept gzip.
+#   Browsers revalidate with an ETag when max_age is 0, otherwise they cache files for max_age seconds.
+static_root = "www"
+static_max_age = 0
+static_cache_size = 16 * 1024 * 1024
+# API requests are served with HTTP/1.1 keep-alive. A connection is closed after http_idle_timeout seconds without a new request,
+#   or after http_max_requests requests.
+http_idle_timeout = 5.0
+http_max_requests = 100
+# Bytes that may be queued towards a /game/watch websocket, a lobby watcher that falls further behind is disconnected.
+lobby_watch_queue_size = 1024 * 1024
+# Admission control, as (requests per second, burst) per endpoint class: "register", "list" (also /game/watch), "connect" and "master".
+#   Requests over the limit of all clients together get a 503, over the limit of their client address a 429, both with Retry-After.
+#   Endpoint classes that are not listed are not limited. With server_workers, these are the limits of every worker.
+admission_global_rates = {"register": (100, 200), "list": (2000, 4000), "connect": (500, 1000), "master": (500, 1000)}
+# Limits per client address are off by default: all players behind a shared NAT (a LAN party, a campus or carrier grade NAT)
+#   share one address and would be throttled together. Only set them when that is acceptable, with room for a whole NAT, for example:
+#   {"register": (5, 50), "list": (50, 200), "connect": (50, 200), "master": (50, 200)}
+admission_address_rates = {}
+# Maximum number of relays (paired client connections), and of master connections that wait for a client. 0 for no limit.
+max_relays = 0
+max_parked_masters = 0
+# Stack size in bytes of the threads of the "threading" engine, which has a thread for every parked master and for both sides of a relay.
+#   0 for the default of the platform (usually 8MB of address space), at least 256KB otherwise.
+thread_stack_size = 0
+# Token of the admin API on /admin/ (thread stacks, sampling profiles and relay latency traces, see adminApi), to be send as
+#   "Authorization: Bearer [token]". None disables the admin API.
+admin_token = None
+# Longest sampling profile and relay trace that can be requested from the admin API, in seconds.
+admin_max_profile_seconds = 60.0
+admin_max_trace_seconds = 3600.0
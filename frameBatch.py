@@ -0,0 +1,77 @@
+import threading
+import time
+import heapq
+import itertools
+import select
+
+import websocketParse
+
+
+## Check if a socket has room in its send buffer, without blocking.
+def isWritable(sock):
+    if hasattr(select, "poll"):
+        poll = select.poll()
+        poll.register(sock, select.POLLOUT)
+        return len(poll.poll(0)) > 0
+    return len(select.select([], [sock], [], 0)[1]) > 0
+
+
+## Collects frames for a single connection, so they can be written to the socket with a single sendmsg call.
+#   Needs to be protected by the lock of the connection that owns it.
+class FrameBatch:
+    def __init__(self, sock):
+        self.__socket = sock
+        self.__buffers = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.__buffers)
+
+    def add(self, header, message):
+        self.__buffers.append(header)
+        self.__buffers.append(message)
+        self.size += len(header) + len(message)
+
+    ## Send all collected frames, blocking till everything is send.
+    def flush(self):
+        websocketParse.sendBuffers(self.__socket, self.__buffers)
+        self.__buffers = []
+        self.size = 0
+
+    ## Send as much as the socket accepts without blocking, returns True when everything was send.
+    def flushNonBlocking(self):
+        if not self.__buffers:
+            return True
+        if not isWritable(self.__socket):
+            return False
+        count = self.__socket.sendmsg(self.__buffers[:websocketParse.max_send_buffers])
+        self.size -= count
+        websocketParse.consumeBuffers(self.__buffers, count)
+        return not self.__buffers
+
+
+## Single thread that calls the flush callbacks of connections when the latency budget of their batch has passed.
+#   The callbacks run on this thread for all connections, so they should never block.
+class BatchFlusher:
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__queue = []
+        self.__counter = itertools.count()
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def schedule(self, delay, callback):
+        with self.__condition:
+            heapq.heappush(self.__queue, (time.monotonic() + delay, next(self.__counter), callback))
+            if self.__queue[0][2] is callback:
+                self.__condition.notify()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__queue or self.__queue[0][0] > time.monotonic():
+                    self.__condition.wait(self.__queue[0][0] - time.monotonic() if self.__queue else None)
+                deadline, count, callback = heapq.heappop(self.__queue)
+            try:
+                callback()
+            except IOError:
+                pass    # The connection is broken, its own reader will notice that and clean up.
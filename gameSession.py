@@ -0,0 +1,421 @@
+import threading
+import time
+import random
+import heapq
+import itertools
+import math
+import collections
+import urllib.parse
+import sys
+
+import config
+import metrics
+
+# pythons secrets library is introduced in 3.7, so use the system random instead (which is what secrets also uses)
+secrets = random.SystemRandom()
+
+
+## A game session as registered trough /game/register.
+#   The waiting websocket/rawsocket can be any connection object that implements closeRelay() and isRelayClosed(),
+#   so the same session can be used by the threaded and the asyncio server engines.
+#   A server can keep multiple master connections waiting, so a burst of clients does not have to wait for the server to reconnect
+#   after every handoff. When more than max_waiting_sockets are waiting, the oldest one is closed.
+#   A multiplexed master (see multiplex) serves any number of clients over a single connection. While it is connected, clients
+#   get a channel on it when no master connection of their own is waiting.
+#   A switchboard can hold a lot of sessions, so they have no instance dict, and the game_name and public address are shared between sessions.
+class GameSession:
+    __slots__ = ("__lock", "__available", "__name", "__game_name", "__version", "__public", "__public_address", "__private_address",
+        "__port", "__key", "__secret", "__waiting_websockets", "__waiting_rawsockets", "__multiplexers", "__timeout")
+    KEY_LENGTH = 5
+    SECRET_LENGTH = 32
+    KEY_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    max_waiting_sockets = getattr(config, "max_waiting_masters", 8)
+    # Limits of what can be registered, a session has to fit in a single message between worker processes (see workerPool).
+    max_name_length = 256
+    max_addresses = 16
+    max_address_length = 64
+    def __init__(self, name, game_name, version, public, public_address, private_address, port, key=None, secret=None):
+        self.__lock = metrics.TimedLock("session")
+        # Clients waiting for a master of either protocol, which are all woken up when a master becomes available.
+        self.__available = threading.Condition(self.__lock)
+        self.__name = name
+        self.__game_name = sys.intern(game_name)
+        self.__version = version
+        self.__public = public
+        self.__public_address = sys.intern(public_address)
+        self.__private_address = private_address
+        self.__port = port
+        self.__key = key if key is not None else self.generateKey()
+        self.__secret = secret if secret is not None else "".join(secrets.choices(self.KEY_CHARS, k=self.SECRET_LENGTH))
+        self.__waiting_websockets = collections.deque()
+        self.__waiting_rawsockets = collections.deque()
+        self.__multiplexers = {"websocket": None, "raw": None}
+        self.__timeout = time.monotonic() + 60.0
+
+    @classmethod
+    def generateKey(cls):
+        return "".join(secrets.choices(cls.KEY_CHARS, k=cls.KEY_LENGTH))
+
+    ## Create a new session from the json data posted to /game/register.
+    #   Returns None if the data is not a valid registration.
+    @classmethod
+    def fromRegistration(cls, post_data, public_address, key=None):
+        if not isinstance(post_data, dict):
+            return None
+        if "name" not in post_data or "game_name" not in post_data or "game_version" not in post_data or "secret_hash" not in post_data:
+            return None
+        if  "public" not in post_data or "address" not in post_data or "port" not in post_data:
+            return None
+        if not isinstance(post_data["name"], str) or not isinstance(post_data["game_name"], str):
+            return None
+        if len(post_data["name"]) > cls.max_name_length or len(post_data["game_name"]) > cls.max_name_length:
+            return None
+        if not isinstance(post_data["address"], list) or len(post_data["address"]) > cls.max_addresses:
+            return None
+        for address in post_data["address"]:
+            if not isinstance(address, str) or len(address) > cls.max_address_length:
+                return None
+        # TODO: Check secret hash
+        try:
+            return cls(
+                name = post_data["name"],
+                game_name = post_data["game_name"],
+                version = int(post_data["game_version"]),
+                public = bool(post_data["public"]),
+                public_address = public_address,
+                private_address = post_data["address"],
+                port = int(post_data["port"]),
+                key = key
+            )
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+    ## Get everything needed to recreate this session in another process with fromRecord, as json compatible dict.
+    def toRecord(self):
+        return {
+            "name": self.__name,
+            "game_name": self.__game_name,
+            "version": self.__version,
+            "public": self.__public,
+            "public_address": self.__public_address,
+            "private_address": self.__private_address,
+            "port": self.__port,
+            "key": self.__key,
+            "secret": self.__secret,
+        }
+
+    ## Recreate a session from toRecord.
+    #   A replica stands in for a session that lives in another process. It never times out by itself,
+    #   it is removed from the registry when the process that owns the session reports that the session is gone.
+    @classmethod
+    def fromRecord(cls, record, replica=False):
+        session = cls(**record)
+        if replica:
+            session.__timeout = math.inf
+        return session
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def version(self):
+        return self.__version
+
+    @property
+    def game_name(self):
+        return self.__game_name
+
+    @property
+    def public(self):
+        return self.__public
+
+    @property
+    def public_address(self):
+        return self.__public_address
+
+    def getAddressesFor(self, remote_address):
+        if self.__port == 0:
+            return []
+        if remote_address == self.__public_address:
+            return self.__private_address + [self.__public_address]
+        return [self.__public_address]
+
+    ## Get the information about this session as it is reported to clients by /game/list and /game/connect
+    def getInfoFor(self, remote_address):
+        return {
+            "name": self.__name,
+            "version": self.__version,
+            "key": self.__key,
+            "address": self.getAddressesFor(remote_address),
+            "port": self.__port
+        }
+
+    ## Monotonic time at which this session times out when no master connection is waiting.
+    @property
+    def timeout(self):
+        return self.__timeout
+
+    @property
+    def port(self):
+        return self.__port
+
+    @property
+    def key(self):
+        return self.__key
+
+    @property
+    def secret(self):
+        return self.__secret
+
+    ## Take a waiting master websocket out of the pool, or None if there is none.
+    #   With a timeout this blocks the calling thread for at most timeout seconds till a master connects.
+    #   This can also be a multiplex.Channel on a multiplexed master.
+    def grabWebsocket(self, timeout=0.0):
+        return self.__grabSocket(self.__waiting_websockets, timeout, "websocket")
+
+    def setWaitingWebsocket(self, socket):
+        self.__setWaitingSocket(self.__waiting_websockets, socket)
+
+    def grabRawsocket(self, timeout=0.0):
+        return self.__grabSocket(self.__waiting_rawsockets, timeout, "raw")
+
+    def setWaitingRawsocket(self, socket):
+        self.__setWaitingSocket(self.__waiting_rawsockets, socket)
+
+    ## Make a multiplex.Multiplexer the multiplexed master of this session for its protocol, replacing an earlier one.
+    #   Clients of the earlier one keep their channels till that master connection is closed.
+    def setMultiplexer(self, multiplexer):
+        self.__timeout = time.monotonic() + 60.0
+        with self.__lock:
+            self.__multiplexers[multiplexer.protocol] = multiplexer
+            self.__available.notify_all()
+
+    def __grabSocket(self, waiting, timeout, protocol):
+        deadline = time.monotonic() + timeout
+        with self.__lock:
+            while True:
+                while waiting:
+                    socket = waiting.popleft()
+                    if not socket.isRelayClosed():
+                        return socket
+                multiplexer = self.__multiplexers[protocol]
+                if multiplexer is not None and not multiplexer.isRelayClosed():
+                    return multiplexer.newChannel()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.__available.wait(remaining)
+
+    def __setWaitingSocket(self, waiting, socket):
+        self.__timeout = time.monotonic() + 60.0
+        with self.__lock:
+            waiting.append(socket)
+            while len(waiting) > self.max_waiting_sockets:
+                waiting.popleft().closeRelay()
+            self.__available.notify_all()
+
+    ## Number of waiting master connections, as (websockets, rawsockets). Can include connections that were closed since they started waiting.
+    def getWaitingCount(self):
+        return len(self.__waiting_websockets), len(self.__waiting_rawsockets)
+
+    def hasTimeout(self):
+        with self.__lock:
+            for multiplexer in self.__multiplexers.values():
+                if multiplexer is not None and not multiplexer.isRelayClosed():
+                    self.__timeout = time.monotonic() + 60.0
+                    return False
+            for waiting in (self.__waiting_websockets, self.__waiting_rawsockets):
+                while waiting and waiting[0].isRelayClosed():
+                    waiting.popleft()
+                if any(not socket.isRelayClosed() for socket in waiting):
+                    self.__timeout = time.monotonic() + 60.0
+                    return False
+        return time.monotonic() > self.__timeout
+
+
+## Split a /game/connect/[key]?wait=[seconds] path into the key and the time to wait for a master connection.
+#   The wait time is limited to max_wait, returns None when the wait time is not a number.
+def parseConnectPath(path, max_wait):
+    url = urllib.parse.urlsplit(path)
+    query = urllib.parse.parse_qs(url.query)
+    try:
+        wait = float(query["wait"][0]) if "wait" in query else 0.0
+    except ValueError:
+        return None
+    return url.path[14:], min(max(wait, 0.0), max_wait)
+
+
+## Keeps track of all registered game sessions, shared by the threaded and asyncio server engines.
+#   Sessions are indexed by key and, for public sessions, by game_name. Expiry is tracked in a min-heap of
+#   (timeout, key) which is swept by a background thread, so requests never have to walk all sessions.
+#   A session that is found to be timed out on lookup is removed right away, so lookups never return expired sessions.
+#   Every change to the public sessions of a game_name gives that game_name a new lobby version, which is used to cache /game/list responses,
+#   and is passed to the lobby listeners, which push it to /game/watch connections.
+class GameRegistryMixin:
+    sweep_interval = 1.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__lock = metrics.TimedLock("registry")
+        self.game_sessions = {}
+        self.__public_sessions = {}
+        self.__expiry = []
+        self.__lobby_versions = {}
+        self.__lobby_origins = {}
+        self.__version_counter = itertools.count(1)
+        self.__lobby_listeners = []
+        metrics.sessions.setCallback(self.getSessionCounts)
+        metrics.waiting_masters.setCallback(self.getWaitingCounts)
+        threading.Thread(target=self.__sweepSessions, daemon=True).start()
+
+    def addGame(self, game):
+        with self.__lock:
+            if game.key in self.game_sessions:
+                return False
+            self.game_sessions[game.key] = game
+            if game.public:
+                self.__public_sessions.setdefault(game.game_name, {})[game.key] = game
+                origins = self.__lobby_origins.setdefault(game.game_name, {})
+                origins[game.public_address] = origins.get(game.public_address, 0) + 1
+                self.__lobby_versions[game.game_name] = next(self.__version_counter)
+                for listener in self.__lobby_listeners:
+                    listener("add", game.game_name, game)
+            heapq.heappush(self.__expiry, (game.timeout, game.key))
+        return True
+
+    def findGame(self, game_key):
+        with self.__lock:
+            session = self.game_sessions.get(game_key)
+            if session is not None and session.hasTimeout():
+                self.__removeGame(session)
+            else:
+                return session
+        metrics.sessions_expired.inc()
+        self.gameRemoved(session)
+        return None
+
+    ## Remove a session by key, returns the removed session or None if there was no session with this key.
+    def removeGame(self, game_key):
+        with self.__lock:
+            session = self.game_sessions.get(game_key)
+            if session is None:
+                return None
+            self.__removeGame(session)
+        self.gameRemoved(session)
+        return session
+
+    ## Create the key for a new session.
+    def createKey(self):
+        return GameSession.generateKey()
+
+    ## Called without the lock held after a session has been removed from the registry, for whatever reason.
+    def gameRemoved(self, session):
+        pass
+
+    def getGames(self, game_name):
+        return self.getGamesWithVersion(game_name)[1]
+
+    ## Get the public sessions of a game_name together with the lobby version that this list belongs to.
+    def getGamesWithVersion(self, game_name):
+        with self.__lock:
+            sessions = self.__public_sessions.get(game_name)
+            if sessions is None:
+                return 0, []
+            result = []
+            removed = []
+            for session in list(sessions.values()):
+                if session.hasTimeout():
+                    self.__removeGame(session)
+                    removed.append(session)
+                else:
+                    result.append(session)
+            version = self.__lobby_versions.get(game_name, 0)
+        metrics.sessions_expired.inc(len(removed))
+        for session in removed:
+            self.gameRemoved(session)
+        return version, result
+
+    ## Call listener(event, game_name, session) for every change to the public sessions, with "add" or "remove" as event.
+    #   Listeners are called with the lock held, so they see the changes in the order in which they happened.
+    #   Which means that they must not block or use the registry.
+    def addLobbyListener(self, listener):
+        with self.__lock:
+            self.__lobby_listeners.append(listener)
+
+    ## Call callback(sessions) with the public sessions of a game_name while holding the lock.
+    #   Together with addLobbyListener this gives a snapshot of the lobby after which every change is seen exactly once.
+    #   Sessions that timed out but are not removed yet are part of the snapshot, their removal is a change like any other.
+    def snapshotLobby(self, game_name, callback):
+        with self.__lock:
+            callback(list(self.__public_sessions.get(game_name, {}).values()))
+
+    ## Get the current lobby version of a game_name and if the remote_address is the public address of one of its sessions.
+    #   This is done without taking the lock, as it is called for every lobby poll and single dict lookups are atomic.
+    def getLobbyVersion(self, game_name, remote_address):
+        return self.__lobby_versions.get(game_name, 0), remote_address in self.__lobby_origins.get(game_name, ())
+
+    ## Number of registered sessions per game_name, as label dict for metrics.sessions.
+    def getSessionCounts(self):
+        counts = {}
+        with self.__lock:
+            for session in self.game_sessions.values():
+                counts[(session.game_name,)] = counts.get((session.game_name,), 0) + 1
+        return counts
+
+    ## Number of waiting master connections over all sessions, as label dict for metrics.waiting_masters.
+    def getWaitingCounts(self):
+        websockets = rawsockets = 0
+        with self.__lock:
+            sessions = list(self.game_sessions.values())
+        for session in sessions:
+            waiting_websockets, waiting_rawsockets = session.getWaitingCount()
+            websockets += waiting_websockets
+            rawsockets += waiting_rawsockets
+        return {("websocket",): websockets, ("raw",): rawsockets}
+
+    ## Remove all sessions of which the timeout has passed, returns the list of removed sessions.
+    #   Only sessions at the top of the expiry heap are checked. Sessions that got their timeout extended are pushed back with their new timeout.
+    def cleanTimeoutSessions(self):
+        now = time.monotonic()
+        removed = []
+        with self.__lock:
+            while self.__expiry and self.__expiry[0][0] <= now:
+                timeout, key = heapq.heappop(self.__expiry)
+                session = self.game_sessions.get(key)
+                if session is None:
+                    continue
+                if session.hasTimeout():
+                    self.__removeGame(session)
+                    removed.append(session)
+                else:
+                    heapq.heappush(self.__expiry, (session.timeout, key))
+        metrics.sessions_expired.inc(len(removed))
+        for session in removed:
+            self.gameRemoved(session)
+        return removed
+
+    # Needs to be called with the lock held. The expiry heap entry is left behind and skipped when it is popped.
+    def __removeGame(self, session):
+        del self.game_sessions[session.key]
+        if session.public:
+            sessions = self.__public_sessions[session.game_name]
+            del sessions[session.key]
+            origins = self.__lobby_origins[session.game_name]
+            origins[session.public_address] -= 1
+            if origins[session.public_address] == 0:
+                del origins[session.public_address]
+            for listener in self.__lobby_listeners:
+                listener("remove", session.game_name, session)
+            if sessions:
+                self.__lobby_versions[session.game_name] = next(self.__version_counter)
+            else:
+                # Versions are unique over all game_names, so dropping the version here still invalidates any cached list.
+                del self.__public_sessions[session.game_name]
+                del self.__lobby_origins[session.game_name]
+                del self.__lobby_versions[session.game_name]
+
+    def __sweepSessions(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.cleanTimeoutSessions()
@@ -0,0 +1,101 @@
+import threading
+import time
+import logging
+
+import metrics
+
+
+## Keepalive scheduler shared by all connections of a server.
+#   Connections are spread over the slots of a timer wheel that does one revolution per interval, so every tick only has to look at
+#   a fraction of all connections and pings are spread evenly over the interval instead of all going out at once.
+#   Connections that received anything within the last interval are not pinged, as they are clearly alive.
+#   Connections that did not receive anything (not even a pong) for longer than their keepalive_timeout are expired.
+#   A connection needs to provide:
+#       - last_activity: time.monotonic() of the last received data.
+#       - keepalive_timeout: seconds without received data after which the connection is expired.
+#       - keepalivePing(): send a ping, this should never block on a congested connection.
+#       - keepaliveExpired(): close the connection.
+#   The statistics of the last full round are shown on /metrics, a round that takes longer than a tick is also logged.
+class KeepaliveScheduler:
+    slot_count = 20
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.tick_interval = interval / self.slot_count
+        self.__lock = threading.Lock()
+        self.__slots = [set() for n in range(self.slot_count)]
+        self.__slot_of = {}
+        self.__next_slot = 0
+        self.__position = 0
+        self.__round_duration = 0.0
+        self.__round_pings = 0
+        self.__round_timeouts = 0
+        # Statistics of the last full revolution of the wheel.
+        self.last_round_duration = 0.0
+        self.last_round_pings = 0
+        self.last_round_timeouts = 0
+        metrics.keepalive_round_seconds.setCallback(lambda: {(): self.last_round_duration})
+        metrics.keepalive_round_pings.setCallback(lambda: {(): self.last_round_pings})
+        metrics.keepalive_round_timeouts.setCallback(lambda: {(): self.last_round_timeouts})
+
+    def __len__(self):
+        return len(self.__slot_of)
+
+    def add(self, connection):
+        with self.__lock:
+            slot = self.__next_slot
+            self.__next_slot = (slot + 1) % self.slot_count
+            self.__slots[slot].add(connection)
+            self.__slot_of[connection] = slot
+
+    def remove(self, connection):
+        with self.__lock:
+            slot = self.__slot_of.pop(connection, None)
+            if slot is not None:
+                self.__slots[slot].discard(connection)
+
+    ## Handle the connections of the next slot, needs to be called every tick_interval seconds.
+    def tick(self):
+        start = time.monotonic()
+        with self.__lock:
+            connections = list(self.__slots[self.__position])
+            self.__position = (self.__position + 1) % self.slot_count
+            end_of_round = self.__position == 0
+        for connection in connections:
+            idle = start - connection.last_activity
+            try:
+                if idle > connection.keepalive_timeout:
+                    self.__round_timeouts += 1
+                    connection.keepaliveExpired()
+                elif idle >= self.interval:
+                    self.__round_pings += 1
+                    connection.keepalivePing()
+            except IOError:
+                pass    # The connection is broken, its own reader will notice that and clean up.
+            except Exception:
+                logging.exception("Keepalive of %s failed", connection)
+        self.__round_duration += time.monotonic() - start
+        if end_of_round:
+            self.last_round_duration = self.__round_duration
+            self.last_round_pings = self.__round_pings
+            self.last_round_timeouts = self.__round_timeouts
+            self.__round_duration = 0.0
+            self.__round_pings = 0
+            self.__round_timeouts = 0
+            if self.last_round_duration > self.tick_interval:
+                logging.warning("Keepalive round for %d connections took %.3f seconds", len(self), self.last_round_duration)
+
+    ## Run the scheduler on its own thread, for the threaded server.
+    def start(self):
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def __run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick_interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic()
+            self.tick()
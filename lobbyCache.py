@@ -0,0 +1,48 @@
+import threading
+import hashlib
+import json
+
+
+## Cache of serialized /game/list/[game_name] responses.
+#   Entries are checked against the lobby version of the registry, which changes whenever a public session of the game_name
+#   is added or expires, so a poll of an unchanged lobby only costs two dict lookups.
+#   The addresses in the list depend on the origin of the caller (see GameSession.getAddressesFor), so callers that share
+#   their public address with one of the listed sessions get their own entry. All other callers share a single entry.
+class LobbyCache:
+    max_entries = 4096
+
+    def __init__(self, registry):
+        self.__registry = registry
+        self.__lock = threading.Lock()
+        self.__entries = {}
+
+    ## Get the json body and the ETag for the list of games of game_name as seen from remote_address.
+    def getList(self, game_name, remote_address):
+        version, same_origin = self.__registry.getLobbyVersion(game_name, remote_address)
+        cache_key = (game_name, remote_address if same_origin else None)
+        entry = self.__entries.get(cache_key)
+        if entry is not None and entry[0] == version:
+            return entry[1], entry[2]
+
+        version, sessions = self.__registry.getGamesWithVersion(game_name)
+        # External callers never match the public address of a session, so None gives the external view of every session.
+        body = json.dumps([session.getInfoFor(cache_key[1]) for session in sessions]).encode("ascii")
+        etag = '"%s"' % (hashlib.sha1(body).hexdigest()[:20])
+        with self.__lock:
+            if cache_key not in self.__entries and len(self.__entries) >= self.max_entries:
+                del self.__entries[next(iter(self.__entries))]
+            self.__entries[cache_key] = (version, body, etag)
+        return body, etag
+
+    ## Check if the If-None-Match header value matches the given ETag.
+    @staticmethod
+    def matchesETag(if_none_match, etag):
+        if if_none_match is None:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == etag or tag == "*":
+                return True
+        return False
@@ -0,0 +1,103 @@
+import threading
+import collections
+import logging
+import json
+
+import metrics
+
+## Push based lobby for /game/watch/[game_name] websockets, instead of polling /game/list/[game_name].
+#   A watcher first gets a snapshot of the lobby, followed by a message for every change to it. All messages are json objects:
+#       - {"event": "snapshot", "games": [game, ...]}: The public games, as listed by /game/list.
+#       - {"event": "add", "game": game}: A public game was registered.
+#       - {"event": "remove", "key": key}: A public game is gone, because it timed out or was removed.
+#   Registered games do not change, so there are no updates of a listed game, a game that is registered again gets a new key.
+#   The changes come from the lobby listener of the registry (see GameRegistryMixin.addLobbyListener) and are send to the watchers
+#   from a single thread, so the registry never waits for a watcher. Every change is serialized once for all watchers of its
+#   game_name, and once more for the watchers that share the public address of the game, as they see its private addresses.
+#   Watchers get every message with watcher.lobbyUpdate(message), which must not block. A watcher that cannot keep up should
+#   be disconnected, it will get a new snapshot when it reconnects.
+
+lobby_updates_metric = metrics.lobby_watch_messages
+
+
+class LobbyWatch:
+    def __init__(self, registry):
+        self.__registry = registry
+        self.__condition = threading.Condition()
+        self.__events = collections.deque()
+        # Number of watchers per game_name, changes of other game_names are not queued at all.
+        self.__watch_counts = {}
+        # Watchers per game_name, as dict of watcher to its remote address. Only used by the thread that sends the messages.
+        self.__watchers = {}
+        registry.addLobbyListener(self.__lobbyChanged)
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    ## Start sending the lobby of game_name to watcher, as seen from remote_address.
+    def subscribe(self, game_name, watcher, remote_address):
+        self.__registry.snapshotLobby(game_name, lambda sessions: self.__queue("snapshot", game_name, (watcher, remote_address, sessions), 1))
+
+    def unsubscribe(self, game_name, watcher):
+        self.__queue("unsubscribe", game_name, watcher, -1)
+
+    # Called with the lock of the registry held.
+    def __lobbyChanged(self, event, game_name, session):
+        if game_name in self.__watch_counts:
+            self.__queue(event, game_name, session)
+
+    def __queue(self, event, game_name, data, watch_change=0):
+        with self.__condition:
+            if watch_change:
+                count = self.__watch_counts.get(game_name, 0) + watch_change
+                if count > 0:
+                    self.__watch_counts[game_name] = count
+                else:
+                    del self.__watch_counts[game_name]
+            elif game_name not in self.__watch_counts:
+                return
+            self.__events.append((event, game_name, data))
+            self.__condition.notify()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__events:
+                    self.__condition.wait()
+                events = list(self.__events)
+                self.__events.clear()
+            for event, game_name, data in events:
+                try:
+                    self.__dispatch(event, game_name, data)
+                except Exception:
+                    logging.exception("Failed to send lobby update of %s", game_name)
+
+    def __dispatch(self, event, game_name, data):
+        if event == "snapshot":
+            watcher, remote_address, sessions = data
+            self.__watchers.setdefault(game_name, {})[watcher] = remote_address
+            self.__send([watcher], event, {"event": event, "games": [session.getInfoFor(remote_address) for session in sessions]})
+            return
+        watchers = self.__watchers.get(game_name)
+        if watchers is None:
+            return
+        if event == "unsubscribe":
+            watchers.pop(data, None)
+            if not watchers:
+                del self.__watchers[game_name]
+        elif event == "add":
+            external = []
+            same_origin = []
+            for watcher, remote_address in watchers.items():
+                (same_origin if remote_address == data.public_address else external).append(watcher)
+            # External watchers never match the public address of a session, so None gives the external view, like LobbyCache does.
+            self.__send(external, event, {"event": event, "game": data.getInfoFor(None)})
+            self.__send(same_origin, event, {"event": event, "game": data.getInfoFor(data.public_address)})
+        elif event == "remove":
+            self.__send(list(watchers), event, {"event": event, "key": data.key})
+
+    def __send(self, watchers, event, message):
+        if not watchers:
+            return
+        message = json.dumps(message).encode("ascii")
+        for watcher in watchers:
+            watcher.lobbyUpdate(message)
+        lobby_updates_metric.labels(event).inc(len(watchers))
@@ -1,23 +1,37 @@
 import http.server
 import http
 import socketserver
+import socket
 import sys
 import threading
 import time
-import os
-import shutil
-import random
 import math
 import logging
 import struct
 import json
+import urllib.parse
 
 import config
 import websocketHttp
 import rawsocketHttp
-
-# pythons secrets library is introduced in 3.7, so use the system random instead (which is what secrets also uses)
-secrets = random.SystemRandom()
+import lobbyCache
+import staticFiles
+import workerPool
+import bufferPool
+import metrics
+import sessionLog
+import multiplex
+import lobbyWatch
+import admission
+import adminApi
+from gameSession import GameSession, GameRegistryMixin, parseConnectPath
+
+relayed_websocket_messages_metric = metrics.relayed_messages.labels("websocket")
+relayed_websocket_bytes_metric = metrics.relayed_bytes.labels("websocket")
+relayed_raw_messages_metric = metrics.relayed_messages.labels("raw")
+relayed_raw_bytes_metric = metrics.relayed_bytes.labels("raw")
+
+bufferPool.pool.max_free_bytes = getattr(config, "buffer_pool_max_free", 16 * 1024 * 1024)
 
 ## WebSocketSwitchboard proxy.
 #   The Switchboard proxy allows clients and servers to connect to each other by using this proxy as middle man.
@@ -51,10 +65,14 @@ secrets = random.SystemRandom()
 #           As a server connect as a websocket or raw socket and wait for a client websocket to connect.
 #           Requires a GET with upgrade to websocket or raw.
 #           Must supply the key and secret as HTTP headers.
+#           Multiple master connections can be waiting at the same time, up to config.max_waiting_masters, after that the oldest is closed.
+#           With a "Game-Multiplex: 1" header this is a multiplexed master that serves all clients over this one connection, see multiplex.
 #       /game/connect/[key]
 #           As a client, connect to a game.
 #               When connecting as a raw or websocket will make a direct transparent channel to a /game/master connected socket if available for the given [key].
 #               Or returns a 404 if the game does not exist and a 503 if the server has no connected socket yet.
+#               With /game/connect/[key]?wait=[seconds] the switchboard waits up to the given time (limited by config.max_connect_wait)
+#               for a master connection before returning the 503.
 #           Or when using a normal http GET request, will return server info for this game.
 #       /game/list/[game_name]
 #           Get a list of public games for a specific game_name. The client should filter out incompattible versions,
@@ -67,136 +85,111 @@ secrets = random.SystemRandom()
 #           - port: port to connect to for direct connection. (optional)
 #           Note that the reported addresses could be an external address detected by the switchboard or the internal addresses reported by the server
 #               if the switchboard detects that both client and server have the same origin.
-
-class GameSession:
-    KEY_LENGTH = 5
-    SECRET_LENGTH = 32
-    KEY_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
-    def __init__(self, name, game_name, version, public, public_address, private_address, port):
-        self.__lock = threading.Lock()
-        self.__name = name
-        self.__game_name = game_name
-        self.__version = version
-        self.__public = public
-        self.__public_address = public_address
-        self.__private_address = private_address
-        self.__port = port
-        self.__key = ""
-        self.__secret = ""
-        self.__waiting_websocket = None
-        self.__waiting_rawsocket = None
-        self.__timeout = time.monotonic() + 60.0
-
-        for n in range(self.KEY_LENGTH):
-            self.__key += secrets.choice(self.KEY_CHARS)
-        for n in range(self.SECRET_LENGTH):
-            self.__secret += secrets.choice(self.KEY_CHARS)
-
-    @property
-    def name(self):
-        return self.__name
-
-    @property
-    def version(self):
-        return self.__version
-
-    @property
-    def game_name(self):
-        return self.__game_name
-
-    @property
-    def public(self):
-        return self.__public
-
-    def getAddressesFor(self, remote_address):
-        if self.__port == 0:
-            return []
-        if remote_address == self.__public_address:
-            return self.__private_address + [self.__public_address]
-        return [self.__public_address]
-
-    @property
-    def port(self):
-        return self.__port
-
-    @property
-    def key(self):
-        return self.__key
-
-    @property
-    def secret(self):
-        return self.__secret
-
-    def grabWebsocket(self):
-        with self.__lock:
-            result = self.__waiting_websocket
-            self.__waiting_websocket = None
-        return result
-    
-    def setWaitingWebsocket(self, socket):
-        self.__timeout = time.monotonic() + 60.0
-        with self.__lock:
-            if self.__waiting_websocket is not None:
-                self.__waiting_websocket.rfile.close()
-            self.__waiting_websocket = socket
-
-    def grabRawsocket(self):
-        with self.__lock:
-            result = self.__rawsocket_in_waiting
-            self.__rawsocket_in_waiting = None
-        return result
-    
-    def setWaitingRawsocket(self, socket):
-        self.__timeout = time.monotonic() + 60.0
-        with self.__lock:
-            if self.__waiting_rawsocket is not None:
-                self.__waiting_rawsocket.rfile.close()
-            self.__waiting_rawsocket = socket
-
-    def hasTimeout(self):
-        if self.__waiting_websocket is not None:
-            if not self.__waiting_websocket.rfile.closed:
-                self.__timeout = time.monotonic() + 60.0
-                return False
-        if self.__waiting_rawsocket is not None:
-            if not self.__waiting_rawsocket.rfile.closed:
-                self.__timeout = time.monotonic() + 60.0
-                return False
-        return time.monotonic() > self.__timeout
-
+#       /game/watch/[game_name]
+#           As a websocket, get the list of /game/list/[game_name] pushed to you, followed by every change to it, see lobbyWatch.
+#       /[file]
+#           Static files of the browser lobby from config.static_root (www/ by default), with / for index.html.
+#       /metrics
+#           Relay throughput, pairing results and latency, connection counts and registry state in the Prometheus text format.
+#       /admin/threads, /admin/profile, /admin/trace/[key]
+#           Thread stacks, sampling profiles and relay latency traces of sessions, only with config.admin_token, see adminApi.
+#   All API endpoints are subject to admission control (see admission), requests over the limits get a 429 or 503 with Retry-After.
 
 class HTTPRequestHandler(rawsocketHttp.RawsocketMixin, websocketHttp.WebsocketMixin, http.server.BaseHTTPRequestHandler):
+    rawsocket_relay_mode = getattr(config, "raw_relay_mode", "splice")
+    max_connect_wait = getattr(config, "max_connect_wait", 10.0)
+    websocket_ping_interval = getattr(config, "websocket_ping_interval", 5.0)
+    websocket_idle_timeout = getattr(config, "websocket_idle_timeout", 20.0)
+    websocket_batch_latency = getattr(config, "websocket_batch_latency", 0.0)
+    send_queue_size = getattr(config, "relay_queue_size", 1024 * 1024)
+    send_queue_policy = getattr(config, "relay_queue_policy", "pause")
+    websocket_deflate = getattr(config, "websocket_deflate", True)
+    websocket_deflate_window_bits = getattr(config, "websocket_deflate_window_bits", 15)
+    websocket_deflate_context_takeover = getattr(config, "websocket_deflate_context_takeover", True)
+    websocket_max_message_size = getattr(config, "websocket_max_message_size", 16 * 1024 * 1024)
+    websocket_cut_through = getattr(config, "websocket_cut_through", True)
+    lobby_watch_queue_size = getattr(config, "lobby_watch_queue_size", 1024 * 1024)
+    http_idle_timeout = getattr(config, "http_idle_timeout", 5.0)
+    http_max_requests = getattr(config, "http_max_requests", 100)
+    protocol_version = "HTTP/1.1"
+    # The multiplex.Multiplexer of a multiplexed master connection.
+    multiplexer = None
+    # The admission.AdmissionControl connection role that this connection has a slot for.
+    admission_role = None
+    # Retry-After of a request that is refused by admission control.
+    retry_after = None
+
+    ## Handle requests till the connection is not kept alive anymore, or http_max_requests are handled.
+    #   Every response has a Content-Length, and errors always close the connection (see send_error), as the body of the request
+    #   might not have been read. Pipelined requests are handled in order from the buffer of rfile.
+    #   Between requests the connection can be idle for http_idle_timeout seconds, after that it is closed.
+    def handle(self):
+        self.__request_count = 1
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.__request_count += 1
+            self.connection.settimeout(self.http_idle_timeout)
+            try:
+                if not self.rfile.peek(1):
+                    return
+            except OSError:
+                return  # Idle for too long, or the connection is gone.
+            self.connection.settimeout(self.timeout)
+            self.handle_one_request()
+
+    def send_response_only(self, code, message=None):
+        super().send_response_only(code, message)
+        self.__response_code = code
+
+    def end_headers(self):
+        # Informational responses, like the switch to websocket or raw, are not the response that ends the request.
+        if self.__response_code >= 200 and not self.close_connection:
+            if self.__request_count >= self.http_max_requests:
+                self.send_header("Connection", "close")
+            elif self.request_version == "HTTP/1.0":
+                self.send_header("Connection", "keep-alive")
+        if self.retry_after is not None:
+            self.send_header("Retry-After", self.retry_after)
+            self.retry_after = None
+        super().end_headers()
+
+    def finish(self):
+        if self.admission_role is not None:
+            self.server.admission.leave(self.admission_role)
+            self.admission_role = None
+        super().finish()
+
     def do_GET(self):
-        if self.path == "/":
-            return self.sendStaticFile("www/index.html")
-        elif self.path.startswith("/game/list/"):
+        if self.path.startswith("/game/list/"):
+            refused = self.__admit("list")
+            if refused is not None:
+                return self.send_error(refused)
             game_name = self.path[11:]
-            result = []
-            for session in self.server.getGames(game_name):
-                result.append({
-                    "name": session.name,
-                    "version": session.version,
-                    "key": session.key,
-                    "address": session.getAddressesFor(self.client_address[0]),
-                    "port": session.port
-                })
-            return self.sendJson(result)
+            body, etag = self.server.lobby_cache.getList(game_name, self.client_address[0])
+            return self.sendCachedJson(body, etag)
         elif self.path.startswith("/game/connect/"):
-            game_key = self.path[14:]
+            refused = self.__admit("connect")
+            if refused is not None:
+                return self.send_error(refused)
+            game_key = urllib.parse.urlsplit(self.path).path[14:]
             game = self.server.findGame(game_key)
             if game is None:
-                return http.HTTPStatus.NOT_FOUND
-            return self.sendJson({
-                "name": game.name,
-                "version": game.version,
-                "key": game.key,
-                "address": game.getAddressesFor(self.client_address[0]),
-                "port": game.port
-            })
-        self.send_error(http.HTTPStatus.NOT_FOUND)
+                metrics.session_not_found.labels("info").inc()
+                return self.send_error(http.HTTPStatus.NOT_FOUND)
+            return self.sendJson(game.getInfoFor(self.client_address[0]))
+        elif self.path == "/metrics":
+            return self.sendMetrics()
+        elif self.path.startswith("/admin/"):
+            return self.sendAdmin()
+        return self.sendStaticFile()
 
     def do_POST(self):
         if self.path == "/game/register":
+            # Checked before the posted json is read, the connection is closed after an error so the body does not need to be read.
+            refused = self.__admit("register")
+            if refused is not None:
+                return self.send_error(refused)
             if "Content-Length" not in self.headers or "Content-Type" not in self.headers:
                 self.send_error(http.HTTPStatus.BAD_REQUEST)
                 return
@@ -209,56 +202,104 @@ class HTTPRequestHandler(rawsocketHttp.RawsocketMixin, websocketHttp.WebsocketMi
                 self.send_error(http.HTTPStatus.BAD_REQUEST)
                 return
 
-            if "name" not in post_data or "game_name" not in post_data or "game_version" not in post_data or "secret_hash" not in post_data:
-                self.send_error(http.HTTPStatus.BAD_REQUEST)
-                return
-            if  "public" not in post_data or "address" not in post_data or "port" not in post_data:
-                self.send_error(http.HTTPStatus.BAD_REQUEST)
-                return
-            if not isinstance(post_data["address"], list):
+            game = GameSession.fromRegistration(post_data, self.client_address[0], self.server.createKey())
+            if game is None:
                 self.send_error(http.HTTPStatus.BAD_REQUEST)
                 return
-            for address in post_data["address"]:
-                if not isinstance(address, str):
-                    self.send_error(http.HTTPStatus.BAD_REQUEST)
-                    return
-            # TODO: Check secret hash
-            game = GameSession(
-                name = post_data["name"],
-                game_name = post_data["game_name"],
-                version = int(post_data["game_version"]),
-                public = bool(post_data["public"]),
-                public_address = self.client_address[0],
-                private_address = post_data["address"],
-                port = int(post_data["port"])
-            )
             if not self.server.addGame(game):
                 # TODO, we should just retry.
                 self.send_error(http.HTTPStatus.INTERNAL_SERVER_ERROR)
                 return
 
             return self.sendJson({"key": game.key, "secret": game.secret})
+        elif self.path.startswith("/admin/"):
+            return self.sendAdmin()
         self.send_error(http.HTTPStatus.NOT_FOUND)
 
-    def sendStaticFile(self, path):
-        try:
-            f = open(path, "rb")
-        except IOError:
+    def sendStaticFile(self):
+        response = self.server.static_files.serve(self.path, self.headers)
+        if response is None:
             return self.send_error(http.HTTPStatus.NOT_FOUND)
-        self.send_response(http.HTTPStatus.OK)
-        fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs.st_size))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        self.send_response(response.status)
+        for key, value in response.headers:
+            self.send_header(key, value)
+        if response.status != http.HTTPStatus.NOT_MODIFIED:
+            self.send_header("Content-Length", str(response.length))
         self.end_headers()
-        shutil.copyfileobj(f, self.wfile)
-        f.close()
+        if response.file is not None:
+            with response.file:
+                # The headers are written by end_headers, so the file can go to the socket directly. Uses os.sendfile when it can.
+                self.connection.sendfile(response.file, 0, response.length)
+        elif response.body:
+            self.wfile.write(response.body)
 
     def sendJson(self, data):
-        response = json.dumps(data)
+        response = json.dumps(data).encode("ascii")
         self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", len(response))
         self.end_headers()
-        self.wfile.write(response.encode("ascii"))
+        self.wfile.write(response)
+
+    def sendAdmin(self):
+        trace_key = adminApi.AdminApi.traceKey(self.path)
+        if trace_key is not None and not self.server.isHomeOf(trace_key):
+            return self.send_error(http.HTTPStatus.MISDIRECTED_REQUEST)
+        # The admin API never reads posted data, so the connection cannot be used for another request when there is any.
+        if self.headers.get("Content-Length", "0").strip() != "0":
+            self.close_connection = True
+        response = self.server.admin_api.handle(self.command, self.path, self.headers)
+        self.send_response(response.status)
+        for key, value in response.headers:
+            self.send_header(key, value)
+        self.send_header("Content-Length", len(response.body))
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    def sendMetrics(self):
+        body = metrics.render()
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", metrics.content_type)
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    ## Send an already serialized json body, or a 304 if the client already has this version.
+    def sendCachedJson(self, body, etag):
+        if lobbyCache.LobbyCache.matchesETag(self.headers.get("If-None-Match"), etag):
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", len(body))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    ## Check a request with admission control, returns None when it is admitted, otherwise the status to refuse it with.
+    def __admit(self, endpoint_class):
+        refused = self.server.admission.admit(endpoint_class, self.client_address[0])
+        if refused is None:
+            return None
+        status, self.retry_after = refused
+        return status
+
+    ## Take a connection slot of admission control, which is released when the connection is finished.
+    #   Returns None when there was room, otherwise the status to refuse the upgrade with.
+    def __enterAdmission(self, role):
+        refused = self.server.admission.enter(role)
+        if refused is not None:
+            status, self.retry_after = refused
+            return status
+        self.admission_role = role
+        return None
+
+    def __leaveAdmission(self):
+        self.server.admission.leave(self.admission_role)
+        self.admission_role = None
 
     def __handleWebOrRawConnect(self, socket_type):
         if self.path == "/game/master":
@@ -267,95 +308,223 @@ class HTTPRequestHandler(rawsocketHttp.RawsocketMixin, websocketHttp.WebsocketMi
                 return http.HTTPStatus.BAD_REQUEST
             game_key = self.headers["Game-Key"]
             secret = self.headers["Game-Secret"]
+            if not self.server.isHomeOf(game_key):
+                return http.HTTPStatus.MISDIRECTED_REQUEST
+            refused = self.__admit("master")
+            if refused is not None:
+                return refused
             game = self.server.findGame(game_key)
             if game is None:
                 logging.warning("Master connection: Game not found")
+                metrics.session_not_found.labels("master").inc()
                 return http.HTTPStatus.NOT_FOUND
             if game.secret != secret:
                 logging.warning("Master connection: Secret mismatch")
                 return http.HTTPStatus.BAD_REQUEST
+            refused = self.__enterAdmission("master")
+            if refused is not None:
+                return refused
             self.other = None
-            if socket_type == "Web":
-                game.setWaitingWebsocket(self)
-            else:
-                game.setWaitingRawsocket(self)
+            self.trace_key = game.key
+            # The master is only made available to clients from websocket_OPEN/rawsocket_OPEN, after the upgrade response has been send.
+            self.__master_game = game
+            self.__multiplexed = multiplex.isRequested(self.headers)
             return
         elif self.path.startswith("/game/connect/"):
-            game_key = self.path[14:]
+            connect = parseConnectPath(self.path, self.max_connect_wait)
+            if connect is None:
+                metrics.connect_requests.labels("bad_request").inc()
+                return http.HTTPStatus.BAD_REQUEST
+            game_key, wait = connect
+            if not self.server.isHomeOf(game_key):
+                return http.HTTPStatus.MISDIRECTED_REQUEST
+            refused = self.__admit("connect")
+            if refused is not None:
+                metrics.connect_requests.labels("refused").inc()
+                return refused
             game = self.server.findGame(game_key)
             if game is None:
+                metrics.connect_requests.labels("not_found").inc()
+                metrics.session_not_found.labels("connect").inc()
                 return http.HTTPStatus.NOT_FOUND
+            refused = self.__enterAdmission("relay")
+            if refused is not None:
+                metrics.connect_requests.labels("refused").inc()
+                return refused
+            start = time.monotonic()
             if socket_type == "Web":
-                self.other = game.grabWebsocket()
+                self.other = game.grabWebsocket(wait)
             else:
-                self.other = game.grabRawsocket()
+                self.other = game.grabRawsocket(wait)
             if self.other is None:
+                self.__leaveAdmission()
+                metrics.connect_requests.labels("unavailable").inc()
                 return http.HTTPStatus.SERVICE_UNAVAILABLE
+            metrics.pairing_wait_seconds.observe(time.monotonic() - start)
+            metrics.connect_requests.labels("paired").inc()
             self.other.other = self
+            self.trace_key = game.key
+            return
+        elif self.path.startswith("/game/watch/") and socket_type == "Web":
+            refused = self.__admit("list")
+            if refused is not None:
+                return refused
+            self.other = None
+            # Lobby updates are send from the thread of the lobby watch, which must never block on a slow watcher.
+            self.send_queue_size = self.lobby_watch_queue_size
+            self.send_queue_policy = "disconnect"
             return
         return http.HTTPStatus.NOT_FOUND
 
+    def closeRelay(self):
+        try:
+            # Wake up the thread of this connection if it is blocked on a read, closing rfile would otherwise wait for that read.
+            self.connection.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        self.rfile.close()
+
+    def isRelayClosed(self):
+        return self.rfile.closed
+
     def do_WEBSOCKET(self):
         return self.__handleWebOrRawConnect("Web")
 
+    def __connectionMetric(self, protocol):
+        if self.path.startswith("/game/watch/"):
+            return metrics.connections.labels("watcher", protocol)
+        return metrics.connections.labels("master" if self.path == "/game/master" else "client", protocol)
+
+    def lobbyUpdate(self, message):
+        self.websocket_send(message)
+
     def websocket_OPEN(self):
+        self.__connectionMetric("websocket").inc()
         if self.path == "/game/master":
-            pass
+            if self.__multiplexed:
+                self.multiplexer = multiplex.Multiplexer(self, "websocket")
+                self.__master_game.setMultiplexer(self.multiplexer)
+            else:
+                self.__master_game.setWaitingWebsocket(self)
+        elif self.path.startswith("/game/watch/"):
+            self.server.lobby_watch.subscribe(self.path[12:], self, self.client_address[0])
+        elif isinstance(self.other, multiplex.Channel):
+            self.other.open()
         else:
             self.other.websocket_send(b"CLIENT_CONNECTED")
 
-    def websocket_MESSAGE(self, message):
-        if self.other is not None:
-            self.other.websocket_send(message)
-    
+    def websocket_MESSAGE(self, message, opcode):
+        if self.multiplexer is not None:
+            try:
+                packets = self.multiplexer.parseMessage(message)
+            except ValueError:
+                return self.closeRelay()
+            for client, opcode, payload in packets:
+                relayed_websocket_messages_metric.inc()
+                relayed_websocket_bytes_metric.inc(len(payload))
+                client.websocket_send(payload, opcode)
+        elif self.other is not None:
+            relayed_websocket_messages_metric.inc()
+            relayed_websocket_bytes_metric.inc(len(message))
+            self.other.websocket_send(message, opcode)
+
+    def websocket_PEER(self):
+        if self.other is not None and self.other.is_websocket():
+            return self.other
+        return None
+
     def websocket_CLOSE(self):
+        self.__connectionMetric("websocket").dec()
+        if self.path.startswith("/game/watch/"):
+            self.server.lobby_watch.unsubscribe(self.path[12:], self)
+        if self.multiplexer is not None:
+            self.multiplexer.closeAll()
         if self.other is not None:
-            self.other.rfile.close()
+            self.other.closeRelay()
 
     def do_RAW(self):
         return self.__handleWebOrRawConnect("Raw")
 
     def rawsocket_OPEN(self):
+        self.__connectionMetric("raw").inc()
         if self.path == "/game/master":
-            pass
+            if self.__multiplexed:
+                self.multiplexer = multiplex.Multiplexer(self, "raw")
+                self.__master_game.setMultiplexer(self.multiplexer)
+            else:
+                self.__master_game.setWaitingRawsocket(self)
+        elif isinstance(self.other, multiplex.Channel):
+            self.other.open()
         else:
             self.other.rawsocket_send(struct.pack("!I", 0))
 
     def rawsocket_MESSAGE(self, data):
-        if self.other is not None:
+        if self.multiplexer is not None:
+            try:
+                packets = self.multiplexer.parseStream(data)
+            except ValueError:
+                return self.closeRelay()
+            for client, opcode, payload in packets:
+                relayed_raw_messages_metric.inc()
+                relayed_raw_bytes_metric.inc(len(payload))
+                client.rawsocket_send(payload)
+        elif self.other is not None:
+            relayed_raw_messages_metric.inc()
+            relayed_raw_bytes_metric.inc(len(data))
             self.other.rawsocket_send(data)
 
+    def rawsocket_PEER(self):
+        if self.other is not None and self.other.is_raw():
+            return self.other
+        return None
+
     def rawsocket_CLOSE(self):
+        self.__connectionMetric("raw").dec()
+        if self.multiplexer is not None:
+            self.multiplexer.closeAll()
         if self.other is not None:
-            self.other.rfile.close()
+            self.other.closeRelay()
 
 
-class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+class Server(sessionLog.SessionLogMixin, GameRegistryMixin, socketserver.ThreadingMixIn, http.server.HTTPServer):
+    session_log_path = getattr(config, "session_log", None)
+    # Stack size of the threads of connections, 0 for the default of the platform. Every parked master and both sides of a relay have a thread.
+    thread_stack_size = getattr(config, "thread_stack_size", 0)
+    # Parsing deeply nested json runs into the recursion limit before it overflows a stack of this size.
+    min_thread_stack_size = 256 * 1024
+
     def __init__(self, *args, **kwargs):
+        if self.thread_stack_size > 0:
+            # Applies to every thread started from now on, which are mostly the threads of connections.
+            threading.stack_size(max(self.thread_stack_size, self.min_thread_stack_size))
         super().__init__(*args, **kwargs)
-        self.game_sessions = {}
-
-    def addGame(self, game):
-        self.cleanTimeoutSessions()
-        if game.key in self.game_sessions:
-            return False
-        self.game_sessions[game.key] = game
+        self.lobby_cache = lobbyCache.LobbyCache(self)
+        self.lobby_watch = lobbyWatch.LobbyWatch(self)
+        self.admission = admission.AdmissionControl(getattr(config, "admission_global_rates", None), getattr(config, "admission_address_rates", None), getattr(config, "max_relays", 0), getattr(config, "max_parked_masters", 0))
+        self.static_files = staticFiles.StaticFiles(getattr(config, "static_root", "www"), getattr(config, "static_max_age", 0), getattr(config, "static_cache_size", 16 * 1024 * 1024))
+        self.admin_api = adminApi.AdminApi(self, getattr(config, "admin_token", None), getattr(config, "admin_max_profile_seconds", 60.0), getattr(config, "admin_max_trace_seconds", 3600.0))
+
+    ## Check if the connections of this game key are handled by this process, see workerPool.WorkerServerMixin.
+    #   With keep-alive a connection can ask for another key than the one it was routed for, that gets a 421 so the client retries on a new connection.
+    def isHomeOf(self, game_key):
         return True
 
-    def findGame(self, game_key):
-        self.cleanTimeoutSessions()
-        try:
-            return self.game_sessions[game_key]
-        except KeyError:
-            return None
 
-    def getGames(self, game_name):
-        self.cleanTimeoutSessions()
-        return [session for session in self.game_sessions.values() if session.public and session.game_name == game_name]
+class WorkerServer(workerPool.WorkerServerMixin, Server):
+    # The coordinator keeps the session log for all workers.
+    session_log_path = None
+
+
+def startWorker(worker_index, registry_channel, handoff_channels):
+    WorkerServer(worker_index, registry_channel, handoff_channels, ('', config.server_port), HTTPRequestHandler).serve_forever()
 
-    def cleanTimeoutSessions(self):
-        self.game_sessions = {k:v for (k,v) in self.game_sessions.items() if not v.hasTimeout()}
 
 if __name__ == "__main__":
-    httpd = Server(('', config.server_port), HTTPRequestHandler)
+    if getattr(config, "server_engine", "threading") == "asyncio":
+        import asyncServer
+        httpd = asyncServer.AsyncServer(('', config.server_port))
+    elif getattr(config, "server_workers", 1) > 1:
+        httpd = workerPool.Coordinator(config.server_workers, startWorker, getattr(config, "session_log", None))
+    else:
+        httpd = Server(('', config.server_port), HTTPRequestHandler)
     httpd.serve_forever()
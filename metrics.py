@@ -0,0 +1,242 @@
+import threading
+import time
+import bisect
+
+## Metrics of this process, served in the Prometheus text format on /metrics.
+#   Recording is done from the hot paths, so it is kept to an uncontended lock and an addition per call. Everything that can be
+#   derived from existing state (like the number of sessions) is not recorded at all, but collected by a callback when /metrics is requested.
+#   With multiple worker processes (see workerPool) every worker has its own metrics, /metrics shows the worker that accepted the request.
+
+_metrics = []
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _formatLabels(names, values, extra=""):
+    labels = ["%s=\"%s\"" % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{%s}" % (",".join(labels))
+
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class _Value:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.__lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+## Base for metrics with labels. Every combination of label values gets its own child, which should be looked up once
+#   and kept around by code in the hot path, instead of calling labels() for every recording.
+class _Family:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.__lock = threading.Lock()
+        self.__children = {}
+        _register(self)
+
+    def labels(self, *values):
+        child = self.__children.get(values)
+        if child is None:
+            with self.__lock:
+                child = self.__children.setdefault(values, self._newChild())
+        return child
+
+    def _newChild(self):
+        return _Value()
+
+    def _children(self):
+        return list(self.__children.items())
+
+    def _samples(self):
+        for values, child in self._children():
+            yield self.name, _formatLabels(self.label_names, values), child.value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for name, labels, value in self._samples():
+            lines.append("%s%s %s" % (name, labels, _formatValue(value)))
+        return lines
+
+
+class Counter(_Family):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Family):
+    kind = "gauge"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+## Gauge of which the values are collected when the metrics are rendered.
+#   The callback returns a dict of label value tuples to values, set with setCallback by the owner of the measured state.
+class CallbackGauge(_Family):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.__callback = None
+
+    def setCallback(self, callback):
+        self.__callback = callback
+
+    def _samples(self):
+        if self.__callback is None:
+            return
+        for values, value in sorted(self.__callback().items()):
+            yield self.name, _formatLabels(self.label_names, values), value
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.__lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(_Family):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def _newChild(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in self._children():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), list(child.counts)):
+                total += count
+                yield self.name + "_bucket", _formatLabels(self.label_names, values, "le=\"%s\"" % (_formatValue(float(bound)))), total
+            yield self.name + "_sum", _formatLabels(self.label_names, values), child.sum
+            yield self.name + "_count", _formatLabels(self.label_names, values), total
+
+
+## Lock that records how long threads had to wait for it. The time is only measured when the lock is not free,
+#   so an uncontended acquire costs a single extra non-blocking acquire.
+#   Can be used as the lock of a threading.Condition.
+class TimedLock:
+    __slots__ = ("__lock", "__wait_seconds", "__contentions")
+
+    def __init__(self, name):
+        self.__lock = threading.Lock()
+        self.__wait_seconds = lock_wait_seconds.labels(name)
+        self.__contentions = lock_contentions.labels(name)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.__lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.monotonic()
+        result = self.__lock.acquire(True, timeout)
+        self.__wait_seconds.inc(time.monotonic() - start)
+        self.__contentions.inc()
+        return result
+
+    def release(self):
+        self.__lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+## Render all metrics in the Prometheus text exposition format.
+def render():
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+websocket_frames_received = Counter("switchboard_websocket_frames_received_total", "Websocket frames received.")
+websocket_bytes_received = Counter("switchboard_websocket_received_bytes_total", "Payload bytes of received websocket frames.")
+websocket_frames_sent = Counter("switchboard_websocket_frames_sent_total", "Websocket frames send.")
+websocket_bytes_sent = Counter("switchboard_websocket_sent_bytes_total", "Payload bytes of send websocket frames.")
+relayed_messages = Counter("switchboard_relayed_messages_total", "Messages relayed between paired connections, for raw connections every received chunk is a message.", ["protocol"])
+relayed_bytes = Counter("switchboard_relayed_bytes_total", "Bytes relayed between paired connections.", ["protocol"])
+deflate_messages = Counter("switchboard_deflate_messages_total", "Websocket messages compressed, decompressed or passed on compressed without decompressing.", ["action"])
+relay_dropped_messages = Counter("switchboard_relay_dropped_messages_total", "Messages dropped because the send queue of a connection was full.")
+relay_dropped_bytes = Counter("switchboard_relay_dropped_bytes_total", "Bytes of the messages dropped because the send queue of a connection was full.")
+relay_queued_messages = CallbackGauge("switchboard_relay_queued_messages", "Messages waiting in the send queues of open connections (threaded engine).")
+relay_queued_bytes = CallbackGauge("switchboard_relay_queued_bytes", "Bytes waiting in the send queues of open connections (threaded engine).")
+relay_queue_peak_bytes = CallbackGauge("switchboard_relay_queue_peak_bytes", "Most bytes that were queued at once in the send queue of an open connection (threaded engine).")
+connect_requests = Counter("switchboard_connect_requests_total", "Upgrade requests to /game/connect/[key] by result.", ["result"])
+pairing_wait_seconds = Histogram("switchboard_pairing_wait_seconds", "Time a client waited for a master connection before it was paired.", [0.0001, 0.001, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0])
+session_not_found = Counter("switchboard_session_not_found_total", "Requests for a game key that is not registered, by endpoint: connect (upgrades of /game/connect/[key]), info (GET of /game/connect/[key]), master and trace (/admin/trace/[key]).", ["endpoint"])
+connections = Gauge("switchboard_connections", "Open upgraded connections.", ["role", "protocol"])
+lobby_watch_messages = Counter("switchboard_lobby_watch_messages_total", "Messages send to /game/watch websockets, by event.", ["event"])
+multiplexed_channels = Gauge("switchboard_multiplexed_channels", "Open client channels on multiplexed master connections.")
+waiting_masters = CallbackGauge("switchboard_waiting_masters", "Master connections waiting for a client.", ["protocol"])
+sessions = CallbackGauge("switchboard_sessions", "Registered game sessions.", ["game_name"])
+sessions_expired = Counter("switchboard_sessions_expired_total", "Game sessions removed because they timed out.")
+sessions_restored = Counter("switchboard_sessions_restored_total", "Game sessions restored from the session log at startup.")
+admission_refused = Counter("switchboard_admission_refused_total", "Requests refused by admission control, by endpoint class and the limit that was reached.", ["endpoint", "reason"])
+admitted_connections = CallbackGauge("switchboard_admitted_connections", "Connections that hold a slot of admission control: paired clients (relay) and masters.", ["role"])
+static_responses = Counter("switchboard_static_responses_total", "Responses for static files, by how they were served: from memory, with sendfile or not_modified.", ["result"])
+buffer_pool_bytes = CallbackGauge("switchboard_buffer_pool_bytes", "Bytes of pooled receive buffers that are in use by a connection, free, or free but still referenced by a send queue (in_flight, part of free).", ["state"])
+event_loop_lag_seconds = Histogram("switchboard_event_loop_lag_seconds", "How late the event loop of the asyncio engine ran a timer, a blocked loop delays all of its connections.", [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0])
+keepalive_round_seconds = CallbackGauge("switchboard_keepalive_round_seconds", "Time spend on the last full round of keepalive pings over all websocket and raw connections.")
+keepalive_round_pings = CallbackGauge("switchboard_keepalive_round_pings", "Pings send in the last full keepalive round.")
+keepalive_round_timeouts = CallbackGauge("switchboard_keepalive_round_timeouts", "Connections closed for being idle too long in the last full keepalive round.")
+lock_wait_seconds = Counter("switchboard_lock_wait_seconds_total", "Time spend waiting for locks that were held by another thread.", ["lock"])
+lock_contentions = Counter("switchboard_lock_contentions_total", "Number of times a lock was held by another thread when it was needed.", ["lock"])
@@ -0,0 +1,182 @@
+import struct
+import threading
+import itertools
+
+import websocketParse
+import metrics
+
+## Multiplexed master connections.
+#   A master that connects to /game/master with a "Game-Multiplex: 1" header serves all clients of its session over that single
+#   connection, instead of keeping a master connection waiting for every client that may join. Every client that connects gets
+#   a channel on the multiplexed master, and everything between them is tagged with the id of that channel.
+#   Over a websocket every message between the switchboard and the master is a binary message that starts with a 5 byte header:
+#   the channel id (uint32) and the event (uint8), followed by the payload. Over a raw connection every packet has a 9 byte
+#   header: the channel id (uint32), the event (uint8) and the length of the payload (uint32), followed by the payload.
+#   All numbers are big endian. Events:
+#       - open (0): Switchboard to master, a client connected on this channel. Replaces "CLIENT_CONNECTED" and the 4 zero bytes of a raw master.
+#       - close (1): Both ways, the client of the channel disconnected, or the master wants the client to be disconnected.
+#       - text (2) / binary (3): A message to or from the client of the channel. Text is only used for text messages of websocket clients.
+#   Multiplexed websocket masters only serve websocket clients, and raw masters only raw clients.
+#   All channels share the master connection, so a client that is not reading pauses the master for all channels with the "pause" send queue policy.
+
+event_open = 0
+event_close = 1
+event_text = 2
+event_binary = 3
+
+websocket_header = struct.Struct("!IB")
+raw_header = struct.Struct("!IBI")
+
+# Opcodes of the websocket messages to and from clients for the text and binary events.
+_opcodes = {event_text: websocketParse.opcode_text, event_binary: websocketParse.opcode_binary}
+
+channels_metric = metrics.multiplexed_channels
+
+
+## Check if a /game/master request asks for a multiplexed master.
+def isRequested(headers):
+    return headers.get("Game-Multiplex", "").strip() == "1"
+
+
+class Multiplexer:
+    # Largest payload of a raw packet from the master, a larger length means the stream is corrupt.
+    max_packet_size = 16 * 1024 * 1024
+
+    ## master is the connection of the master, protocol is "websocket" or "raw".
+    def __init__(self, master, protocol):
+        self.master = master
+        self.protocol = protocol
+        self.__lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+        self.__channels = {}
+        self.__ids = itertools.count(1)
+        # Received raw data that does not form a complete packet yet.
+        self.__stream = bytearray()
+
+    def isRelayClosed(self):
+        return self.master.isRelayClosed()
+
+    ## Get a new channel for a client. The master only learns about it when the channel is opened, see Channel.open.
+    def newChannel(self):
+        return Channel(self, next(self.__ids) & 0xFFFFFFFF)
+
+    ## Send a message from the client of a channel to the master, nothing is send when the channel is closed.
+    def sendMessage(self, channel_id, opcode, payload):
+        if channel_id in self.__channels:
+            self.send(channel_id, event_text if opcode == websocketParse.opcode_text else event_binary, payload)
+
+    def isOpen(self, channel_id):
+        return channel_id in self.__channels and not self.master.isRelayClosed()
+
+    def send(self, channel_id, event, payload=b""):
+        if self.protocol == "websocket":
+            self.master.websocket_send(websocket_header.pack(channel_id, event) + payload, websocketParse.opcode_binary)
+        else:
+            # Raw sends from different client threads must not interleave, a websocket master takes care of that itself.
+            with self.__send_lock:
+                self.master.rawsocket_send(raw_header.pack(channel_id, event, len(payload)) + payload)
+
+    ## Parse a websocket message of the master. Returns a list of (client, opcode, payload) to relay, close events are handled here.
+    #   Raises ValueError when the message is not a valid multiplexed message.
+    def parseMessage(self, message):
+        if len(message) < websocket_header.size:
+            raise ValueError("Multiplexed message without header")
+        channel_id, event = websocket_header.unpack_from(message)
+        return self.__handleEvent(channel_id, event, message[websocket_header.size:])
+
+    ## Parse a chunk of the raw stream of the master. Returns a list of (client, opcode, payload) to relay, close events are handled here.
+    #   Raises ValueError when the stream is corrupt.
+    def parseStream(self, data):
+        stream = self.__stream
+        stream += data
+        result = []
+        offset = 0
+        while len(stream) - offset >= raw_header.size:
+            channel_id, event, length = raw_header.unpack_from(stream, offset)
+            if length > self.max_packet_size:
+                raise ValueError("Multiplexed packet too large")
+            end = offset + raw_header.size + length
+            if end > len(stream):
+                break
+            result += self.__handleEvent(channel_id, event, bytes(stream[offset + raw_header.size:end]))
+            offset = end
+        del stream[:offset]
+        return result
+
+    def __handleEvent(self, channel_id, event, payload):
+        channel = self.__channels.get(channel_id)
+        if event == event_close:
+            if channel is not None and self.channelClosed(channel, False):
+                channel.other.closeRelay()
+            return []
+        if event not in _opcodes:
+            raise ValueError("Unknown multiplex event %d" % (event))
+        if channel is None or channel.other is None:
+            return []   # The client is already gone, the master will get the close event.
+        return [(channel.other, _opcodes[event], payload)]
+
+    def channelOpened(self, channel):
+        with self.__lock:
+            self.__channels[channel.id] = channel
+        channels_metric.inc()
+        self.send(channel.id, event_open)
+
+    ## Remove a channel, returns False when it was already removed. With notify the master gets a close event.
+    def channelClosed(self, channel, notify):
+        with self.__lock:
+            if self.__channels.pop(channel.id, None) is None:
+                return False
+        channels_metric.dec()
+        if notify and not self.master.isRelayClosed():
+            self.send(channel.id, event_close)
+        return True
+
+    ## Disconnect the clients of all channels, for when the master connection is closed.
+    def closeAll(self):
+        with self.__lock:
+            channels = list(self.__channels.values())
+        for channel in channels:
+            if self.channelClosed(channel, False) and channel.other is not None:
+                channel.other.closeRelay()
+
+
+## Stand in for the master connection of a client that is connected to a multiplexed master.
+#   The client uses it as it would use a master connection of its own (as its "other"), it only offers what the
+#   relaying needs and is never a websocket or raw peer, so nothing bypasses the channel header.
+class Channel:
+    __slots__ = ("__multiplexer", "id", "other")
+
+    def __init__(self, multiplexer, channel_id):
+        self.__multiplexer = multiplexer
+        self.id = channel_id
+        self.other = None
+
+    ## Tell the master about the client, to be called once the client connection is upgraded.
+    def open(self):
+        self.__multiplexer.channelOpened(self)
+
+    def websocket_send(self, message, opcode=websocketParse.opcode_text):
+        self.__multiplexer.sendMessage(self.id, opcode, message)
+
+    def rawsocket_send(self, message):
+        self.__multiplexer.sendMessage(self.id, websocketParse.opcode_binary, message)
+
+    ## Backpressure of the asyncio engine, applies to the master connection.
+    async def reserveSend(self, message, policy):
+        return await self.__multiplexer.master.reserveSend(message, policy)
+
+    ## Relay tracing of the asyncio engine, the message is written by the master connection.
+    def traceSent(self, key, received):
+        self.__multiplexer.master.traceSent(key, received)
+
+    def is_websocket(self):
+        return False
+
+    def is_raw(self):
+        return False
+
+    def closeRelay(self):
+        self.__multiplexer.channelClosed(self, True)
+
+    def isRelayClosed(self):
+        return not self.__multiplexer.isOpen(self.id)
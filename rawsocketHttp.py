@@ -1,15 +1,36 @@
 import threading
 import http
-import base64
-import hashlib
-import threading
 import time
+import os
+import select
+
+import sendQueue
+import bufferPool
+import metrics
+import relayTrace
+
+relayed_messages_metric = metrics.relayed_messages.labels("raw")
+relayed_bytes_metric = metrics.relayed_bytes.labels("raw")
 
 
 class RawsocketMixin:
+    # How raw connections that are paired to another raw connection relay their data:
+    #   "splice": Move data between the sockets inside the kernel with os.splice, only available on linux, otherwise "copy" is used.
+    #   "copy": Receive into a reused buffer and send it directly to the other socket.
+    #   "message": Pass every received chunk trough rawsocket_MESSAGE.
+    rawsocket_relay_mode = "splice"
+    rawsocket_relay_size = 64 * 1024
+    # When larger than 0, everything send with rawsocket_send goes trough a sendQueue.SendQueue of this many bytes with its own writer thread.
+    #   A raw stream cannot lose data, so the "drop_oldest" policy disconnects instead.
+    send_queue_size = 0
+    send_queue_policy = "pause"
+    # Game key under which the messages relayed by this connection are traced, see relayTrace.
+    trace_key = None
+
     def __init__(self, *args):
-        super().__init__(*args)
         self.__is_raw = False
+        self.send_queue = None
+        super().__init__(*args)
 
     def parse_request(self):
         if not super().parse_request():
@@ -27,6 +48,7 @@ class RawsocketMixin:
             self.send_header("Cache-Control", "No-Store")
             self.end_headers()
             self.close_connection = True
+            self.headers = None
             
             self.__handle_rawsocket()
             return False
@@ -35,23 +57,124 @@ class RawsocketMixin:
     def __handle_rawsocket(self):
         self.__lock = threading.Lock()
         self.connection.settimeout(60.0 * 60.0)
+        if self.send_queue_size > 0:
+            policy = "disconnect" if self.send_queue_policy == "drop_oldest" else self.send_queue_policy
+            self.send_queue = sendQueue.SendQueue(self.connection, self.send_queue_size, policy)
         self.__is_raw = True
+        receive_buffer = bufferPool.ReceiveBuffer(bufferPool.pool)
         self.rawsocket_OPEN()
         try:
             while not self.rfile.closed:
-                message = self.connection.recv(4096)
-                if message == b"":
+                # A traced relay needs to see every message, so it uses the message mode while it is traced.
+                if self.rawsocket_relay_mode != "message" and not (relayTrace.traces and relayTrace.isTraced(self.trace_key)):
+                    peer = self.rawsocket_PEER()
+                    if peer is not None:
+                        # We are going to write to the socket of the peer directly, so anything still queued for it needs to go first.
+                        if peer.send_queue is not None:
+                            peer.send_queue.flush()
+                        if self.rawsocket_relay_mode == "splice" and hasattr(os, "splice"):
+                            self.__spliceRelay(peer)
+                        else:
+                            self.__copyRelay(peer)
+                        return
+                # The message is a view of the receive buffer, which is reused for the next receive once the peer no longer references it.
+                message = None
+                view = receive_buffer.get(receive_buffer.receive_size)
+                count = self.connection.recv_into(view)
+                if count == 0:
                     return
+                receive_buffer.observe(count)
+                traced = relayTrace.traces and relayTrace.beginRelay(self.trace_key, time.monotonic())
+                message = view[:count]
+                view = None
                 self.rawsocket_MESSAGE(message)
+                if traced:
+                    relayTrace.endRelay()
         except IOError:
             pass    # We can pretty much except an IOError at some point because the other side will close the connection, or we will get a timeout.
         finally:
+            receive_buffer.close()
+            if self.send_queue is not None:
+                self.send_queue.close()
             self.rawsocket_CLOSE()
             self.__is_raw = False
 
+    ## Relay everything we receive to the peer without the data ever entering python, using a pipe and os.splice.
+    #   The peer socket is dupped, so it stays valid for us even when the thread of the peer closes it.
+    def __spliceRelay(self, peer):
+        source = self.connection.fileno()
+        target = os.dup(peer.connection.fileno())
+        pipe_read, pipe_write = os.pipe()
+        poll = select.poll()
+        poll.register(source, select.POLLIN)
+        poll.register(target, select.POLLRDHUP)
+        timeout = self.connection.gettimeout()
+        timeout = None if timeout is None else timeout * 1000
+        flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        try:
+            while not self.rfile.closed:
+                if not self.__pollRelay(poll, source, target, timeout):
+                    return
+                try:
+                    count = os.splice(source, pipe_write, self.rawsocket_relay_size, flags=flags)
+                except BlockingIOError:
+                    continue
+                if count == 0:
+                    return
+                relayed_messages_metric.inc()
+                relayed_bytes_metric.inc(count)
+                while count > 0:
+                    try:
+                        count -= os.splice(pipe_read, target, count, flags=flags)
+                    except BlockingIOError:
+                        poll.modify(source, 0)
+                        poll.modify(target, select.POLLOUT | select.POLLRDHUP)
+                        if not self.__pollRelay(poll, target, target, timeout):
+                            return
+                        poll.modify(source, select.POLLIN)
+                        poll.modify(target, select.POLLRDHUP)
+        finally:
+            os.close(pipe_read)
+            os.close(pipe_write)
+            os.close(target)
+
+    ## Wait till the wanted fd is ready, returns False on a timeout or when the peer has hung up.
+    @staticmethod
+    def __pollRelay(poll, wanted, target, timeout):
+        events = poll.poll(timeout)
+        if not events:
+            return False
+        for fd, event in events:
+            if fd == target and event & (select.POLLRDHUP | select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                return False
+        return any(fd == wanted for fd, event in events)
+
+    ## Fallback for when splice is not available, receive into a single buffer and directly send that to the peer.
+    def __copyRelay(self, peer):
+        buffer = bufferPool.pool.acquire(self.rawsocket_relay_size)
+        view = memoryview(buffer)
+        try:
+            while not self.rfile.closed:
+                count = self.connection.recv_into(buffer)
+                if count == 0:
+                    return
+                relayed_messages_metric.inc()
+                relayed_bytes_metric.inc(count)
+                peer.connection.sendall(view[:count])
+        finally:
+            view.release()
+            bufferPool.pool.release(buffer)
+
+    ## Return the raw connection that this connection relays to, which allows the data to bypass rawsocket_MESSAGE.
+    #   None if there is no such peer, in which case all data is passed to rawsocket_MESSAGE.
+    def rawsocket_PEER(self):
+        return None
+
     def is_raw(self):
         return self.__is_raw
 
     def rawsocket_send(self, message):
-        if not self.wfile.closed:
+        if self.send_queue is not None:
+            self.send_queue.put([message])
+        elif not self.wfile.closed:
             self.wfile.write(message)
@@ -0,0 +1,183 @@
+import bisect
+import collections
+import threading
+import time
+
+## Relay latency tracing of single sessions, started and read trough the admin API (see adminApi).
+#   While a game key is traced, every message relayed by one of the connections of that session is timed from the moment it
+#   was received (the last frame of a websocket message, or a chunk of a raw stream), with a histogram for each of:
+#       - handoff: till it was handed to the other side, written to its socket or put in its send queue or transport buffer.
+#       - sent: till it was written to the socket of the other side, so including the time it waited behind earlier messages.
+#   The threaded engine marks the message that a thread is relaying with beginRelay, a sendQueue.SendQueue that gets it takes
+#   the mark along and reports when it is written. Messages that are written directly, or collected by a frameBatch.FrameBatch,
+#   count as sent when they are handed off. The asyncio engine reports a message as sent once the transport of the other side
+#   has no buffered data left, which under a constant stream of data can be later than the message itself was written.
+#   Relaying checks the traces dict before anything else, so while nothing is traced this costs a single truth test per message.
+#   Raw relays that move their data with splice or copy (see rawsocketHttp) do not see single messages, while their session is
+#   traced they use the message mode instead. A raw relay that was already splicing when the trace started is not traced.
+#   With server_workers a session is only traced in its home worker, the admin API requests for a trace are routed there.
+
+# Upper bounds of the histogram buckets, in seconds.
+buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Finished traces that are kept to be read after they ended.
+max_finished = 16
+
+# Running traces by game key. Only changed by start and stop, relaying only reads it.
+traces = {}
+_finished = collections.OrderedDict()
+_lock = threading.Lock()
+# The message that the current thread is relaying, as [key, received, queued], see beginRelay.
+_relaying = threading.local()
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    # Needs to be called with the lock of the trace held.
+    def observe(self, latency):
+        self.counts[bisect.bisect_left(buckets, latency)] += 1
+        self.sum += latency
+        if latency > self.max:
+            self.max = latency
+
+    # Needs to be called with the lock of the trace held.
+    def toJson(self):
+        histogram = []
+        total = 0
+        for bound, count in zip(buckets + (None,), self.counts):
+            total += count
+            histogram.append({"le": "+Inf" if bound is None else bound, "count": total})
+        return {"messages": total, "sum": self.sum, "max": self.max, "mean": self.sum / total if total else None, "histogram": histogram}
+
+
+class Trace:
+    def __init__(self, key, seconds):
+        self.key = key
+        self.started = time.monotonic()
+        self.expires = self.started + seconds
+        self.ended = None
+        self.__lock = threading.Lock()
+        self.__handoff = _Histogram()
+        self.__sent = _Histogram()
+
+    def recordHandoff(self, latency):
+        with self.__lock:
+            self.__handoff.observe(latency)
+
+    def recordSent(self, latency):
+        with self.__lock:
+            self.__sent.observe(latency)
+
+    ## State of the trace as json, with cumulative bucket counts like a Prometheus histogram.
+    def toJson(self):
+        now = time.monotonic()
+        end = self.expires if self.ended is None else self.ended
+        with self.__lock:
+            return {
+                "key": self.key,
+                "active": self.ended is None,
+                "elapsed": round(min(now, end) - self.started, 3),
+                "remaining": round(max(0.0, end - now), 3) if self.ended is None else 0.0,
+                "handoff": self.__handoff.toJson(),
+                "sent": self.__sent.toJson(),
+            }
+
+
+## Start tracing a game key for the given number of seconds, a trace that is already running for it is restarted.
+def start(key, seconds):
+    trace = Trace(key, seconds)
+    with _lock:
+        _finished.pop(key, None)
+        traces[key] = trace
+    # Make sure the trace is removed when it ends, even when its session does not relay anything anymore.
+    timer = threading.Timer(seconds, stop, (key, trace))
+    timer.daemon = True
+    timer.start()
+    return trace
+
+
+## Stop tracing a game key, the trace stays available with get. Returns None when the key was not traced.
+#   When only is given, the trace of the key is only stopped when it is still that trace.
+def stop(key, only=None):
+    with _lock:
+        trace = traces.get(key)
+        if trace is None or (only is not None and trace is not only):
+            return None
+        del traces[key]
+        trace.ended = min(time.monotonic(), trace.expires)
+        _finished[key] = trace
+        while len(_finished) > max_finished:
+            _finished.popitem(last=False)
+    return trace
+
+
+## Get the running or finished trace of a game key, or None.
+def get(key):
+    trace = traces.get(key)
+    if trace is not None and time.monotonic() >= trace.expires:
+        trace = stop(key, trace) or trace
+    if trace is None:
+        trace = _finished.get(key)
+    return trace
+
+
+def isTraced(key):
+    return key in traces
+
+
+# The running trace of a key, or None when it is not traced or its time is up.
+def _getRunning(key, now):
+    trace = traces.get(key)
+    if trace is not None and now >= trace.expires:
+        stop(key, trace)
+        return None
+    return trace
+
+
+## Record that a message of the session key, received at the time.monotonic() received, was handed to the other side.
+#   Returns False when the key is not traced. Only to be called when traces is not empty.
+def handedOff(key, received):
+    now = time.monotonic()
+    trace = _getRunning(key, now)
+    if trace is None:
+        return False
+    trace.recordHandoff(now - received)
+    return True
+
+
+## Record that a message of the session key, received at the time.monotonic() received, was written to the other side.
+def sent(key, received):
+    now = time.monotonic()
+    trace = _getRunning(key, now)
+    if trace is not None:
+        trace.recordSent(now - received)
+
+
+## Mark the message that the current thread is going to relay, for the threaded engine. Returns False when the key is not traced,
+#   otherwise endRelay needs to be called once it is relayed. Only to be called when traces is not empty.
+def beginRelay(key, received):
+    if key not in traces:
+        return False
+    _relaying.message = [key, received, False]
+    return True
+
+
+## Take the mark of the message that the current thread is relaying, for a send queue that reports when it is written with sent.
+#   Returns (key, received), or None when the thread is not relaying a traced message.
+def takeRelay():
+    message = getattr(_relaying, "message", None)
+    if message is None:
+        return None
+    message[2] = True
+    return message[0], message[1]
+
+
+## The message marked with beginRelay is handed off, when no send queue took it, it has been written as well.
+def endRelay():
+    key, received, queued = _relaying.message
+    _relaying.message = None
+    if handedOff(key, received) and not queued:
+        sent(key, received)
@@ -0,0 +1,196 @@
+import threading
+import collections
+import time
+import socket
+import weakref
+
+import websocketParse
+import metrics
+import relayTrace
+
+# Non blocking sends for a single call are not available everywhere, without them control messages start the writer thread as well.
+can_write_directly = hasattr(socket, "MSG_DONTWAIT")
+
+# Send queues of this process that are not closed, for the metrics.
+_queues = weakref.WeakSet()
+_queues_lock = threading.Lock()
+
+
+## Bounded outbound queue of a single connection, drained to the socket by its own writer thread.
+#   This decouples the reader thread of a peer from the speed of this connection, one slow client can no longer freeze the
+#   reader of its master. All writes to the socket need to go trough the queue once it exists, as the writer thread could
+#   be in the middle of a write at any time.
+#   When the queue is full, the policy decides what happens to new messages:
+#       - "pause": The putting thread blocks till there is room, which stops reading from the peer.
+#       - "drop_oldest": The oldest queued messages are dropped to make room.
+#       - "disconnect": The connection is closed.
+#   Everything the writer finds in the queue is send with a single sendmsg call. With a batch_latency the writer waits up to that
+#   long for more messages before writing, unless batch_size bytes are already queued.
+#   The writer thread is only started for the first message that is not a control message. Till then control messages are
+#   written directly when the socket can take them without blocking, so an idle connection that only gets pings has no thread.
+#   Messages of a traced relay (see relayTrace) are reported by the writer thread once they are written.
+#   The queued data of all open queues and the dropped messages are shown on /metrics.
+class SendQueue:
+    POLICIES = ("pause", "drop_oldest", "disconnect")
+    close_timeout = 5.0
+
+    def __init__(self, sock, max_size, policy="pause", batch_latency=0.0, batch_size=16 * 1024):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown send queue policy: %s" % (policy))
+        self.__socket = sock
+        self.__condition = threading.Condition()
+        self.__messages = collections.deque()
+        self.__closed = False
+        self.__writing = False
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_latency = batch_latency
+        self.batch_size = batch_size
+        # Statistics
+        self.size = 0
+        self.max_size_seen = 0
+        self.__thread = None
+        with _queues_lock:
+            _queues.add(self)
+
+    ## Number of messages waiting to be written.
+    @property
+    def depth(self):
+        return len(self.__messages)
+
+    ## Queue a message, given as a list of buffers. Returns False when the message was not queued.
+    #   Control messages (pings/pongs) are small and never subject to the size limit.
+    def put(self, buffers, control=False):
+        length = sum(len(buffer) for buffer in buffers)
+        traced = relayTrace.takeRelay() if relayTrace.traces and not control else None
+        with self.__condition:
+            if self.__closed:
+                return False
+            if not control and self.size + length > self.max_size and self.size > 0:
+                if self.policy == "pause":
+                    while not self.__closed and self.size + length > self.max_size and self.size > 0:
+                        self.__condition.wait()
+                    if self.__closed:
+                        return False
+                elif self.policy == "drop_oldest":
+                    while self.__messages and self.size + length > self.max_size:
+                        dropped = self.__messages.popleft()
+                        self.size -= dropped[0]
+                        metrics.relay_dropped_messages.inc()
+                        metrics.relay_dropped_bytes.inc(dropped[0])
+                else:
+                    metrics.relay_dropped_messages.inc()
+                    metrics.relay_dropped_bytes.inc(length)
+                    self.__fail()
+                    return False
+            if self.__thread is None:
+                if control and can_write_directly:
+                    buffers = self.__writeDirectly(buffers)
+                    if not buffers:
+                        return not self.__closed
+                    length = len(buffers[0])
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+            self.__messages.append((length, buffers, traced))
+            self.size += length
+            if self.size > self.max_size_seen:
+                self.max_size_seen = self.size
+            self.__condition.notify_all()
+        return True
+
+    ## Wait till everything queued so far has been written.
+    def flush(self):
+        with self.__condition:
+            while not self.__closed and (self.__messages or self.__writing):
+                self.__condition.wait()
+
+    ## Stop the queue. Messages that are still queued get a short time to be written, then the socket is shut down.
+    #   Must be called before the socket is closed, as the writer thread could still be using it.
+    def close(self):
+        with _queues_lock:
+            _queues.discard(self)
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+            if self.__thread is None:
+                return
+        self.__thread.join(self.close_timeout)
+        if self.__thread.is_alive():
+            self.__shutdown()
+            self.__thread.join()
+
+    # Needs to be called with the lock held, while there is no writer thread. Returns the part that could not be written.
+    def __writeDirectly(self, buffers):
+        data = b"".join(buffers)
+        try:
+            sent = self.__socket.send(data, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.__fail()
+            return []
+        return [data[sent:]] if sent < len(data) else []
+
+    def __fail(self):
+        self.__closed = True
+        self.__messages.clear()
+        self.size = 0
+        self.__condition.notify_all()
+        self.__shutdown()
+
+    def __shutdown(self):
+        try:
+            self.__socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__messages and not self.__closed:
+                    self.__condition.wait()
+                if self.batch_latency > 0 and not self.__closed and self.size < self.batch_size:
+                    deadline = time.monotonic() + self.batch_latency
+                    while not self.__closed and self.size < self.batch_size and time.monotonic() < deadline:
+                        self.__condition.wait(deadline - time.monotonic())
+                if not self.__messages:
+                    return
+                buffers = []
+                length = 0
+                traced = None
+                while self.__messages and len(buffers) < websocketParse.max_send_buffers:
+                    message_length, message_buffers, message_traced = self.__messages.popleft()
+                    length += message_length
+                    buffers += message_buffers
+                    if message_traced is not None:
+                        if traced is None:
+                            traced = []
+                        traced.append(message_traced)
+                self.__writing = True
+            try:
+                websocketParse.sendBuffers(self.__socket, buffers)
+            except OSError:
+                with self.__condition:
+                    self.__writing = False
+                    self.__fail()
+                return
+            if traced is not None:
+                for key, received in traced:
+                    relayTrace.sent(key, received)
+            # Do not keep the written buffers referenced while waiting for more, they can be pooled receive buffers of the peer.
+            buffers = message_buffers = None
+            with self.__condition:
+                self.__writing = False
+                self.size -= length
+                self.__condition.notify_all()
+
+
+## Queued messages and bytes, and the largest number of bytes queued at once, over all open send queues.
+def _getQueueTotals():
+    with _queues_lock:
+        queues = list(_queues)
+    return sum(queue.depth for queue in queues), sum(queue.size for queue in queues), max((queue.max_size_seen for queue in queues), default=0)
+
+metrics.relay_queued_messages.setCallback(lambda: {(): _getQueueTotals()[0]})
+metrics.relay_queued_bytes.setCallback(lambda: {(): _getQueueTotals()[1]})
+metrics.relay_queue_peak_bytes.setCallback(lambda: {(): _getQueueTotals()[2]})
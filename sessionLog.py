@@ -0,0 +1,217 @@
+import os
+import json
+import logging
+import threading
+import time
+
+import metrics
+from gameSession import GameSession
+
+## Append only log of the session registry on disk, so a restarted switchboard keeps all keys and secrets.
+#   Every line is a json object, {"add": record} (see GameSession.toRecord) or {"remove": key}, the same messages that workerPool
+#   sends between processes. Lines are written with a single write on a file opened with O_APPEND, so a crash of the process never
+#   loses a line that was written, and can at most leave a partial last line, which is skipped when loading. The file is synced to
+#   disk every sync_interval seconds to survive a crash of the machine as well.
+#   When the log holds much more lines than there are sessions, it is compacted by writing the current sessions to a new file,
+#   which replaces the log.
+#   To keep startup time constant, the previous log is only renamed to [path].old at startup and loaded in the background.
+#   Until restored() is called, the new log only has the changes made since the start, so it is not compacted. When the
+#   process stops before that, the next start loads [path].old followed by [path].
+
+class SessionLog:
+    sync_interval = 1.0
+    # Compact when the log has more than compact_ratio lines per session, and at least min_compact_lines lines.
+    compact_ratio = 4
+    min_compact_lines = 1024
+
+    ## snapshot is called from a background thread to get the records of all current sessions when the log is compacted.
+    def __init__(self, path, snapshot):
+        self.path = path
+        self.__old_path = path + ".old"
+        self.__snapshot = snapshot
+        self.__lock = threading.Lock()
+        if os.path.exists(path) and not os.path.exists(self.__old_path):
+            os.rename(path, self.__old_path)
+        self.__fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        # Anything after this offset is written by this process, and already part of the registry.
+        self.__restore_size = os.fstat(self.__fd).st_size
+        self.__restoring = True
+        self.__dirty = False
+        self.__lines = 0
+        self.__sessions = 0
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def added(self, record):
+        self.__append({"add": record}, 1)
+
+    def removed(self, key):
+        self.__append({"remove": key}, -1)
+
+    ## Get the records of all sessions of the previous run, as a dict of key to record.
+    def load(self):
+        records = {}
+        for path, size in ((self.__old_path, None), (self.path, self.__restore_size)):
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            with f:
+                data = f.read() if size is None else f.read(size)
+            for line in data.split(b"\n"):
+                if not line:
+                    continue
+                try:
+                    message = json.loads(line.decode("utf-8"))
+                    if "add" in message:
+                        records[message["add"]["key"]] = message["add"]
+                    else:
+                        records.pop(message["remove"], None)
+                except (ValueError, TypeError, KeyError):
+                    logging.warning("Skipping damaged line in session log %s", path)
+        return records
+
+    ## Called once the sessions from load() are in the registry. Writes them to the log, after which the old log is no longer needed.
+    def restored(self):
+        self.compact()
+        with self.__lock:
+            self.__restoring = False
+        try:
+            os.unlink(self.__old_path)
+        except FileNotFoundError:
+            pass
+
+    ## Replace the log by the records of the current sessions.
+    #   Holds the lock while the snapshot is taken, so changes that are not part of the snapshot end up in the new log.
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with self.__lock:
+            records = self.__snapshot()
+            with open(tmp_path, "wb") as f:
+                for record in records:
+                    f.write(json.dumps({"add": record}).encode("utf-8") + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.__syncDirectory()
+            os.close(self.__fd)
+            self.__fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            self.__lines = self.__sessions = len(records)
+            self.__dirty = False
+
+    def __append(self, message, change):
+        line = json.dumps(message).encode("utf-8") + b"\n"
+        with self.__lock:
+            try:
+                os.write(self.__fd, line)
+            except OSError:
+                logging.exception("Failed to write to session log %s", self.path)
+                return
+            self.__lines += 1
+            self.__sessions += change
+            self.__dirty = True
+
+    def __needsCompaction(self):
+        with self.__lock:
+            return not self.__restoring and self.__lines > max(self.min_compact_lines, self.__sessions * self.compact_ratio)
+
+    def __syncDirectory(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                if self.__needsCompaction():
+                    self.compact()
+                with self.__lock:
+                    if self.__dirty:
+                        os.fsync(self.__fd)
+                        self.__dirty = False
+            except OSError:
+                logging.exception("Failed to sync session log %s", self.path)
+
+
+## Registry mixin that keeps the sessions in a SessionLog at session_log_path, to be mixed in before GameRegistryMixin.
+#   Sessions of the previous run are restored in the background with a new timeout, so the masters of those sessions can
+#   reconnect with their key and secret. A lookup of a key that is not found waits till the log is loaded, and restores
+#   that session right away when it is still waiting to be restored, so a master does not have to wait for all other sessions.
+#   Nothing is logged when session_log_path is None.
+class SessionLogMixin:
+    session_log_path = None
+    # Maximum time a lookup waits for the session log of the previous run to be loaded.
+    restore_wait = 5.0
+
+    def __init__(self, *args, **kwargs):
+        self.__loaded = threading.Event()
+        self.__session_log = None
+        # Records of the previous run that are not restored yet, by key.
+        self.__pending = {}
+        self.__restore_lock = threading.Lock()
+        if self.session_log_path is None:
+            self.__loaded.set()
+        else:
+            self.__session_log = SessionLog(self.session_log_path, self.__getRecords)
+        super().__init__(*args, **kwargs)
+        if self.__session_log is not None:
+            threading.Thread(target=self.__restore, daemon=True).start()
+
+    def addGame(self, game):
+        if not super().addGame(game):
+            return False
+        if self.__session_log is not None:
+            self.__session_log.added(game.toRecord())
+        return True
+
+    def gameRemoved(self, session):
+        super().gameRemoved(session)
+        if self.__session_log is not None:
+            self.__session_log.removed(session.key)
+
+    def findGame(self, game_key):
+        session = super().findGame(game_key)
+        if session is None and self.__session_log is not None:
+            if self.restore_wait > 0:
+                self.waitForRestore(self.restore_wait)
+            # Also look again when another thread restored it, which could have happened after the first lookup.
+            self.__restoreSession(game_key)
+            session = super().findGame(game_key)
+        return session
+
+    ## Check if the session log of the previous run is loaded, after which lookups no longer have to wait.
+    def isRestored(self):
+        return self.__loaded.is_set()
+
+    ## Block till the session log of the previous run is loaded, or timeout seconds have passed.
+    def waitForRestore(self, timeout):
+        return self.__loaded.wait(timeout)
+
+    def __getRecords(self):
+        return [session.toRecord() for session in list(self.game_sessions.values())]
+
+    # Can be called from any thread. The lock makes sure a lookup does not miss a session that another thread is restoring.
+    def __restoreSession(self, game_key):
+        with self.__restore_lock:
+            record = self.__pending.pop(game_key, None)
+            if record is None:
+                return False
+            try:
+                game = GameSession.fromRecord(record)
+            except TypeError:
+                return False
+            # Bypass the logging of addGame, as the session is already in the log. A session that got registered with the same key since the start wins.
+            if not super().addGame(game):
+                return False
+        metrics.sessions_restored.inc()
+        return True
+
+    def __restore(self):
+        self.__pending = self.__session_log.load()
+        self.__loaded.set()
+        logging.info("Restoring %d sessions from %s", len(self.__pending), self.session_log_path)
+        for game_key in list(self.__pending):
+            self.__restoreSession(game_key)
+        self.__session_log.restored()
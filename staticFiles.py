@@ -0,0 +1,213 @@
+import os
+import time
+import gzip
+import http
+import threading
+import mimetypes
+import email.utils
+import urllib.parse
+
+import metrics
+from lobbyCache import LobbyCache
+
+## Static files of the browser lobby, served from a directory tree (www/ by default).
+#   Files up to max_file_size are kept in memory, together with a gzip compressed copy for compressible types, so serving
+#   them costs no file system access at all. Larger files are send with sendfile by the caller. A precompressed [file].gz next
+#   to a file is used as its gzip variant, so large assets can be compressed at build time.
+#   Cached files are checked for changes with a stat at most every check_interval seconds.
+#   Every response has an ETag and Last-Modified, and If-None-Match and If-Modified-Since are answered with a 304.
+#   Shared by the threaded and asyncio server engines, the caller sends the StaticResponse that serve returns.
+
+compressible_types = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+
+class StaticResponse:
+    def __init__(self, status, headers, body=b"", file=None, length=None):
+        self.status = status
+        self.headers = headers
+        # Either body is the content, or file is an open file of which the first length bytes are the content.
+        self.body = body
+        self.file = file
+        self.length = len(body) if length is None else length
+
+
+class _Entry:
+    def __init__(self, path, stat, content_type):
+        self.path = path
+        self.stat_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.mtime = int(stat.st_mtime)
+        self.etag = "\"%x-%x\"" % (stat.st_mtime_ns, stat.st_size)
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        self.content_type = content_type
+        self.body = None
+        self.gzip_body = None
+        self.gzip_path = None
+        self.checked = time.monotonic()
+
+    @property
+    def has_gzip(self):
+        return self.gzip_body is not None or self.gzip_path is not None
+
+    @property
+    def gzip_etag(self):
+        return self.etag[:-1] + "-gzip\""
+
+    @property
+    def cached_bytes(self):
+        return len(self.body or b"") + len(self.gzip_body or b"")
+
+
+def _acceptsGzip(accept_encoding):
+    if accept_encoding is None:
+        return False
+    for coding in accept_encoding.split(","):
+        name, _, parameters = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            parameter, _, value = parameters.partition("=")
+            try:
+                return parameter.strip() != "q" or float(value) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def _notModified(request_headers, etag, mtime):
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match is not None:
+        return LobbyCache.matchesETag(if_none_match, etag)
+    if_modified_since = request_headers.get("If-Modified-Since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError, IndexError):
+        return False
+    if since is None or since.tzinfo is None:
+        return False
+    return mtime <= since.timestamp()
+
+
+class StaticFiles:
+    index = "index.html"
+    check_interval = 1.0
+    # Files up to this size are kept in memory, as long as all cached files together stay below max_cache_bytes.
+    max_file_size = 256 * 1024
+    gzip_level = 9
+
+    def __init__(self, root, max_age=0, max_cache_bytes=16 * 1024 * 1024):
+        self.root = os.path.realpath(root)
+        self.cache_control = "max-age=%d" % (max_age) if max_age > 0 else "no-cache"
+        self.max_cache_bytes = max_cache_bytes
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__cached_bytes = 0
+
+    ## Check if serve can answer a request for url_path without touching the file system.
+    def isCached(self, url_path):
+        entry = self.__entries.get(self.__relativePath(url_path))
+        return entry is not None and entry.body is not None and time.monotonic() - entry.checked < self.check_interval
+
+    ## Get the StaticResponse for a GET of url_path, or None when there is no such file.
+    def serve(self, url_path, request_headers):
+        relative_path = self.__relativePath(url_path)
+        if relative_path is None:
+            return None
+        entry = self.__getEntry(relative_path)
+        if entry is None:
+            if relative_path and os.path.isdir(os.path.join(self.root, relative_path)):
+                location = urllib.parse.urlsplit(url_path).path + "/"
+                return StaticResponse(http.HTTPStatus.MOVED_PERMANENTLY, [("Location", location)])
+            return None
+        use_gzip = entry.has_gzip and _acceptsGzip(request_headers.get("Accept-Encoding"))
+        etag = entry.gzip_etag if use_gzip else entry.etag
+        headers = [("ETag", etag), ("Last-Modified", entry.last_modified), ("Cache-Control", self.cache_control)]
+        if entry.has_gzip:
+            headers.append(("Vary", "Accept-Encoding"))
+        if _notModified(request_headers, etag, entry.mtime):
+            metrics.static_responses.labels("not_modified").inc()
+            return StaticResponse(http.HTTPStatus.NOT_MODIFIED, headers)
+        headers.append(("Content-Type", entry.content_type))
+        if use_gzip:
+            headers.append(("Content-Encoding", "gzip"))
+        body = entry.gzip_body if use_gzip else entry.body
+        if body is not None:
+            metrics.static_responses.labels("memory").inc()
+            return StaticResponse(http.HTTPStatus.OK, headers, body)
+        try:
+            f = open(entry.gzip_path if use_gzip else entry.path, "rb")
+        except OSError:
+            return None
+        metrics.static_responses.labels("sendfile").inc()
+        return StaticResponse(http.HTTPStatus.OK, headers, None, f, os.fstat(f.fileno()).st_size)
+
+    # Path of the file below root, or None for paths that can never be served, like hidden files.
+    def __relativePath(self, url_path):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(url_path).path)
+        parts = [part for part in path.split("/") if part]
+        for part in parts:
+            if part.startswith(".") or "\\" in part or "\0" in part:
+                return None
+        if not parts or path.endswith("/"):
+            parts.append(self.index)
+        return "/".join(parts)
+
+    def __getEntry(self, relative_path):
+        entry = self.__entries.get(relative_path)
+        if entry is not None and time.monotonic() - entry.checked < self.check_interval:
+            return entry
+        path = os.path.join(self.root, relative_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if stat is None or not os.path.isfile(path) or not os.path.realpath(path).startswith(self.root + os.sep):
+            if entry is not None:
+                self.__setEntry(relative_path, None)
+            return None
+        if entry is not None and entry.stat_key == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            entry.checked = time.monotonic()
+            return entry
+        entry = self.__load(path, stat)
+        self.__setEntry(relative_path, entry)
+        return entry
+
+    def __load(self, path, stat):
+        content_type, encoding = mimetypes.guess_type(path)
+        if content_type is None or encoding is not None:
+            content_type = "application/octet-stream"
+        elif content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+        entry = _Entry(path, stat, content_type)
+        try:
+            gzip_stat = os.stat(path + ".gz")
+            if gzip_stat.st_mtime_ns >= stat.st_mtime_ns:
+                entry.gzip_path = path + ".gz"
+        except OSError:
+            pass
+        if stat.st_size > self.max_file_size or self.__cached_bytes + stat.st_size > self.max_cache_bytes:
+            return entry
+        try:
+            with open(path, "rb") as f:
+                entry.body = f.read()
+            if entry.gzip_path is not None:
+                with open(entry.gzip_path, "rb") as f:
+                    entry.gzip_body = f.read()
+            elif content_type.startswith(compressible_types):
+                compressed = gzip.compress(entry.body, self.gzip_level, mtime=0)
+                if len(compressed) < len(entry.body):
+                    entry.gzip_body = compressed
+        except OSError:
+            entry.body = entry.gzip_body = None
+        # The file could have changed while reading it, the next check will notice that and load it again.
+        if entry.body is not None and len(entry.body) != stat.st_size:
+            entry.checked = 0.0
+        return entry
+
+    def __setEntry(self, relative_path, entry):
+        with self.__lock:
+            old = self.__entries.pop(relative_path, None)
+            if old is not None:
+                self.__cached_bytes -= old.cached_bytes
+            if entry is not None:
+                self.__entries[relative_path] = entry
+                self.__cached_bytes += entry.cached_bytes
@@ -0,0 +1,209 @@
+import zlib
+
+## permessage-deflate websocket extension (RFC 7692).
+#   The switchboard is the websocket server for both the master and the client side of a relay, so every connection compresses what
+#   it sends with the server_* parameters and decompresses what it receives with the client_* parameters.
+#   Compressed messages do not have to be decompressed and compressed again when they can be relayed as they are, see canPassTo.
+
+extension_name = "permessage-deflate"
+# Every compressed message ends with an empty stored block, which is removed from the payload on the wire.
+message_tail = b"\x00\x00\xff\xff"
+# zlib does not support a raw deflate window of 8 bits for compression, so we do not negotiate it at all.
+min_window_bits = 9
+max_window_bits = 15
+
+
+## Split a Sec-WebSocket-Extensions header into a list of (name, {parameter: value}) offers.
+#   Parameters without a value have None as value. Returns None when the header cannot be parsed.
+def parseExtensions(header):
+    offers = []
+    for extension in header.split(","):
+        parts = [part.strip() for part in extension.split(";")]
+        if not parts[0]:
+            continue
+        parameters = {}
+        for part in parts[1:]:
+            key, sep, value = part.partition("=")
+            key = key.strip()
+            if not key or key in parameters:
+                return None
+            parameters[key] = value.strip().strip("\"") if sep else None
+        offers.append((parts[0], parameters))
+    return offers
+
+
+def _windowBits(value):
+    try:
+        bits = int(value)
+    except (TypeError, ValueError):
+        return None
+    if bits < 8 or bits > max_window_bits or str(bits) != value:
+        return None
+    return bits
+
+
+## Pick the first permessage-deflate offer from a Sec-WebSocket-Extensions header that we can accept.
+#   window_bits bounds the windows of both the compressor and the decompressor of the connection, and without context_takeover
+#   no compression state is kept between messages at all. Together those bound the memory a connection can use.
+#   Returns a PerMessageDeflate, of which the response attribute is the value for the Sec-WebSocket-Extensions response header,
+#   or None when there is no acceptable offer.
+def negotiate(header, window_bits=max_window_bits, context_takeover=True):
+    window_bits = max(min_window_bits, min(window_bits, max_window_bits))
+    offers = parseExtensions(header)
+    if offers is None:
+        return None
+    for name, parameters in offers:
+        if name.lower() != extension_name:
+            continue
+        deflate = _negotiateOffer(parameters, window_bits, context_takeover)
+        if deflate is not None:
+            return deflate
+    return None
+
+
+def _negotiateOffer(parameters, window_bits, context_takeover):
+    response = [extension_name]
+    server_no_context_takeover = not context_takeover
+    client_no_context_takeover = not context_takeover
+    # Our compressor window, and the window of the decompressor of the peer.
+    compress_bits = window_bits
+    peer_decompress_bits = max_window_bits
+    # The largest window the peer may compress with, so what our decompressor needs.
+    decompress_bits = max_window_bits
+    for key, value in parameters.items():
+        if key == "server_no_context_takeover" and value is None:
+            server_no_context_takeover = True
+        elif key == "client_no_context_takeover" and value is None:
+            client_no_context_takeover = True
+        elif key == "server_max_window_bits":
+            bits = _windowBits(value)
+            if bits is None or bits < min_window_bits:
+                return None
+            compress_bits = min(compress_bits, bits)
+            peer_decompress_bits = compress_bits
+            response.append("server_max_window_bits=%d" % (compress_bits))
+        elif key == "client_max_window_bits":
+            if value is not None:
+                bits = _windowBits(value)
+                if bits is None:
+                    return None
+                decompress_bits = bits
+            decompress_bits = min(decompress_bits, window_bits)
+            if decompress_bits < max_window_bits:
+                response.append("client_max_window_bits=%d" % (decompress_bits))
+        else:
+            return None
+    if decompress_bits > window_bits:
+        # Without client_max_window_bits in the offer we cannot limit the window of the peer, and so not our memory use.
+        return None
+    if server_no_context_takeover:
+        response.append("server_no_context_takeover")
+    if client_no_context_takeover:
+        response.append("client_no_context_takeover")
+    deflate = PerMessageDeflate(compress_bits, decompress_bits, peer_decompress_bits, server_no_context_takeover, client_no_context_takeover)
+    deflate.response = "; ".join(response)
+    return deflate
+
+
+## Negotiated permessage-deflate state of a single connection.
+#   Not thread safe, compress is only to be used while holding the send lock of the connection,
+#   decompress only from the thread that reads the connection.
+class PerMessageDeflate:
+    compress_level = 6
+    # Messages smaller than this are not worth compressing.
+    min_compress_size = 64
+
+    def __init__(self, compress_bits, decompress_bits, peer_decompress_bits, server_no_context_takeover, client_no_context_takeover):
+        self.compress_bits = compress_bits
+        self.decompress_bits = decompress_bits
+        self.peer_decompress_bits = peer_decompress_bits
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.response = None
+        self.__compressor = None
+        self.__decompressor = None
+        # Number of compressed messages received from and send to the peer, the peer keeps the same history in its own (de)compressor.
+        self.received_count = 0
+        self.send_count = 0
+        # The connection that all compressed messages received so far are passed to unchanged, see canPassTo.
+        self.__passthrough_target = None
+        # When messages compressed by someone else have been passed to the peer, the history of the decompressor of the peer no
+        # longer matches our compressor, so from then on every message we compress ourselves has to stand on its own.
+        self.__self_contained = server_no_context_takeover
+        # Once messages with context takeover are passed to the peer, its decompressor follows the history of the sender,
+        # so anything we send ourselves has to go uncompressed.
+        self.__compress_own = True
+        self.__lossy = False
+
+    ## Messages send to the peer can be dropped (see the drop_oldest send queue policy), so the peer can not rely on any history.
+    def setLossy(self):
+        self.__lossy = True
+        self.__self_contained = True
+        self.__compressor = None
+
+    def shouldCompress(self, message):
+        return self.__compress_own and len(message) >= self.min_compress_size
+
+    def compress(self, message):
+        compressor = self.__compressor
+        if compressor is None or self.__self_contained:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -self.compress_bits)
+            if not self.__self_contained:
+                self.__compressor = compressor
+        data = compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.send_count += 1
+        if data.endswith(message_tail):
+            return data[:-4]
+        return data
+
+    ## Decompress a received message, raises zlib.error when the payload is not valid.
+    #   max_size (when not 0) limits the size of the decompressed message, None is returned when it is larger.
+    def decompress(self, payload, max_size=0):
+        decompressor = self.__decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-self.decompress_bits)
+            if not self.client_no_context_takeover:
+                self.__decompressor = decompressor
+        # The payload can be a memoryview of a receive buffer, which is not copied to append the tail to it.
+        message = decompressor.decompress(payload, max_size)
+        if not decompressor.unconsumed_tail:
+            message += decompressor.decompress(message_tail, max_size + 1 - len(message) if max_size else 0)
+        if decompressor.unconsumed_tail or (max_size and len(message) > max_size):
+            return None
+        self.received_count += 1
+        return message
+
+    ## Check if a compressed message received on this connection can be send unchanged to the peer of the target connection.
+    #   The decompressor on the other end must be able to handle the window of the sender, and the message has to either stand on its own
+    #   (the sender does not use context takeover), or the history of both streams has to be the same: every compressed message
+    #   of the sender has been passed to the target as is, and the target did not send any other compressed message.
+    #   Once a message is passed on with context takeover, all following compressed messages have to be passed on as well,
+    #   and the target no longer compresses anything itself.
+    def canPassTo(self, target):
+        if target is None or self.decompress_bits > target.peer_decompress_bits:
+            return False
+        if self.client_no_context_takeover:
+            return True
+        if target.isLossy():
+            return False
+        if self.__passthrough_target is target:
+            return True
+        return self.received_count == 0 and target.send_count == 0 and not target.server_no_context_takeover
+
+    def isLossy(self):
+        return self.__lossy
+
+    ## Record that a compressed message received on this connection was passed to target unchanged.
+    def passedTo(self, target):
+        self.received_count += 1
+        if not self.client_no_context_takeover:
+            self.__passthrough_target = target
+            target.__compress_own = False
+        # Our decompressor missed this message, so if it has history it can no longer be used.
+        self.__decompressor = None
+
+    ## Record that a message compressed by someone else is send to the peer of this connection.
+    def passedFrom(self):
+        self.send_count += 1
+        self.__self_contained = True
+        self.__compressor = None
@@ -1,26 +1,61 @@
 import websocketParse
+import websocketDeflate
+import keepalive
+import bufferPool
+import frameBatch
+import sendQueue
+import relayTrace
 import threading
 import http
-import base64
-import hashlib
-import threading
 import time
+import socket
+import struct
+import zlib
+
+import metrics
+
+
+compressed_metric = metrics.deflate_messages.labels("compressed")
+decompressed_metric = metrics.deflate_messages.labels("decompressed")
+passthrough_metric = metrics.deflate_messages.labels("passthrough")
+relayed_messages_metric = metrics.relayed_messages.labels("websocket")
+relayed_bytes_metric = metrics.relayed_bytes.labels("websocket")
 
 
 class WebsocketMixin:
     timeout = 60.0
-    __ping_thread = None
-    __active_websockets = set()
+    websocket_ping_interval = 5.0
+    # Close a websocket when nothing, not even a pong, has been received for this many seconds.
+    websocket_idle_timeout = 20.0
+    # Single scheduler that pings all websockets, created when the first websocket is opened.
+    keepalive_scheduler = None
+    __keepalive_lock = threading.Lock()
+    # When larger than 0, frames send with websocket_send are collected for at most this many seconds,
+    #   or till websocket_batch_size bytes are collected, and then written to the socket with a single syscall.
+    websocket_batch_latency = 0.0
+    websocket_batch_size = 16 * 1024
+    __batch_flusher = None
+    # When larger than 0, everything send to a websocket goes trough a sendQueue.SendQueue of this many bytes with its own writer thread.
+    send_queue_size = 0
+    send_queue_policy = "pause"
+    # Accept permessage-deflate when the client offers it, with at most this window size, see websocketDeflate.negotiate.
+    websocket_deflate = False
+    websocket_deflate_window_bits = 15
+    websocket_deflate_context_takeover = True
+    # Messages larger than this are refused by closing the websocket, also when they are forwarded frame by frame.
+    websocket_max_message_size = 16 * 1024 * 1024
+    # Forward the frames of a fragmented message to the peer (see websocket_PEER) as they arrive, instead of collecting the whole message first.
+    websocket_cut_through = True
+    # Game key under which the messages relayed by this connection are traced, see relayTrace.
+    trace_key = None
 
     def __init__(self, *args):
-        super().__init__(*args)
-        
+        # BaseHTTPRequestHandler handles the whole request from its constructor, so everything needs to be set before that.
         self.__lock = None
         self.__is_websocket = False
-        
-        if WebsocketMixin.__ping_thread is None:
-            __ping_thread = threading.Thread(target=self.__pingWebsockets, daemon=True)
-            __ping_thread.start()
+        self.send_queue = None
+        self.deflate = None
+        super().__init__(*args)
 
     def parse_request(self):
         if not super().parse_request():
@@ -40,14 +75,20 @@ class WebsocketMixin:
             self.send_header("Connection", "Upgrade")
             self.send_header("Upgrade", "websocket")
             self.send_header("Cache-Control", "No-Cache")
-            self.send_header("Sec-WebSocket-Accept", base64.b64encode(hashlib.sha1((self.headers["sec-websocket-key"] + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode("utf-8")).digest()).decode("utf-8"))
+            self.send_header("Sec-WebSocket-Accept", websocketParse.acceptKey(self.headers["sec-websocket-key"]))
             if "Sec-WebSocket-Protocol" in self.headers:
                 if "binary" in self.headers["Sec-WebSocket-Protocol"]:
                     self.send_header("Sec-WebSocket-Protocol", "binary")
                 else:
                     self.send_header("Sec-WebSocket-Protocol", "chat")
+            if self.websocket_deflate and "Sec-WebSocket-Extensions" in self.headers:
+                self.deflate = websocketDeflate.negotiate(", ".join(self.headers.get_all("Sec-WebSocket-Extensions")), self.websocket_deflate_window_bits, self.websocket_deflate_context_takeover)
+                if self.deflate is not None:
+                    self.send_header("Sec-WebSocket-Extensions", self.deflate.response)
             self.end_headers()
             self.close_connection = True
+            # The request headers are not needed anymore, and a parked master can stay for a long time.
+            self.headers = None
             
             self.__handle_websocket()
             return False
@@ -55,61 +96,246 @@ class WebsocketMixin:
 
     def __handle_websocket(self):
         self.__lock = threading.Lock()
-        WebsocketMixin.__active_websockets.add(self)
+        self.__batch = frameBatch.FrameBatch(self.connection)
+        receive_buffer = bufferPool.ReceiveBuffer(bufferPool.pool, websocketParse.min_pooled_payload)
+        if self.send_queue_size > 0:
+            self.send_queue = sendQueue.SendQueue(self.connection, self.send_queue_size, self.send_queue_policy, self.websocket_batch_latency, self.websocket_batch_size)
+            if self.deflate is not None and self.send_queue_policy == "drop_oldest":
+                self.deflate.setLossy()
+        self.last_activity = time.monotonic()
+        self.keepalive_timeout = self.websocket_idle_timeout
+        scheduler = self.__getKeepaliveScheduler()
+        scheduler.add(self)
         self.__is_websocket = True
         self.websocket_OPEN()
-        full_message = b''
+        # State of the fragmented message that is being received, message_opcode is None between messages.
+        message_opcode = None
+        message_size = 0
+        compressed = False
+        fragments = []
+        forward_to = None
+        allowed_rsv = websocketParse.rsv1_mask if self.deflate is not None else 0
         try:
             while not self.rfile.closed:
-                frame = websocketParse.readFrame(self.rfile)
+                # Drop our references to the last message first, so the receive buffer can be reused if the peer is done with it.
+                frame = message = None
+                frame = websocketParse.readFrame(self.rfile, allowed_rsv, self.websocket_max_message_size, receive_buffer)
                 if frame is None:
                     return
-                fin, opcode, message = frame
-                if opcode == websocketParse.opcode_continuation:
-                    full_message = full_message + message
-                    if fin:
-                        self.websocket_MESSAGE(full_message)
-                        full_message = b''
-                elif opcode == websocketParse.opcode_text or opcode == websocketParse.opcode_binary:
-                    if fin:
-                        self.websocket_MESSAGE(message)
+                self.last_activity = time.monotonic()
+                fin, opcode, message, rsv = frame
+                if rsv and opcode != websocketParse.opcode_text and opcode != websocketParse.opcode_binary:
+                    return  # Only the first frame of a data message can be marked as compressed.
+                if opcode == websocketParse.opcode_continuation or opcode == websocketParse.opcode_text or opcode == websocketParse.opcode_binary:
+                    if (opcode == websocketParse.opcode_continuation) != (message_opcode is not None):
+                        return  # A continuation frame without a message to continue, or a new message before the last one was finished.
+                    if opcode != websocketParse.opcode_continuation:
+                        if fin:
+                            traced = relayTrace.traces and relayTrace.beginRelay(self.trace_key, self.last_activity)
+                            if not self.__receiveMessage(opcode, message, bool(rsv)):
+                                return self.__closeMessageTooBig()
+                            if traced:
+                                relayTrace.endRelay()
+                            continue
+                        message_opcode = opcode
+                        message_size = 0
+                        compressed = bool(rsv)
+                        forward_to = self.__startForwarding(compressed)
+                    message_size += len(message)
+                    if message_size > self.websocket_max_message_size:
+                        return self.__closeMessageTooBig()
+                    # A message is traced from its last frame.
+                    traced = fin and relayTrace.traces and relayTrace.beginRelay(self.trace_key, self.last_activity)
+                    if forward_to is not None:
+                        relayed_bytes_metric.inc(len(message))
+                        if opcode != websocketParse.opcode_continuation and compressed:
+                            forward_to.websocket_send_compressed(message, opcode, fin)
+                        else:
+                            forward_to.websocket_send_fragment(opcode, message, fin)
                     else:
-                        full_message = message
+                        fragments.append(message)
+                    if fin:
+                        if forward_to is not None:
+                            relayed_messages_metric.inc()
+                        elif not self.__receiveMessage(message_opcode, b"".join(fragments), compressed):
+                            return self.__closeMessageTooBig()
+                        if traced:
+                            relayTrace.endRelay()
+                        message_opcode = None
+                        fragments = []
+                        forward_to = None
                 elif opcode == websocketParse.opcode_close:
-                    websocketParse.writeFrame(self.wfile, websocketParse.opcode_close, message)
+                    self.__writeControlFrame(websocketParse.opcode_close, message)
                     return
                 elif opcode == websocketParse.opcode_ping:
-                    websocketParse.writeFrame(self.wfile, websocketParse.opcode_pong, message)
+                    self.__writeControlFrame(websocketParse.opcode_pong, message)
                 elif opcode == websocketParse.opcode_pong:
                     pass
                 else:
                     return
         except IOError:
             pass    # We can pretty much except an IOError at some point because the other side will close the connection, or we will get a timeout.
+        except zlib.error:
+            pass    # Invalid compressed data, there is nothing we can do but close the connection.
         finally:
-            WebsocketMixin.__active_websockets.remove(self)
+            receive_buffer.close()
+            scheduler.remove(self)
+            if self.send_queue is not None:
+                self.send_queue.close()
+            else:
+                with self.__lock:
+                    try:
+                        self.__batch.flush()
+                    except IOError:
+                        pass
             self.websocket_CLOSE()
             self.__is_websocket = False
 
-    def websocket_send(self, message):
+    ## Pass a complete received message to websocket_MESSAGE, or when it is compressed and the peer can take it as it is, directly to the peer.
+    #   Returns False when the message is too large once decompressed.
+    def __receiveMessage(self, opcode, message, compressed):
+        if compressed:
+            peer = self.websocket_PEER()
+            if peer is not None and self.deflate.canPassTo(peer.deflate):
+                self.deflate.passedTo(peer.deflate)
+                passthrough_metric.inc()
+                relayed_messages_metric.inc()
+                relayed_bytes_metric.inc(len(message))
+                peer.websocket_send_compressed(message, opcode)
+                return True
+            message = self.deflate.decompress(message, self.websocket_max_message_size)
+            if message is None:
+                return False
+            decompressed_metric.inc()
+        self.websocket_MESSAGE(message, opcode)
+        return True
+
+    ## Find the peer that the frames of a new fragmented message can be forwarded to as they arrive, instead of collecting the whole message first.
+    #   Returns None when the message has to be collected, which is also the case for a compressed message that we need to decompress.
+    def __startForwarding(self, compressed):
+        if not self.websocket_cut_through:
+            return None
+        peer = self.websocket_PEER()
+        if peer is None or not peer.canForwardFragments():
+            return None
+        if compressed:
+            if not self.deflate.canPassTo(peer.deflate):
+                return None
+            self.deflate.passedTo(peer.deflate)
+            passthrough_metric.inc()
+        return peer
+
+    def __closeMessageTooBig(self):
+        self.__writeControlFrame(websocketParse.opcode_close, struct.pack(">H", websocketParse.close_message_too_big))
+
+    ## Return the websocket connection that messages of this connection are relayed to, if any.
+    #   Fragmented messages are forwarded to this peer frame by frame, and compressed messages can be send to it without being
+    #   decompressed first, see websocketDeflate.PerMessageDeflate.canPassTo.
+    def websocket_PEER(self):
+        return None
+
+    ## Forwarded fragments cannot be dropped halfway a message, so this is only possible when the send queue never drops messages.
+    def canForwardFragments(self):
+        return self.send_queue is None or self.send_queue.policy != "drop_oldest"
+
+    def websocket_send(self, message, opcode=websocketParse.opcode_text):
+        # Compressing is done while holding the lock, as messages need to be send in the order in which they were compressed.
         with self.__lock:
-            if not self.wfile.closed:
-                websocketParse.writeFrame(self.wfile, websocketParse.opcode_text, message)
+            rsv = 0
+            if self.deflate is not None and self.deflate.shouldCompress(message):
+                message = self.deflate.compress(message)
+                compressed_metric.inc()
+                rsv = websocketParse.rsv1_mask
+            self.__sendFrame(opcode, message, rsv, True)
+
+    ## Send a message, or the first frame of a fragmented message, that was compressed by the peer of another connection.
+    #   Only to be used when that connection allowed it with canPassTo.
+    def websocket_send_compressed(self, payload, opcode=websocketParse.opcode_text, fin=True):
+        with self.__lock:
+            self.deflate.passedFrom()
+            self.__sendFrame(opcode, payload, websocketParse.rsv1_mask, fin)
+
+    ## Forward a single frame of a fragmented message unchanged. The frames of a message have to be send without any other message in between.
+    def websocket_send_fragment(self, opcode, payload, fin):
+        with self.__lock:
+            self.__sendFrame(opcode, payload, 0, fin)
+
+    # Needs to be called with self.__lock held.
+    def __sendFrame(self, opcode, message, rsv, fin):
+        if self.send_queue is not None:
+            self.send_queue.put([websocketParse.frameHeader(opcode, len(message), rsv, fin), message])
+            return
+        if self.wfile.closed:
+            return
+        if self.websocket_batch_latency <= 0:
+            websocketParse.writeFrame(self.connection, opcode, message, rsv, fin)
+            return
+        self.__batch.add(websocketParse.frameHeader(opcode, len(message), rsv, fin), message)
+        if self.__batch.size >= self.websocket_batch_size:
+            self.__batch.flush()
+        elif len(self.__batch) == 2:
+            self.__getBatchFlusher().schedule(self.websocket_batch_latency, self.__flushBatch)
+
+    ## Called from the batch flusher thread when the latency budget of the first frame in the batch has passed.
+    #   If the socket cannot take everything without blocking, the rest is retried after another latency period.
+    def __flushBatch(self):
+        if not self.__lock.acquire(blocking=False):
+            self.__getBatchFlusher().schedule(self.websocket_batch_latency, self.__flushBatch)
+            return
+        try:
+            if self.wfile.closed:
+                return
+            if not self.__batch.flushNonBlocking():
+                self.__getBatchFlusher().schedule(self.websocket_batch_latency, self.__flushBatch)
+        finally:
+            self.__lock.release()
 
     def websocket_send_ping(self):
+        self.__writeControlFrame(websocketParse.opcode_ping, b'')
+
+    def __writeControlFrame(self, opcode, message):
+        if self.send_queue is not None:
+            self.send_queue.put([websocketParse.frameHeader(opcode, len(message)), message], control=True)
+            return
         with self.__lock:
             if not self.wfile.closed:
-                websocketParse.writeFrame(self.wfile, websocketParse.opcode_ping, b'')
+                websocketParse.writeFrame(self.connection, opcode, message)
 
     def is_websocket(self):
         return self.__is_websocket
 
+    ## Called by the keepalive scheduler. This must not block that thread, so no ping is send while another thread is writing,
+    #   (which means the connection is not idle anyway) or when the send buffer of the socket is full.
+    def keepalivePing(self):
+        if self.send_queue is not None:
+            if self.send_queue.depth == 0:
+                self.send_queue.put([websocketParse.frameHeader(websocketParse.opcode_ping, 0)], control=True)
+            return
+        if not self.__lock.acquire(blocking=False):
+            return
+        try:
+            if not self.wfile.closed and frameBatch.isWritable(self.connection):
+                websocketParse.writeFrame(self.connection, websocketParse.opcode_ping, b'')
+        finally:
+            self.__lock.release()
+
+    def keepaliveExpired(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    @classmethod
+    def __getKeepaliveScheduler(cls):
+        with WebsocketMixin.__keepalive_lock:
+            if WebsocketMixin.keepalive_scheduler is None:
+                WebsocketMixin.keepalive_scheduler = keepalive.KeepaliveScheduler(cls.websocket_ping_interval)
+                WebsocketMixin.keepalive_scheduler.start()
+            return WebsocketMixin.keepalive_scheduler
+
     @staticmethod
-    def __pingWebsockets():
-        while True:
-            time.sleep(5)
-            try:
-                for ws in WebsocketMixin.__active_websockets.copy():
-                    ws.websocket_send_ping()
-            except:
-                pass
+    def __getBatchFlusher():
+        with WebsocketMixin.__keepalive_lock:
+            if WebsocketMixin.__batch_flusher is None:
+                WebsocketMixin.__batch_flusher = frameBatch.BatchFlusher()
+            return WebsocketMixin.__batch_flusher
@@ -1,9 +1,21 @@
 import struct
 import itertools
+import base64
+import hashlib
+import asyncio
+
+import metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 fin_mask = 0x80
 rsv_mask = 0x70
+# Set on the first frame of a compressed message when permessage-deflate is negotiated.
+rsv1_mask = 0x40
 opcode_mask = 0x0f
     
 mask_mask = 0x80;
@@ -18,8 +30,77 @@ opcode_close = 0x08
 opcode_ping = 0x09
 opcode_pong = 0x0a
 
+# Status code of a close frame for a message that is too big to process.
+close_message_too_big = 1009
+
+accept_magic = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Every frame that is read or written passes here, so the metric children are only looked up once.
+frames_received_metric = metrics.websocket_frames_received.labels()
+bytes_received_metric = metrics.websocket_bytes_received.labels()
+frames_sent_metric = metrics.websocket_frames_sent.labels()
+bytes_sent_metric = metrics.websocket_bytes_sent.labels()
+
+
+def acceptKey(websocket_key):
+    return base64.b64encode(hashlib.sha1((websocket_key + accept_magic).encode("utf-8")).digest()).decode("utf-8")
+
+
+# Payloads of at least this size are unmasked with numpy when it is installed, below this the big integer xor is faster.
+numpy_unmask_threshold = 1024
+# Payloads of at least this size are read into a pooled receive buffer, see readFrame.
+min_pooled_payload = 32 * 1024
+
+
+## Reference implementation, one python iteration per byte.
+def unmaskPython(message, mask_data):
+    return bytes(b ^ m for b, m in zip(message, itertools.cycle(mask_data)))
+
+
+## Unmask the whole payload in one go by treating both the payload and the repeated mask as one big integer.
+def unmaskInt(message, mask_data):
+    length = len(message)
+    mask_data = (mask_data * ((length >> 2) + 1))[:length]
+    return (int.from_bytes(message, "little") ^ int.from_bytes(mask_data, "little")).to_bytes(length, "little")
 
-def readFrame(stream):
+
+## Unmask 4 bytes at a time with numpy, the tail that does not fill a full word is done with unmaskInt.
+def unmaskNumpy(message, mask_data):
+    length = len(message)
+    words = length >> 2
+    result = numpy.bitwise_xor(numpy.frombuffer(message, dtype=numpy.uint32, count=words), numpy.frombuffer(mask_data, dtype=numpy.uint32)[0]).tobytes()
+    if words * 4 != length:
+        result += unmaskInt(message[words * 4:], mask_data)
+    return result
+
+
+def unmask(message, mask_data):
+    if numpy is not None and len(message) >= numpy_unmask_threshold:
+        return unmaskNumpy(message, mask_data)
+    return unmaskInt(message, mask_data)
+
+
+## Unmask a writable buffer (like a memoryview of a bytearray) without allocating a new payload. Only numpy can do this
+#   without any temporary copy, unmaskInt needs one.
+def unmaskInPlace(message, mask_data):
+    length = len(message)
+    if numpy is not None and length >= numpy_unmask_threshold:
+        words = length >> 2
+        array = numpy.frombuffer(message, dtype=numpy.uint32, count=words)
+        numpy.bitwise_xor(array, numpy.frombuffer(mask_data, dtype=numpy.uint32)[0], out=array)
+        if words * 4 != length:
+            message[words * 4:] = unmaskInt(message[words * 4:], mask_data)
+    else:
+        message[:] = unmaskInt(message, mask_data)
+
+
+## Read a single frame, returns (fin, opcode, message, rsv) or None when the connection is closed or the frame is invalid.
+#   Frames with any of the RSV bits set that are not in allowed_rsv are invalid, these bits are only used by extensions.
+#   Frames with a payload larger than max_length (when not 0) are invalid as well, so no memory is spend on them.
+#   With a bufferPool.ReceiveBuffer large payloads are read into that and unmasked in place, the message is then a memoryview
+#   of the buffer (see bufferPool for how long it stays valid). Small payloads, or masked payloads without numpy (unmaskInt
+#   creates a new payload anyway), are read into a new bytes object, which is cheaper than the pool for those.
+def readFrame(stream, allowed_rsv=0, max_length=0, receive_buffer=None):
     header = stream.read(2)
     if len(header) != 2:
         return None
@@ -29,33 +110,114 @@ def readFrame(stream):
     rsv = header[0] & rsv_mask
     mask = header[1] & mask_mask
     
-    if rsv != 0x00:
+    if rsv & ~allowed_rsv:
         return None
-    
+
+    # Extended payload length and mask are read in one go.
+    extra_length = 4 if mask else 0
     if payload_length == payload_length_16bit:
-        payload_length_buffer = stream.read(2)
-        if len(payload_length_buffer) != 2:
-            return None
-        payload_length = struct.unpack(">H", payload_length_buffer)[0]
+        extra_length += 2
     elif payload_length == payload_length_64bit:
-        payload_length_buffer = stream.read(8)
-        if len(payload_length_buffer) != 8:
+        extra_length += 8
+    extra = stream.read(extra_length) if extra_length else b""
+    if len(extra) != extra_length:
+        return None
+    if payload_length == payload_length_16bit:
+        payload_length = struct.unpack_from(">H", extra)[0]
+    elif payload_length == payload_length_64bit:
+        payload_length = struct.unpack_from(">Q", extra)[0]
+    if max_length and payload_length > max_length:
+        return None
+    mask_data = extra[-4:] if mask else None
+    if receive_buffer is not None and payload_length >= min_pooled_payload and (numpy is not None or not mask):
+        receive_buffer.observe(payload_length)
+        message = receive_buffer.get(payload_length)
+        if stream.readinto(message) != payload_length:
             return None
-        payload_length = struct.unpack(">Q", payload_length_buffer)[0]
-    mask_data = None
-    if mask:
-        mask_data = stream.read(4)
-    message = stream.read(payload_length)
+        if mask:
+            unmaskInPlace(message, mask_data)
+    else:
+        message = stream.read(payload_length)
+        if len(message) != payload_length:
+            return None
+        if mask:
+            message = unmask(message, mask_data)
+    frames_received_metric.inc()
+    bytes_received_metric.inc(payload_length)
+    return fin, opcode, message, rsv
+
+
+## Same as readFrame, but for an asyncio.StreamReader
+async def readFrameAsync(stream, allowed_rsv=0, max_length=0):
+    try:
+        header = await stream.readexactly(2)
+        payload_length = header[1] & payload_length_mask
+        opcode = header[0] & opcode_mask
+        fin = header[0] & fin_mask
+        rsv = header[0] & rsv_mask
+        mask = header[1] & mask_mask
+
+        if rsv & ~allowed_rsv:
+            return None
+
+        if payload_length == payload_length_16bit:
+            payload_length = struct.unpack(">H", await stream.readexactly(2))[0]
+        elif payload_length == payload_length_64bit:
+            payload_length = struct.unpack(">Q", await stream.readexactly(8))[0]
+        if max_length and payload_length > max_length:
+            return None
+        mask_data = None
+        if mask:
+            mask_data = await stream.readexactly(4)
+        message = await stream.readexactly(payload_length)
+    except asyncio.IncompleteReadError:
+        return None
     if mask:
-        message = bytes(b ^ m for b, m in zip(message, itertools.cycle(mask_data)))
-    return fin, opcode, message
+        message = unmask(message, mask_data)
+    frames_received_metric.inc()
+    bytes_received_metric.inc(payload_length)
+    return fin, opcode, message, rsv
 
 
-def writeFrame(stream, opcode, message):
-    if len(message) < payload_length_16bit:
-        stream.write(struct.pack(">BB", fin_mask | opcode, len(message)))
-    elif len(message) < (1 << 16):
-        stream.write(struct.pack(">BBH", fin_mask | opcode, payload_length_16bit, len(message)))
+## Build the header of an outgoing frame. All frames that are send are build trough here, so this is where they are counted.
+#   Frames of a fragmented message are send with fin=False, except for the last one.
+def frameHeader(opcode, length, rsv=0, fin=True):
+    frames_sent_metric.inc()
+    bytes_sent_metric.inc(length)
+    first_byte = (fin_mask if fin else 0) | rsv | opcode
+    if length < payload_length_16bit:
+        return struct.pack(">BB", first_byte, length)
+    elif length < (1 << 16):
+        return struct.pack(">BBH", first_byte, payload_length_16bit, length)
+    return struct.pack(">BBQ", first_byte, payload_length_64bit, length)
+
+
+## Write a single frame. When the stream is a socket the header and payload are send with a single sendmsg call,
+#   otherwise they are given to the stream in a single writelines call, which asyncio.StreamWriter turns into one write.
+def writeFrame(stream, opcode, message, rsv=0, fin=True):
+    header = frameHeader(opcode, len(message), rsv, fin)
+    if hasattr(stream, "sendmsg"):
+        sendBuffers(stream, [header, message])
     else:
-        stream.write(struct.pack(">BBQ", fin_mask | opcode, payload_length_64bit, len(message)))
-    stream.write(message)
+        stream.writelines((header, message))
+
+
+# Linux limits the number of buffers in a single sendmsg call to 1024
+max_send_buffers = 1024
+
+
+## Send a list of buffers to a socket, using as few sendmsg calls as possible.
+def sendBuffers(sock, buffers):
+    buffers = [buffer for buffer in buffers if len(buffer) > 0]
+    while buffers:
+        consumeBuffers(buffers, sock.sendmsg(buffers[:max_send_buffers]))
+
+
+## Remove count bytes from the front of a list of buffers, after a (partial) send of those buffers.
+def consumeBuffers(buffers, count):
+    while count > 0:
+        if count >= len(buffers[0]):
+            count -= len(buffers.pop(0))
+        else:
+            buffers[0] = memoryview(buffers[0])[count:]
+            count = 0
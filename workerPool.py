@@ -0,0 +1,345 @@
+import os
+import socket
+import selectors
+import signal
+import sys
+import array
+import json
+import logging
+import threading
+import time
+import urllib.parse
+import zlib
+
+import sessionLog
+from gameSession import GameSession
+
+## Multi process mode of the threaded server.
+#   A coordinator process forks a number of workers, which all listen on the server port with SO_REUSEPORT, so the kernel spreads
+#   new connections over them and relaying is no longer limited to a single core.
+#   Every worker has a copy of all sessions, so /game/register and /game/list can be handled by any worker. Changes are send to
+#   the coordinator, which forwards them to all other workers and keeps a copy to restore a worker that has to be restarted.
+#   Every game key has a home worker (see homeWorker). Only the home worker handles /game/master and /game/connect/[key] for that
+#   key, so the masters and clients of a session always meet in the same process. Keys of new sessions are chosen so that the
+#   worker handling the registration is the home worker. A connection that is accepted by another worker is passed to the home
+#   worker with SCM_RIGHTS before anything is read from it, the home worker then handles it as if it accepted it itself.
+#   Only the home worker expires a session, the copies in other workers are replicas that are removed when the home worker reports
+#   the session as removed.
+#   With a session log (see sessionLog) the coordinator writes all changes to it, and restores the sessions of the previous run
+#   by sending them to the workers as if they were just registered.
+
+# Maximum size of the HTTP request head that is inspected to find out where a connection should go.
+max_peek_size = 8192
+# Maximum size of a message between the coordinator and a worker.
+max_message_size = 65536
+
+
+def homeWorker(game_key, worker_count):
+    return zlib.crc32(game_key.encode("utf-8", "replace")) % worker_count
+
+
+## Find the game key that a new connection is about, without consuming any of its data.
+#   Returns None for requests that are not about a single session, or when the request head did not arrive in time.
+def peekGameKey(sock, timeout, retry_delay=0.005):
+    deadline = time.monotonic() + timeout
+    head = b""
+    try:
+        sock.settimeout(timeout)
+        while True:
+            head = sock.recv(max_peek_size, socket.MSG_PEEK)
+            if head == b"" or b"\r\n\r\n" in head or len(head) >= max_peek_size:
+                break
+            if time.monotonic() > deadline:
+                return None
+            # A peek returns right away as long as there is any data, so wait a bit for the rest of the head to arrive.
+            time.sleep(retry_delay)
+    except OSError:
+        return None
+    finally:
+        try:
+            sock.settimeout(None)
+        except OSError:
+            pass
+    request_line, _, header_block = head.partition(b"\r\n")
+    words = request_line.split()
+    if len(words) != 3:
+        return None
+    path = words[1].decode("latin-1")
+    if path.startswith("/game/connect/"):
+        return urllib.parse.urlsplit(path).path[14:]
+    if path.startswith("/admin/trace/"):
+        return urllib.parse.urlsplit(path).path[13:]
+    if path == "/game/master":
+        for line in header_block.split(b"\r\n"):
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"game-key":
+                return value.strip().decode("latin-1")
+    return None
+
+
+## Pass a connected socket to another process, together with the address of the remote side.
+def sendConnection(channel, sock, client_address):
+    fds = array.array("i", [sock.fileno()])
+    channel.sendmsg([json.dumps(client_address).encode("utf-8")], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+## Receive a socket send with sendConnection, returns a (socket, client_address) tuple.
+def receiveConnection(channel):
+    fds = array.array("i")
+    data, ancdata, flags, address = channel.recvmsg(max_message_size, socket.CMSG_SPACE(fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if len(fds) != 1:
+        for fd in fds:
+            os.close(fd)
+        return None, None
+    return socket.socket(fileno=fds[0]), tuple(json.loads(data.decode("utf-8")))
+
+
+## Server mixin for a worker process, to be mixed in before the Server class in main.py.
+class WorkerServerMixin:
+    # Time to wait for the request head of a new connection to find out which worker should handle it.
+    route_timeout = 5.0
+
+    def __init__(self, worker_index, registry_channel, handoff_channels, *args, **kwargs):
+        self.worker_index = worker_index
+        self.worker_count = len(handoff_channels)
+        self.__registry_channel = registry_channel
+        self.__handoff_channels = handoff_channels
+        super().__init__(*args, **kwargs)
+        threading.Thread(target=self.__receiveRegistry, daemon=True).start()
+        threading.Thread(target=self.__receiveHandoffs, daemon=True).start()
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def isHomeOf(self, game_key):
+        return homeWorker(game_key, self.worker_count) == self.worker_index
+
+    def createKey(self):
+        while True:
+            key = super().createKey()
+            if self.isHomeOf(key):
+                return key
+
+    def addGame(self, game):
+        if not super().addGame(game):
+            return False
+        if not self.__publish({"add": game.toRecord()}):
+            # The other workers do not know about the session, so it cannot be used.
+            self.removeGame(game.key)
+            return False
+        return True
+
+    def gameRemoved(self, session):
+        super().gameRemoved(session)
+        if self.isHomeOf(session.key):
+            self.__publish({"remove": session.key})
+
+    def process_request_thread(self, request, client_address):
+        game_key = peekGameKey(request, self.route_timeout)
+        if game_key and not self.isHomeOf(game_key):
+            try:
+                sendConnection(self.__handoff_channels[homeWorker(game_key, self.worker_count)], request, client_address)
+            except OSError:
+                logging.exception("Failed to pass connection for %s to its home worker", game_key)
+            else:
+                # Only close our copy, shutting the socket down would also end the connection for the home worker.
+                self.close_request(request)
+                return
+        super().process_request_thread(request, client_address)
+
+    ## Send a registry update to the coordinator, returns False when it could not be send.
+    def __publish(self, message):
+        data = json.dumps(message).encode("utf-8")
+        if len(data) > max_message_size:
+            logging.error("Registry update of %d bytes is too large to send to the coordinator", len(data))
+            return False
+        try:
+            self.__registry_channel.send(data)
+        except OSError:
+            logging.exception("Failed to send registry update to the coordinator")
+            return False
+        return True
+
+    def __receiveRegistry(self):
+        while True:
+            try:
+                data = self.__registry_channel.recv(max_message_size)
+            except OSError:
+                data = b""
+            if data == b"":
+                logging.error("Worker %d lost the connection to the coordinator, stopping", self.worker_index)
+                self.shutdown()
+                return
+            try:
+                message = json.loads(data.decode("utf-8"))
+                if "add" in message:
+                    record = message["add"]
+                    # Use the registry directly, updates from the coordinator should not be published again.
+                    super().addGame(GameSession.fromRecord(record, replica=not self.isHomeOf(record["key"])))
+                elif "remove" in message:
+                    self.removeGame(message["remove"])
+            except (ValueError, TypeError, KeyError):
+                logging.exception("Worker %d dropped an invalid registry update", self.worker_index)
+
+    def __receiveHandoffs(self):
+        channel = self.__handoff_channels[self.worker_index]
+        while True:
+            try:
+                request, client_address = receiveConnection(channel)
+            except OSError:
+                logging.exception("Failed to receive connection from another worker")
+                continue
+            if request is not None:
+                self.process_request(request, client_address)
+
+
+## Parent process of the workers.
+#   start_worker(worker_index, registry_channel, handoff_channels) is called in every forked worker process and should serve till
+#   the worker is stopped. Workers that die are started again, at most once per restart_delay, and get all sessions that are known
+#   to the coordinator.
+class Coordinator:
+    restart_delay = 1.0
+
+    def __init__(self, worker_count, start_worker, session_log_path=None):
+        self.worker_count = worker_count
+        self.__start_worker = start_worker
+        self.__selector = selectors.DefaultSelector()
+        self.__records = {}
+        self.__session_log = None
+        if session_log_path is not None:
+            self.__session_log = sessionLog.SessionLog(session_log_path, lambda: list(self.__records.values()))
+        self.__pids = {}
+        self.__start_times = [0.0] * worker_count
+        self.__dead_workers = set()
+        self.__registry_channels = [None] * worker_count
+        # Every worker can send connections to every other worker, so all workers get the sending ends of all channels.
+        # The receiving end of a channel is kept open here as well, so connections passed to a worker that is being restarted are not lost.
+        self.__handoff_pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for n in range(worker_count)]
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        for index in range(self.worker_count):
+            self.__startWorker(index)
+        if self.__session_log is not None:
+            self.__restoreSessions()
+        try:
+            while True:
+                for key, events in self.__selector.select(self.restart_delay):
+                    self.__receive(key.data)
+                self.__restartDeadWorkers()
+        finally:
+            for pid in self.__pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def __startWorker(self, index):
+        old_channel = self.__registry_channels[index]
+        if old_channel is not None:
+            self.__selector.unregister(old_channel)
+            old_channel.close()
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.__start_times[index] = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.__selector.close()
+            channel.close()
+            for other in self.__registry_channels:
+                if other is not None:
+                    other.close()
+            handoff_channels = []
+            for other_index, (send_end, receive_end) in enumerate(self.__handoff_pairs):
+                if other_index == index:
+                    send_end.close()
+                    handoff_channels.append(receive_end)
+                else:
+                    receive_end.close()
+                    handoff_channels.append(send_end)
+            try:
+                self.__start_worker(index, worker_channel, handoff_channels)
+            except BaseException:
+                logging.exception("Worker %d failed", index)
+                os._exit(1)
+            os._exit(0)
+        worker_channel.close()
+        self.__pids[pid] = index
+        self.__registry_channels[index] = channel
+        self.__selector.register(channel, selectors.EVENT_READ, index)
+        for record in self.__records.values():
+            channel.send(json.dumps({"add": record}).encode("utf-8"))
+        logging.info("Started worker %d as process %d", index, pid)
+
+    def __receive(self, index):
+        try:
+            data = self.__registry_channels[index].recv(max_message_size)
+        except OSError:
+            data = b""
+        if data == b"":
+            # The worker is gone, stop listening till it is restarted.
+            self.__selector.unregister(self.__registry_channels[index])
+            self.__registry_channels[index].close()
+            self.__registry_channels[index] = None
+            return
+        try:
+            message = json.loads(data.decode("utf-8"))
+            if "add" in message:
+                key = message["add"]["key"]
+            elif "remove" in message:
+                key = message["remove"]
+            else:
+                raise ValueError("Unknown registry update")
+            if not isinstance(key, str):
+                raise ValueError("Invalid game key")
+        except (ValueError, TypeError, KeyError):
+            logging.exception("Dropped an invalid registry update of worker %d", index)
+            return
+        if "add" in message:
+            self.__records[key] = message["add"]
+            if self.__session_log is not None:
+                self.__session_log.added(message["add"])
+        elif "remove" in message:
+            if self.__records.pop(message["remove"], None) is None:
+                return
+            if self.__session_log is not None:
+                self.__session_log.removed(message["remove"])
+        self.__sendToWorkers(data, index)
+
+    def __sendToWorkers(self, data, skip_index=None):
+        for other_index, channel in enumerate(self.__registry_channels):
+            if other_index != skip_index and channel is not None:
+                try:
+                    channel.send(data)
+                except OSError:
+                    pass    # The worker is dying, it gets the full state when it is restarted.
+
+    # The workers are already serving while this runs, but lookups in the workers do not wait for the restore.
+    def __restoreSessions(self):
+        count = 0
+        for key, record in self.__session_log.load().items():
+            if key in self.__records:
+                continue
+            self.__records[key] = record
+            self.__sendToWorkers(json.dumps({"add": record}).encode("utf-8"))
+            count += 1
+        self.__session_log.restored()
+        logging.info("Restored %d sessions from %s", count, self.__session_log.path)
+
+    def __restartDeadWorkers(self):
+        while self.__pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            index = self.__pids.pop(pid, None)
+            if index is not None:
+                logging.warning("Worker %d (process %d) stopped with status %d, restarting", index, pid, status)
+                self.__dead_workers.add(index)
+        for index in list(self.__dead_workers):
+            if time.monotonic() - self.__start_times[index] >= self.restart_delay:
+                self.__dead_workers.discard(index)
+                self.__startWorker(index)